@@ -1,162 +1,514 @@
 #!/usr/bin/env python
-import getpass
-import sys
-import telnetlib
-import time
-import sqlite3
 import httplib
+import json
 import logging
+import socket
+import sqlite3
+import telnetlib
+import threading
+import time
+import uuid
 
 import argparse
 
 logging.basicConfig(level=logging.INFO)
 
-def local_record(mac, is_new):
-    if is_new:
-        # Insert a row of data
-        query = "insert into mac(joined, mac) values (%d,'%s')" % (
-            int(time.time()), mac)
-    else:
-        query = "update mac set left = %d where left is null and mac = '%s'" % (
-            int(time.time()), mac)
-
-    cursor.execute(query)
-    conn.commit()
-
-def http_record(mac, is_new):
-    httpconn = httplib.HTTPConnection(args.server, args.port)
-    if is_new:
-        httpconn.request("GET", "/MAC/%s" % mac)
-    else:
-        httpconn.request("DELETE", "/MAC/%s" % mac)
-    res = httpconn.getresponse()
-    if res.status != 200:
-        print "Error updating: " + res.reason
-    else:
-        print res.read()
-    httpconn.close()
-
-def http_ping():
-    httpconn = httplib.HTTPConnection(args.server, args.port)
-    httpconn.request("GET", "/ping")
-    res = httpconn.getresponse()
-    if res.status != 200:
-        print "Error updating: " + res.reason
-    httpconn.close()
-
-def fetch_current_mac():
-    query = "select mac from mac where left is null"
-    cursor.execute(query)
-    return set([v[0] for v in cursor.fetchall()])
-
-logging.info("Parsing arguments")
-parser = argparse.ArgumentParser(description='Capture wifi data')
-parser.add_argument(
-    '--sqlite_filename',
-    dest='sqlite_filename',
-    default='/opt/wifi/mac.dat')
-parser.add_argument(
-    '--host',
-    dest='host',
-    default='192.168.1.1')
-parser.add_argument(
-    '--user',
-    dest='user',
-    default='root'
-    )
-parser.add_argument(
-    '--password_filename',
-    dest='password_filename',
-    default='/opt/wifi/router.passwd'
-    )
-parser.add_argument(
-    '--server',
-    dest='server',
-    default='wifi.xinchejian.com'
-    )
-parser.add_argument(
-    '--port',
-    dest='port',
-    default=9000
-    )
-parser.add_argument(
-    '--once',
-    dest='once',
-    default=False
-    )
-global args
-
-args = parser.parse_args()
-password = file(args.password_filename).readlines()[0].strip()
-
-conn = sqlite3.connect(args.sqlite_filename)
-cursor = conn.cursor()
-
-logging.info("Creating local datastore table " + args.sqlite_filename)
-try:
-    cursor.execute(
-        "create table mac (joined NUMERIC, left NUMERIC, mac TEXT)")
-except sqlite3.OperationalError:
-    pass
-
-logging.info("Syncing local datastore %s to server %s" % (args.sqlite_filename, args.server))
-mac_set = fetch_current_mac()
-
-# make sure we're in sync...
-for m in mac_set:
-    http_record(m, True)
-
-logging.info("Connecting to the server %s" % args.server)
-while True:
-    try:
-        tn = telnetlib.Telnet(args.host)
-
-        tn.read_until("login: ")
-        tn.write(args.user + "\n")
-        if password:
-            tn.read_until("Password: ")
-            tn.write(password + "\n")
-        tn.read_until("#").split("\n")
-        logging.error("Connected!")
-        break
-    except Exception as e:
-        logging.error("Unable to connect, waiting! %s" % e)
-    if args.once:
-        break
-    else:
-        time.sleep(5)
-
-logging.info("Fetching information from %s" % args.host)
-while True:
-    try:
-        tn.write("wl_atheros assoclist\n")
-        current_list = tn.read_until("#").split("\n")
-        current_list = [i.split(" ")[1].strip() for i in current_list if i.startswith("assoclist")]
-        current_set = set(current_list)
-        #print "Currently connected: %d" % len(current_set)
-        ping_needed = True
-        for s in current_set.difference(mac_set):
-            logging.info("NEW: " + s)
-            local_record(s, True)
-            http_record(s, True)
-            ping_needed = False
-        for s in mac_set.difference(current_set):
-            logging.info("GONE: " + s)
-            local_record(s, False)
-            http_record(s, False)
-            ping_needed = False
-        if ping_needed:
-            http_ping()
-        mac_set.intersection_update(current_set)
-        mac_set.update(current_set)
-    except Exception as e:
-        logging.error("Error recording information %s" % e)
-    if args.once:
-        break
-    else:
-        time.sleep(5)
-
-tn.write("exit\n")
-# We can also close the cursor if we are done with it
-cursor.close()
+POLL_INTERVAL = 5
+TIMEOUT = 10
+MAX_BACKOFF = 300
+BATCH_SIZE = 500
+ARCHIVE_INTERVAL = 60 * 60
+ARCHIVE_BATCH = 500
+DAY_LENGTH = 60 * 60 * 24
+
+# schema of the local datastore, `pragma user_version` is the number of
+# migrations applied
+MIGRATIONS = [
+    [
+        "create table if not exists mac "
+        "(joined NUMERIC, left NUMERIC, mac TEXT)",
+        "create table if not exists outbox ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT, timestamp NUMERIC, "
+        "event TEXT, mac TEXT, acked INTEGER DEFAULT 0)",
+        "create table if not exists meta "
+        "(key TEXT PRIMARY KEY, value TEXT)",
+        "create table device (id INTEGER PRIMARY KEY, mac TEXT NOT NULL "
+        "UNIQUE)",
+        "create table session (id INTEGER PRIMARY KEY, device INTEGER NOT "
+        "NULL REFERENCES device(id), joined NUMERIC NOT NULL, left NUMERIC)",
+        "insert or ignore into device(mac) select mac from mac order by rowid",
+        "insert into session(device, joined, left) "
+        "select device.id, mac.joined, mac.left from mac "
+        "join device on device.mac = mac.mac order by mac.rowid",
+        "drop table mac",
+        "create index session_open on session(device) where left is null",
+        "create index session_left on session(left) where left is not null",
+        "create index outbox_pending on outbox(seq) where acked = 0",
+    ],
+]
+# how long the last assoclist of an unreachable router is still trusted
+STALE_AFTER = 60
+
+
+class Backoff():
+    def __init__(self, initial=POLL_INTERVAL, maximum=MAX_BACKOFF):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0
+        self.next_attempt = 0
+
+    def ready(self):
+        return time.time() >= self.next_attempt
+
+    def failed(self):
+        self.delay = min(max(self.delay * 2, self.initial), self.maximum)
+        self.next_attempt = time.time() + self.delay
+        return self.delay
+
+    def succeeded(self):
+        self.delay = 0
+        self.next_attempt = 0
+
+
+class Router():
+    def __init__(self, host, user, password, port=23):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.tn = None
+        self.backoff = Backoff()
+
+    def connect(self):
+        tn = telnetlib.Telnet(self.host, self.port, TIMEOUT)
+        self._read_until(tn, "login: ")
+        tn.write(self.user + "\n")
+        if self.password:
+            self._read_until(tn, "Password: ")
+            tn.write(self.password + "\n")
+        self._read_until(tn, "#")
+        self.tn = tn
+
+    def close(self):
+        if self.tn is None:
+            return
+        try:
+            self.tn.write("exit\n")
+            self.tn.close()
+        except (socket.error, EOFError):
+            pass
+        self.tn = None
+
+    def assoclist(self):
+        # None when the router can't be reached, reconnections are spaced
+        # out by the backoff without ever sleeping
+        if self.tn is None:
+            if not self.backoff.ready():
+                return None
+            try:
+                self.connect()
+            except (socket.error, EOFError, IOError) as e:
+                logging.error("Unable to connect to %s, retrying in %ds: %s"
+                              % (self.host, self.backoff.failed(), e))
+                return None
+            self.backoff.succeeded()
+            logging.info("Connected to %s" % self.host)
+        try:
+            self.tn.write("wl_atheros assoclist\n")
+            current_list = self._read_until(self.tn, "#").split("\n")
+        except (socket.error, EOFError, IOError) as e:
+            logging.error("Lost connection to %s: %s" % (self.host, e))
+            self.close()
+            return None
+        return set([i.split(" ")[1].strip()
+                    for i in current_list if i.startswith("assoclist")])
+
+    def _read_until(self, tn, prompt):
+        data = tn.read_until(prompt, TIMEOUT)
+        if not data.endswith(prompt):
+            raise IOError("timeout waiting for %r" % prompt)
+        return data
+
+
+class RouterPoller(threading.Thread):
+    def __init__(self, router, interval=POLL_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.router = router
+        self.interval = interval
+        self.macs = None
+        self.updated = 0
+        self.lock = threading.Lock()
+        self.polled = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            try:
+                current_set = self.router.assoclist()
+            except Exception as e:
+                logging.error("Error polling %s: %s" % (self.router.host, e))
+                current_set = None
+            if current_set is not None:
+                with self.lock:
+                    self.macs = current_set
+                    self.updated = time.time()
+            self.polled.set()
+            self.stopped.wait(max(0, self.interval - (time.time() - start)))
+        self.router.close()
+
+    def presence(self, now):
+        with self.lock:
+            if self.macs is None or now - self.updated > STALE_AFTER:
+                return None
+            return self.macs
+
+
+class Site():
+    # Polls every router concurrently and merges their assoclists, a device
+    # roaming between access points stays present.
+    def __init__(self, routers, interval=POLL_INTERVAL):
+        self.pollers = [RouterPoller(router, interval) for router in routers]
+
+    def start(self):
+        for poller in self.pollers:
+            poller.start()
+        # don't report devices of routers not polled yet as gone
+        deadline = time.time() + TIMEOUT * 2
+        for poller in self.pollers:
+            poller.polled.wait(max(0, deadline - time.time()))
+
+    def stop(self):
+        for poller in self.pollers:
+            poller.stopped.set()
+        for poller in self.pollers:
+            poller.join()
+
+    def assoclist(self):
+        now = time.time()
+        current_sets = [poller.presence(now) for poller in self.pollers]
+        current_sets = [macs for macs in current_sets if macs is not None]
+        if not current_sets:
+            return None
+        return set().union(*current_sets)
+
+
+class Flusher(threading.Thread):
+    # Ships the outbox to the server in sequence order on a keep-alive
+    # connection and marks events acknowledged once the server applied
+    # them. Runs in its own thread, with its own database connection, so a
+    # slow or unreachable server never delays polling; events wait in the
+    # outbox until it is back.
+    def __init__(self, filename, server, port):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.server = server
+        self.port = port
+        self.conn = None
+        self.backoff = Backoff(1)
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        # the server gets the open sessions once, after the outbox
+        self.resync = True
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.join()
+
+    def run(self):
+        store = Store(self.filename)
+        while True:
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+            delay = None
+            try:
+                self.flush(store)
+                self.backoff.succeeded()
+            except (httplib.HTTPException, socket.error) as e:
+                delay = self.backoff.failed()
+                logging.error("Unable to reach %s, retrying in %ds: %s"
+                              % (self.server, delay, e))
+            except Exception:
+                # a bad response or a locked datastore, the thread must
+                # outlive it or the outbox is never shipped again
+                delay = self.backoff.failed()
+                logging.exception("Unable to flush to %s, retrying in %ds"
+                                  % (self.server, delay))
+            if delay is not None:
+                self.close()
+                if not self.stopped.is_set():
+                    self.stopped.wait(delay)
+            if self.stopped.is_set():
+                break
+        store.close()
+        self.close()
+
+    def flush(self, store):
+        sent = False
+        while True:
+            events = store.pending(BATCH_SIZE)
+            if not events:
+                break
+            body = "".join(["%d %d %s%s\n" % event for event in events])
+            result = json.loads(self.request(
+                "POST", "/assoclist?mode=events&agent=%s" % store.agent_id,
+                body))
+            store.ack(result["acked"])
+            sent = True
+            if result["acked"] < events[-1][0]:
+                break
+        if self.resync:
+            body = "".join(["%s\n" % mac for mac in store.current_macs()])
+            self.request("POST", "/assoclist", body)
+            self.resync = False
+            sent = True
+        if not sent:
+            self.request("GET", "/ping")
+
+    def request(self, method, uri, body=None):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.server, self.port,
+                                               timeout=TIMEOUT)
+        self.conn.request(method, uri, body, {"Content-Type": "text/plain"})
+        res = self.conn.getresponse()
+        content = res.read()
+        if res.status != 200:
+            raise httplib.HTTPException(
+                "%s %s: %s" % (uri, res.status, res.reason))
+        return content
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Store():
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("pragma journal_mode=wal")
+        self.cursor.execute("pragma synchronous=normal")
+        self.migrate()
+        self.agent_id = self._agent_id()
+        self.conn.commit()
+
+    def migrate(self):
+        self.cursor.execute("pragma user_version")
+        version = self.cursor.fetchone()[0]
+        # each migration is a single transaction, DDL included
+        self.conn.isolation_level = None
+        for (version, statements) in enumerate(MIGRATIONS[version:],
+                                               version + 1):
+            logging.info("Migrating %s to schema version %d"
+                         % (self.filename, version))
+            self.cursor.execute("begin")
+            for statement in statements:
+                self.cursor.execute(statement)
+            self.cursor.execute("pragma user_version = %d" % version)
+            self.cursor.execute("commit")
+        self.conn.isolation_level = ""
+
+    def _agent_id(self):
+        # sequence numbers are only meaningful with this database, a new
+        # database is a new agent for the server
+        self.cursor.execute("select value from meta where key = 'agent_id'")
+        row = self.cursor.fetchone()
+        if row:
+            return row[0]
+        agent_id = uuid.uuid4().hex
+        self.cursor.execute(
+            "insert into meta(key, value) values ('agent_id', ?)",
+            (agent_id,))
+        return agent_id
+
+    def current_macs(self):
+        self.cursor.execute(
+            "select mac from session join device on device.id = "
+            "session.device where session.left is null")
+        return set([v[0] for v in self.cursor.fetchall()])
+
+    def record(self, joined, left):
+        now = int(time.time())
+        self.cursor.executemany(
+            "insert or ignore into device(mac) values (?)",
+            [(mac,) for mac in joined])
+        self.cursor.executemany(
+            "insert into session(device, joined) "
+            "select id, ? from device where mac = ?",
+            [(now, mac) for mac in joined])
+        self.cursor.executemany(
+            "update session set left = ? where left is null and "
+            "device = (select id from device where mac = ?)",
+            [(now, mac) for mac in left])
+        self.cursor.executemany(
+            "insert into outbox(timestamp, event, mac) values (?, ?, ?)",
+            [(now, "+", mac) for mac in sorted(joined)] +
+            [(now, "-", mac) for mac in sorted(left)])
+        self.conn.commit()
+
+    def pending(self, limit):
+        self.cursor.execute(
+            "select seq, timestamp, event, mac from outbox where acked = 0 "
+            "order by seq limit ?", (limit,))
+        return self.cursor.fetchall()
+
+    def ack(self, seq):
+        self.cursor.execute(
+            "update outbox set acked = 1 where acked = 0 and seq <= ?",
+            (seq,))
+        self.conn.commit()
+
+    def archive(self, before):
+        # moves the sessions closed before `before` to the archive database
+        # next to the store, in small transactions so polling isn't held up
+        self.cursor.execute("attach database ? as archive",
+                            (self.filename + ".archive",))
+        self.cursor.execute(
+            "create table if not exists archive.session "
+            "(mac TEXT, joined NUMERIC, left NUMERIC)")
+        archived = 0
+        while True:
+            self.cursor.execute(
+                "select id from session where left < ? limit ?",
+                (before, ARCHIVE_BATCH))
+            ids = [row[0] for row in self.cursor.fetchall()]
+            if not ids:
+                break
+            placeholders = ",".join(["?"] * len(ids))
+            self.cursor.execute(
+                "insert into archive.session(mac, joined, left) "
+                "select device.mac, session.joined, session.left "
+                "from session join device on device.id = session.device "
+                "where session.id in (%s) order by session.id"
+                % placeholders, ids)
+            self.cursor.execute(
+                "delete from session where id in (%s)" % placeholders, ids)
+            self.conn.commit()
+            archived += len(ids)
+        self.cursor.execute("delete from outbox where acked = 1")
+        self.conn.commit()
+        self.cursor.execute("detach database archive")
+        return archived
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+
+def poll(router, store, flusher, mac_set):
+    current_set = router.assoclist()
+    if current_set is None:
+        return mac_set
+    joined = current_set.difference(mac_set)
+    left = mac_set.difference(current_set)
+    for s in joined:
+        logging.info("NEW: " + s)
+    for s in left:
+        logging.info("GONE: " + s)
+    if joined or left:
+        store.record(joined, left)
+        flusher.notify()
+    return current_set
+
+
+def main(args):
+    password = file(args.password_filename).readlines()[0].strip()
+
+    logging.info("Opening local datastore " + args.sqlite_filename)
+    store = Store(args.sqlite_filename)
+    mac_set = store.current_macs()
+
+    logging.info("Syncing local datastore %s to server %s" % (
+        args.sqlite_filename, args.server))
+    flusher = Flusher(args.sqlite_filename, args.server, args.port)
+    flusher.start()
+
+    routers = []
+    for host in args.host:
+        port = args.router_port
+        if ':' in host:
+            (host, port) = host.split(':')
+        routers.append(Router(host, args.user, password, int(port)))
+    site = Site(routers)
+    logging.info("Fetching information from %s" % ", ".join(args.host))
+    site.start()
+    next_archive = 0
+    while True:
+        start = time.time()
+        try:
+            mac_set = poll(site, store, flusher, mac_set)
+            if args.retention_days and start >= next_archive:
+                archived = store.archive(
+                    start - args.retention_days * DAY_LENGTH)
+                logging.info("Archived %d sessions" % archived)
+                next_archive = start + ARCHIVE_INTERVAL
+        except Exception as e:
+            logging.error("Error recording information %s" % e)
+        if args.once:
+            break
+        time.sleep(max(0, POLL_INTERVAL - (time.time() - start)))
+
+    flusher.stop()
+    site.stop()
+    store.close()
+
 
+if __name__ == '__main__':
+    logging.info("Parsing arguments")
+    parser = argparse.ArgumentParser(description='Capture wifi data')
+    parser.add_argument(
+        '--sqlite_filename',
+        dest='sqlite_filename',
+        default='/opt/wifi/mac.dat')
+    parser.add_argument(
+        '--host',
+        dest='host',
+        nargs='+',
+        default=['192.168.1.1'],
+        help='one or more routers, as host or host:port')
+    parser.add_argument(
+        '--router_port',
+        dest='router_port',
+        default=23,
+        type=int)
+    parser.add_argument(
+        '--user',
+        dest='user',
+        default='root'
+        )
+    parser.add_argument(
+        '--password_filename',
+        dest='password_filename',
+        default='/opt/wifi/router.passwd'
+        )
+    parser.add_argument(
+        '--server',
+        dest='server',
+        default='wifi.xinchejian.com'
+        )
+    parser.add_argument(
+        '--port',
+        dest='port',
+        default=9000
+        )
+    parser.add_argument(
+        '--retention_days',
+        dest='retention_days',
+        default=30,
+        type=int,
+        help='days closed sessions stay in the datastore before being '
+             'moved to SQLITE_FILENAME.archive, 0 to keep them')
+    parser.add_argument(
+        '--once',
+        dest='once',
+        default=False
+        )
+    main(parser.parse_args())
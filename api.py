@@ -1,15 +1,43 @@
 #!/usr/bin/env python
-from apscheduler.scheduler import Scheduler
-from bottle import route, run, request, post, get, response, delete
+import sys
+
+# gevent has to patch the standard library before bottle, threading, socket
+# or redis are imported, the locks of module level objects included
+if __name__ == '__main__' and (
+        ('-server', 'gevent') in zip(sys.argv, sys.argv[1:]) or
+        ('-worker_class', 'gevent') in zip(sys.argv, sys.argv[1:]) or
+        '-server=gevent' in sys.argv or '-worker_class=gevent' in sys.argv):
+    from gevent import monkey
+    monkey.patch_all()
+
+from bottle import route, run, request, post, get, response, delete, abort
+from bottle import ServerAdapter, install, parse_date
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
 
 import argparse
+import binascii
+import bisect
 import datetime
+import email.utils
+import hashlib
+import itertools
 import json
 import logging
 import os
+import Queue
 import re
 import redis
+import socket
+import SocketServer
+import threading
 import time
+import uuid
+import zlib
+
+import config
+import metrics
+from oui import OuiIndex
+from scheduler import Scheduler
 
 SUBDIR = 'logs'
 
@@ -48,9 +76,360 @@ logger = getLogger(__file__)
 
 SEP = '|'
 SYSTEM_NAME = 'wifi'
+MINUTE_LENGTH = len('2013-05-18T19:42')
 HOUR_LENGTH = len('2013-05-18T19')
 DAY_LENGTH = len('2013-05-18')
-SCHED = Scheduler()
+SCHED = Scheduler(logger)
+METRICS = metrics.Registry()
+ROUTE_SECONDS = METRICS.histogram(
+    'wifi_http_request_seconds', 'Time spent handling requests, by route',
+    ['method', 'route'])
+DATA_SECONDS = METRICS.histogram(
+    'wifi_data_seconds', 'Time spent in WifiData methods', ['method'])
+JOB_SECONDS = METRICS.histogram(
+    'wifi_job_seconds', 'Time spent running scheduled jobs', ['job'])
+REDIS_COMMANDS = METRICS.counter(
+    'wifi_redis_commands_total', 'Redis commands sent, pipelined ones '
+    'included', ['command'])
+OPERATION_COMMANDS = METRICS.counter(
+    'wifi_operation_redis_commands_total', 'Redis commands sent during '
+    'each route or WifiData method, nested calls included', ['operation'])
+MAC_FIELDS = ['joined', 'count', 'oui', 'left', 'ip', 'hostname']
+# derived field -> field it is computed from
+DERIVED_FIELDS = {
+    'joined_iso8601': 'joined',
+    'left_iso8601': 'left',
+    'uptime': 'joined',
+}
+PAGE_SIZE = 500
+# largest page a request may ask for
+MAX_LIMIT = 10000
+JOIN_INTERVAL = 60*60
+MINUTE_RETENTION = 60*60*24*7
+MAX_BUCKETS = 60*24*31
+DAY_SECONDS = 60*60*24
+MAX_SESSION_DAYS = 31
+ROLLUP_RESOLUTIONS = {
+    'minute': ('%Y-%m-%dT%H:%M', datetime.timedelta(minutes=1)),
+    'hour': ('%Y-%m-%dT%H', datetime.timedelta(hours=1)),
+    'day': ('%Y-%m-%d', datetime.timedelta(days=1)),
+}
+
+# Number of MACs present (active and not excluded) and when it last
+# changed, kept up to date by every script changing either set
+PRESENT_FUNCTION = '''
+local function update_present(active, excluded, present, now)
+    local count = redis.call('SCARD', active) - redis.call('SCARD', excluded)
+    if tonumber(redis.call('HGET', present, 'count') or -1) ~= count then
+        redis.call('HMSET', present, 'count', count, 'changed', now)
+    end
+    return count
+end
+'''
+
+# Appends to the capped events stream, and publishes the entry on the
+# channel of the same name for /events
+EVENTS_MAXLEN = 100000
+EVENT_FUNCTION = '''
+local function append_event(stream, name, mac, now, ...)
+    local id = redis.call('XADD', stream, 'MAXLEN', '~', %d, '*',
+                          'event', name, 'mac', mac, 'time', now, ...)
+    redis.call('PUBLISH', stream,
+               id .. ' ' .. name .. ' ' .. mac .. ' ' .. now)
+end
+''' % EVENTS_MAXLEN
+
+# Sessions of a MAC, as 'start end' scored by end, in the sessions|<mac>
+# sorted set and in sessions-by-day|<day> as 'mac start end', for every
+# day since the epoch it spans; the open ones are in the session-open
+# hash. Their keys are made from the prefixes passed.
+SESSION_FUNCTION = '''
+local function open_session(open, mac, now)
+    redis.call('HSETNX', open, mac, now)
+end
+
+local function close_session(open, mac_prefix, day_prefix, mac, now)
+    local start = redis.call('HGET', open, mac)
+    if not start then
+        return
+    end
+    redis.call('HDEL', open, mac)
+    redis.call('ZADD', mac_prefix .. mac, now, start .. ' ' .. now)
+    for d = math.floor(tonumber(start) / 86400),
+            math.floor(tonumber(now) / 86400) do
+        redis.call('ZADD', day_prefix .. d, now,
+                   mac .. ' ' .. start .. ' ' .. now)
+    end
+end
+
+local function purge_sessions(open, mac_prefix, day_prefix, mac)
+    redis.call('HDEL', open, mac)
+    for _, session in ipairs(redis.call('ZRANGE', mac_prefix .. mac, 0, -1)) do
+        local start, finish = session:match('(%S+) (%S+)')
+        for d = math.floor(tonumber(start) / 86400),
+                math.floor(tonumber(finish) / 86400) do
+            redis.call('ZREM', day_prefix .. d, mac .. ' ' .. session)
+        end
+    end
+    redis.call('DEL', mac_prefix .. mac)
+end
+'''
+
+# Shared by the reconciliation and projection scripts below
+# KEYS: assoclist, active, count, join-by-timestamp, left-by-timestamp,
+#       excluded, minute, peak minute, hour, peak hour, day, peak day,
+#       weekday-hour, rejoined, present, events, session-open, sessions
+#       prefix, sessions-by-day prefix, excluded cutoff
+# ARGV: now, interval, minute, hour, day, weekday-hour, minute retention,
+#       join channel, left channel, ...
+ROLLUP_FUNCTION = '''
+local function rollup(joins)
+    if joins > 0 then
+        redis.call('HINCRBY', KEYS[7], ARGV[3], joins)
+        redis.call('HINCRBY', KEYS[9], ARGV[4], joins)
+        redis.call('HINCRBY', KEYS[11], ARGV[5], joins)
+        redis.call('HINCRBY', KEYS[13], ARGV[6], joins)
+    end
+    local present = update_present(KEYS[2], KEYS[6], KEYS[15], ARGV[1])
+    for i = 0, 2 do
+        local key = KEYS[8 + 2 * i]
+        local peak = tonumber(redis.call('HGET', key, ARGV[3 + i]) or 0)
+        if present > peak then
+            redis.call('HSET', key, ARGV[3 + i], present)
+        end
+    end
+    redis.call('EXPIRE', KEYS[7], ARGV[7])
+    redis.call('EXPIRE', KEYS[8], ARGV[7])
+end
+'''
+
+# KEYS: active, excluded, present
+# ARGV: now
+PRESENT_SCRIPT = PRESENT_FUNCTION + '''
+return update_present(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+'''
+
+# Shared by the reconciliation scripts below, KEYS and ARGV as above
+RECONCILE_SCRIPT = PRESENT_FUNCTION + EVENT_FUNCTION + SESSION_FUNCTION + \
+    ROLLUP_FUNCTION + '''
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local excluded_cutoff = tonumber(redis.call('GET', KEYS[20]) or 0)
+
+local function join(mac)
+    redis.call('SADD', KEYS[2], mac)
+    redis.call('HINCRBY', KEYS[3], mac, 1)
+    -- only change last join timestamp if the MAC has been away long enough
+    local last_left = tonumber(redis.call('ZSCORE', KEYS[5], mac) or 0)
+    local fresh = 0
+    if now - last_left > interval then
+        redis.call('ZADD', KEYS[4], ARGV[1], mac)
+        redis.call('PUBLISH', ARGV[8], mac)
+        fresh = 1
+    end
+    -- an old join timestamp, kept or replayed from before the last run of
+    -- EXCLUDE_SCRIPT, is outside the range its next run looks at
+    if fresh == 0 or now <= excluded_cutoff then
+        redis.call('SADD', KEYS[14], mac)
+    end
+    append_event(KEYS[16], 'join', mac, ARGV[1], 'fresh', fresh)
+    open_session(KEYS[17], mac, ARGV[1])
+    if redis.call('SISMEMBER', KEYS[6], mac) == 0 then
+        return 1
+    end
+    return 0
+end
+
+local function leave(mac)
+    redis.call('SREM', KEYS[2], mac)
+    redis.call('ZADD', KEYS[5], ARGV[1], mac)
+    redis.call('SREM', KEYS[6], mac)
+    redis.call('PUBLISH', ARGV[9], mac)
+    append_event(KEYS[16], 'left', mac, ARGV[1])
+    close_session(KEYS[17], KEYS[18], KEYS[19], mac, ARGV[1])
+end
+'''
+
+# Reconcile the active set with a new assoclist in one atomic call
+# ARGV: ..., mac...
+BULK_SCRIPT = RECONCILE_SCRIPT + '''
+redis.call('DEL', KEYS[1])
+for i = 10, #ARGV, 500 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 499, #ARGV)))
+end
+local joined = redis.call('SDIFF', KEYS[1], KEYS[2])
+local left = redis.call('SDIFF', KEYS[2], KEYS[1])
+local joins = 0
+for _, mac in ipairs(joined) do
+    joins = joins + join(mac)
+end
+for _, mac in ipairs(left) do
+    leave(mac)
+end
+rollup(joins)
+return {joined, left}
+'''
+
+# Apply joined and left MACs. With the last sequence applied of an agent,
+# each MAC comes with the sequence of its event: those at or below it are
+# replays and skipped, and it is raised to the highest one.
+# KEYS: ..., [agent sequence]
+# ARGV: ..., number of joined macs, joined mac..., left mac...,
+#       [sequence of each mac...]
+DELTA_SCRIPT = RECONCILE_SCRIPT + '''
+local count = tonumber(ARGV[10])
+local macs = #ARGV - 10
+local applied = nil
+if KEYS[21] then
+    macs = macs / 2
+    applied = tonumber(redis.call('GET', KEYS[21]) or 0)
+end
+local function replayed(i)
+    return applied and tonumber(ARGV[i + macs]) <= applied
+end
+local joined = {}
+local left = {}
+local joins = 0
+for i = 11, 10 + count do
+    local mac = ARGV[i]
+    if not replayed(i) and redis.call('SISMEMBER', KEYS[2], mac) == 0 then
+        joins = joins + join(mac)
+        redis.call('SADD', KEYS[1], mac)
+        table.insert(joined, mac)
+    end
+end
+for i = 11 + count, 10 + macs do
+    local mac = ARGV[i]
+    if not replayed(i) and redis.call('SISMEMBER', KEYS[2], mac) == 1 then
+        leave(mac)
+        redis.call('SREM', KEYS[1], mac)
+        table.insert(left, mac)
+    end
+end
+if applied then
+    for i = 11 + macs, #ARGV do
+        applied = math.max(applied, tonumber(ARGV[i]))
+    end
+    redis.call('SET', KEYS[21], applied)
+end
+rollup(joins)
+return {joined, left}
+'''
+
+# Apply events of the log recorded at the same time, without logging them
+# again
+# ARGV: ..., (event, mac, fresh)...
+PROJECT_SCRIPT = PRESENT_FUNCTION + SESSION_FUNCTION + ROLLUP_FUNCTION + '''
+local joins = 0
+local changed = false
+for i = 10, #ARGV, 3 do
+    local event = ARGV[i]
+    local mac = ARGV[i + 1]
+    if event == 'join' then
+        redis.call('SADD', KEYS[2], mac)
+        redis.call('HINCRBY', KEYS[3], mac, 1)
+        if ARGV[i + 2] == '1' then
+            redis.call('ZADD', KEYS[4], ARGV[1], mac)
+        end
+        if redis.call('SISMEMBER', KEYS[6], mac) == 0 then
+            joins = joins + 1
+        end
+        open_session(KEYS[17], mac, ARGV[1])
+        changed = true
+    elseif event == 'left' then
+        redis.call('SREM', KEYS[2], mac)
+        redis.call('ZADD', KEYS[5], ARGV[1], mac)
+        redis.call('SREM', KEYS[6], mac)
+        close_session(KEYS[17], KEYS[18], KEYS[19], mac, ARGV[1])
+        changed = true
+    elseif event == 'exclude' then
+        redis.call('SADD', KEYS[6], mac)
+    elseif event == 'purge' then
+        redis.call('HDEL', KEYS[3], mac)
+        redis.call('SREM', KEYS[2], mac)
+        redis.call('SREM', KEYS[6], mac)
+        redis.call('ZREM', KEYS[4], mac)
+        redis.call('ZREM', KEYS[5], mac)
+        purge_sessions(KEYS[17], KEYS[18], KEYS[19], mac)
+    end
+end
+-- peaks are only taken by reconciliations, as when the events were logged
+if changed then
+    rollup(joins)
+else
+    update_present(KEYS[2], KEYS[6], KEYS[15], ARGV[1])
+end
+'''
+
+# Forget a MAC, logged as a purge event
+# KEYS: count, active, excluded, join-by-timestamp, left-by-timestamp, ip,
+#       hostname, present, events, session-open, sessions prefix,
+#       sessions-by-day prefix
+# ARGV: mac, now
+PURGE_SCRIPT = PRESENT_FUNCTION + EVENT_FUNCTION + SESSION_FUNCTION + '''
+local mac = ARGV[1]
+redis.call('HDEL', KEYS[1], mac)
+redis.call('SREM', KEYS[2], mac)
+redis.call('SREM', KEYS[3], mac)
+redis.call('ZREM', KEYS[4], mac)
+redis.call('ZREM', KEYS[5], mac)
+redis.call('HDEL', KEYS[6], mac)
+redis.call('HDEL', KEYS[7], mac)
+purge_sessions(KEYS[10], KEYS[11], KEYS[12], mac)
+update_present(KEYS[2], KEYS[3], KEYS[8], ARGV[2])
+append_event(KEYS[9], 'purge', mac, ARGV[2])
+'''
+
+# Exclude MACs that have been present since before the cutoff. Only the
+# join timestamps between the previous cutoff and this one are looked at,
+# plus MACs that rejoined with an older join timestamp since the last run.
+# KEYS: join-by-timestamp, active, excluded, rejoined, previous cutoff,
+#       present, events
+# ARGV: cutoff, exclude channel, now
+EXCLUDE_SCRIPT = PRESENT_FUNCTION + EVENT_FUNCTION + '''
+local cutoff = tonumber(ARGV[1])
+local previous = redis.call('GET', KEYS[5]) or '-inf'
+local candidates = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '(' .. previous, cutoff)
+for _, mac in ipairs(redis.call('SMEMBERS', KEYS[4])) do
+    table.insert(candidates, mac)
+end
+local excluded = {}
+for _, mac in ipairs(candidates) do
+    local joined = tonumber(redis.call('ZSCORE', KEYS[1], mac) or cutoff + 1)
+    if joined <= cutoff and redis.call('SISMEMBER', KEYS[2], mac) == 1 then
+        if redis.call('SADD', KEYS[3], mac) == 1 then
+            redis.call('PUBLISH', ARGV[2], mac)
+            append_event(KEYS[7], 'exclude', mac, ARGV[3])
+            table.insert(excluded, mac)
+        end
+    end
+end
+redis.call('DEL', KEYS[4])
+redis.call('SET', KEYS[5], ARGV[1])
+update_present(KEYS[2], KEYS[3], KEYS[6], ARGV[3])
+return excluded
+'''
+
+# the scheduler runs in the one process holding this lock
+# KEYS: lock
+# ARGV: holder, ttl
+LEADER_SCRIPT = '''
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return 0
+end
+redis.call('SETEX', KEYS[1], ARGV[2], ARGV[1])
+return 1
+'''
+LEADER_TTL = 30
+# seconds clients may reuse the status badge and count
+MAX_AGE = 10
+# events buffered for each /events client before it is dropped
+CLIENT_QUEUE = 1000
+# False with gunicorn sync workers, an /events stream would hold one
+STREAMING = True
+EVENTS_KEEPALIVE = 15
 
 
 def join_args(*arg):
@@ -61,15 +440,17 @@ def prefix(*arg):
     return join_args([SYSTEM_NAME, SEP.join(list(arg))])
 
 
-def client(config=None):
-    #logger.debug(dir(redis))
-    if config and 'redis' in config:
-        redis_config = config['redis']
-        logger.debug('Using alternate Redis config %s' % (redis_config))
-        return redis.Redis(
-            host=redis_config['host'],
-            port=int(redis_config['port']))
-    return redis.Redis()
+def client(settings=None, max_connections=None):
+    # shared by the request handlers and the scheduler, callers wait for a
+    # free connection instead of opening more, the commands sent are counted
+    if settings is None:
+        settings = config.load()
+    if max_connections is not None:
+        settings = dict(settings, max_connections=max_connections)
+    logger.debug('Redis %s' % dict(
+        (k, v) for (k, v) in settings.iteritems() if k != 'password'))
+    return metrics.Redis(REDIS_COMMANDS, OPERATION_COMMANDS,
+                         connection_pool=config.pool(settings))
 
 
 def get_file_content(filename):
@@ -94,6 +475,27 @@ def day(unix):
     return unix_to_iso8601(unix)[0:DAY_LENGTH]
 
 
+def minute(unix):
+    return unix_to_iso8601(unix)[0:MINUTE_LENGTH]
+
+
+def weekday_hour(unix):
+    d = datetime.datetime.fromtimestamp(unix)
+    return '%02d%02d' % (d.weekday(), d.hour)
+
+
+def bucket_range(resolution, start, end):
+    (fmt, step) = ROLLUP_RESOLUTIONS[resolution]
+    last = datetime.datetime.fromtimestamp(end).strftime(fmt)
+    current = datetime.datetime.strptime(
+        datetime.datetime.fromtimestamp(start).strftime(fmt), fmt)
+    buckets = []
+    while current.strftime(fmt) <= last and len(buckets) <= MAX_BUCKETS:
+        buckets.append(current.strftime(fmt))
+        current += step
+    return buckets
+
+
 def safe_float(s):
         if s:
             return float(s)
@@ -101,9 +503,259 @@ def safe_float(s):
             return 0.0
 
 
+FIELD_PARSERS = {
+    'joined': float,
+    'count': int,
+    'left': safe_float,
+}
+
+
+def projection(fields):
+    if fields is None:
+        return (MAC_FIELDS, None)
+    unknown = set(fields) - set(MAC_FIELDS) - set(DERIVED_FIELDS)
+    if unknown:
+        raise ValueError('Unknown fields %s' % ','.join(sorted(unknown)))
+    needed = set(fields)
+    needed.update([DERIVED_FIELDS[f] for f in fields if f in DERIVED_FIELDS])
+    return ([f for f in MAC_FIELDS if f in needed], fields)
+
+
+def paginate(macs_list, offset, limit, after=None):
+    # a page of the sorted macs_list starts at offset, or right after the
+    # member after, the last member of a page is the cursor to the next one
+    if after is not None:
+        offset = bisect.bisect_right(macs_list, after)
+    if limit is None:
+        return (macs_list[offset:], None)
+    page = macs_list[offset:offset + limit]
+    if len(macs_list) > offset + limit:
+        return (page, page[-1])
+    return (page, None)
+
+
+class Leader():
+    def __init__(self, client, key, ttl=LEADER_TTL):
+        self.r = client
+        self.key = key
+        self.ttl = ttl
+        # renewed well before it expires
+        self.interval = ttl / 3.0
+        self.pid = None
+        self.script = self.r.register_script(LEADER_SCRIPT)
+
+    def acquire(self):
+        # a process forked after this was created, e.g. a gunicorn worker,
+        # is another holder
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.holder = '%s:%d:%s' % (
+                socket.gethostname(), self.pid, uuid.uuid4().hex)
+        return self.script(keys=[self.key], args=[self.holder, self.ttl]) == 1
+
+
+class ThreadedServer(ServerAdapter):
+    # wsgiref with a thread per request, so the status badge doesn't wait
+    # behind slow /MAC requests
+    def run(self, handler):
+        class Server(SocketServer.ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        handler_class = WSGIRequestHandler
+        if self.quiet:
+            class QuietHandler(WSGIRequestHandler):
+                def log_request(*args, **kw):
+                    pass
+            handler_class = QuietHandler
+        make_server(self.host, self.port, handler, Server,
+                    handler_class).serve_forever()
+
+
+class TextMacs():
+    # MACs are stored as their uppercase 17 character form
+    name = 'text'
+
+    def encode(self, mac):
+        if len(mac) == 6:
+            return BINARY.decode(mac)
+        return mac.upper()
+
+    def decode(self, mac):
+        return self.encode(mac)
+
+
+class BinaryMacs():
+    # MACs are stored as their 6 bytes, in the order of the text form
+    name = 'binary'
+
+    def encode(self, mac):
+        if len(mac) == 6:
+            return mac
+        try:
+            return binascii.unhexlify(mac.replace(':', ''))
+        except TypeError:
+            raise ValueError('Invalid MAC %s' % mac)
+
+    def decode(self, mac):
+        if len(mac) != 6:
+            return mac.upper()
+        h = binascii.hexlify(mac).upper()
+        return ':'.join([h[i:i + 2] for i in range(0, 12, 2)])
+
+
+TEXT = TextMacs()
+BINARY = BinaryMacs()
+MAC_FORMATS = dict((f.name, f) for f in (TEXT, BINARY))
+
+
+class Cached():
+    # Remembers what func returns for ttl seconds
+    def __init__(self, func, ttl):
+        self.func = func
+        self.ttl = ttl
+        self.value = None
+        self.expires = 0
+
+    def __call__(self):
+        now = time.time()
+        if now >= self.expires:
+            self.value = self.func()
+            self.expires = now + self.ttl
+        return self.value
+
+
+class EventHub():
+    # One subscription to the events channel per process, fanned out to
+    # every /events client. A client that falls CLIENT_QUEUE events behind
+    # gets None and should resume from the stream.
+    def __init__(self, client, stream, mac_format=TEXT):
+        self.r = client
+        # the subscription waits for messages as long as there are none,
+        # without the socket_timeout of the other commands
+        pool = client.connection_pool
+        self.subscriber = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=pool.connection_class,
+            **dict(pool.connection_kwargs, socket_timeout=None)))
+        self.stream = stream
+        self.mac_format = mac_format
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_id = None
+
+    def subscribe(self):
+        queue = Queue.Queue(CLIENT_QUEUE)
+        with self.lock:
+            # started on demand, after the fork of multi-process servers
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.clients.discard(queue)
+
+    def range(self, start, count=PAGE_SIZE):
+        # events from start (included) on, oldest first
+        return [self._decode(event) for event in parse_entries(
+            self.r.execute_command(
+                'XRANGE', self.stream, start, '+', 'COUNT', count))]
+
+    def dispatch(self, event):
+        if stream_id(event[0]) <= stream_id(self.last_id):
+            return
+        self.last_id = event[0]
+        with self.lock:
+            clients = list(self.clients)
+        for queue in clients:
+            try:
+                queue.put_nowait(event)
+            except Queue.Full:
+                self.unsubscribe(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def run(self):
+        while True:
+            pubsub = self.subscriber.pubsub()
+            try:
+                if self.last_id is None:
+                    # the latest event before subscribing, the ones after it
+                    # are read from the stream once subscribed
+                    latest = self.r.execute_command(
+                        'XREVRANGE', self.stream, '+', '-', 'COUNT', 1)
+                    self.last_id = latest[0][0] if latest else '0-0'
+                pubsub.subscribe(self.stream)
+                # what was published while disconnected
+                for event in self.range(self.last_id):
+                    self.dispatch(event)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        # a binary MAC may contain spaces
+                        (id, name, rest) = message['data'].split(' ', 2)
+                        (mac, t) = rest.rsplit(' ', 1)
+                        self.dispatch(
+                            self._decode((id, name, mac, float(t), None)))
+            except redis.ConnectionError as e:
+                logger.warning('Events subscription lost: %s' % e)
+                time.sleep(1)
+            except redis.RedisError as e:
+                logger.error('Events subscription failed: %s' % e)
+                time.sleep(1)
+            finally:
+                pubsub.reset()
+
+    def _decode(self, event):
+        (id, name, mac, t, fresh) = event
+        return (id, name, self.mac_format.decode(mac), t, fresh)
+
+
+class LeaseWatcher():
+    def __init__(self, data, filename=None):
+        self.data = data
+        self.filename = filename
+        self.stat = None
+        self.digest = None
+        self.leases = {}
+
+    def poll(self):
+        st = os.stat(self.filename)
+        stat = (st.st_ino, st.st_mtime, st.st_size)
+        if stat == self.stat:
+            return {}
+        changed = self.update(file(self.filename).read())
+        self.stat = stat
+        return changed
+
+    def update(self, content):
+        digest = hashlib.sha1(content).digest()
+        if digest == self.digest:
+            return {}
+        leases = {}
+        for (mac, ip, hostname) in parse_leases(content):
+            leases[mac.upper()] = (ip, hostname)
+        # only write what changed since the previous content, leases that
+        # went away keep their last known ip and hostname
+        changed = {}
+        for (mac, lease) in leases.iteritems():
+            if self.leases.get(mac) != lease:
+                changed[mac] = lease
+        self.data.add_leases(changed)
+        self.leases = leases
+        self.digest = digest
+        return changed
+
+
 class WifiData():
-    def __init__(self, client):
+    def __init__(self, client, oui=None):
         self.r = client
+        # in-process OuiIndex, the Redis 'oui' hash is used without one
+        self.oui = oui
         self.assoclist_mac_set = prefix('assoclist')
         self.active_mac_set = prefix('active')
         self.mac_to_count_hash = prefix('count')
@@ -116,16 +768,54 @@ class WifiData():
         self.join_mac_by_timestamp_z = prefix('join-by-timestamp')
 
         self.excluded_mac_set = prefix('excluded')
+        self.rejoined_mac_set = prefix('rejoined')
+        self.excluded_cutoff_key = prefix('excluded-cutoff')
+        self.present_hash = prefix('present')
+        self.events_stream = prefix('events')
+        self.session_open_hash = prefix('session-open')
+        self.sessions_prefix = prefix('sessions', '')
+        self.sessions_by_day_prefix = prefix('sessions-by-day', '')
         self.hour_set = prefix('hour')
+        self.day_set = prefix('day')
+        self.weekday_hour_set = prefix('weekday-hour')
+        self.peak_hour_set = prefix('peak', 'hour')
+        self.peak_day_set = prefix('peak', 'day')
         self.oui_to_manufacturer_hash = 'oui'
+        # how MACs are stored, set by migrate.py mac_format
+        self.mac_format_key = prefix('mac-format')
+        self.mac_format = MAC_FORMATS[
+            self.r.get(self.mac_format_key) or TEXT.name]
         self.started = time.time()
+        self.bulk_script = self.r.register_script(BULK_SCRIPT)
+        self.delta_script = self.r.register_script(DELTA_SCRIPT)
+        self.exclude_script = self.r.register_script(EXCLUDE_SCRIPT)
+        self.present_script = self.r.register_script(PRESENT_SCRIPT)
+        self.project_script = self.r.register_script(PROJECT_SCRIPT)
+        self.purge_script = self.r.register_script(PURGE_SCRIPT)
 
     def add_ip(self, mac, ip):
-        self.r.hset(self.mac_to_ip_hash, mac, ip)
+        self.r.hset(self.mac_to_ip_hash, self.mac_format.encode(mac), ip)
 
     def add_hostname(self, mac, hostname):
-        self.r.hset(self.mac_to_hostname_hash, mac, hostname)
+        self.r.hset(self.mac_to_hostname_hash, self.mac_format.encode(mac),
+                    hostname)
+
+    @metrics.timed(DATA_SECONDS)
+    def add_leases(self, leases):
+        if not leases:
+            return
+        ips = {}
+        hostnames = {}
+        for (mac, (ip, hostname)) in leases.iteritems():
+            mac = self.mac_format.encode(mac)
+            ips[mac] = ip
+            hostnames[mac] = hostname
+        m = self.r.pipeline()
+        m.hmset(self.mac_to_ip_hash, ips)
+        m.hmset(self.mac_to_hostname_hash, hostnames)
+        m.execute()
 
+    @metrics.timed(DATA_SECONDS)
     def agent(self):
         last = self._last()
         agent = {
@@ -143,157 +833,506 @@ class WifiData():
         }
         return result
 
+    @metrics.timed(DATA_SECONDS)
     def ping(self):
         m = self.r.pipeline()
         m.set(self.last_timestamp_key, time.time())
         m.incr(self.ping_counter_key)
         return m.execute()
 
-    def bulk(self, macs):
-        m = self.r.pipeline()
-        m.delete(self.assoclist_mac_set)
-        m.sadd(self.assoclist_mac_set, *macs)
-        m.execute()
-        m.sdiff(self.assoclist_mac_set, self.active_mac_set)
-        m.sdiff(self.active_mac_set, self.assoclist_mac_set)
-        results = m.execute()
+    @metrics.timed(DATA_SECONDS)
+    def bulk(self, macs, interval=JOIN_INTERVAL):
+        macs = self._encode(macs)
+        now = time.time()
+        result = self.bulk_script(
+            keys=self._reconcile_keys(now),
+            args=self._reconcile_args(now, interval) + macs)
+        (joined_macs, left_macs) = [self._decode(macs) for macs in result]
 
-        joined_macs = results[0]
-        left_macs = results[1]
         for mac in joined_macs:
             logger.info('Joining %s' % mac)
-            self.join(mac)
         for mac in left_macs:
             logger.info('Leaving %s' % mac)
-            self.left(mac)
         return (joined_macs, left_macs)
 
-    def join(self, mac, interval=60*60):
-        mac = mac.upper()
-        if self.r.sismember(self.active_mac_set, mac):
-            return False
-        now = time.time()
-
-        m = self.r.pipeline()
-        m.sadd(self.active_mac_set, mac)
-        m.hincrby(self.mac_to_count_hash, mac, 1)
-        # only change last join timestamp if the MAC has been away long enough
-        if not self._is_recently_active(mac, now, interval):
-            m.zadd(self.join_mac_by_timestamp_z, mac, now)
-            self.r.publish(prefix('join'), mac)
-        if not self.r.sismember(self.excluded_mac_set, mac):
-            m.hincrby(self.hour_set, hour(now), 1)
-        m.execute()
-
-        return True
+    @metrics.timed(DATA_SECONDS)
+    def delta(self, joined_macs, left_macs, interval=JOIN_INTERVAL,
+              now=None):
+        return self._delta(joined_macs, left_macs, interval, now)
+
+    def _delta(self, joined_macs, left_macs, interval=JOIN_INTERVAL,
+               now=None, seq_key=None, seqs=()):
+        joined_macs = self._encode(joined_macs)
+        left_macs = self._encode(left_macs)
+        if now is None:
+            now = time.time()
+        keys = self._reconcile_keys(now)
+        if seq_key is not None:
+            keys.append(seq_key)
+        args = self._reconcile_args(now, interval) + [len(joined_macs)]
+        result = self.delta_script(
+            keys=keys, args=args + joined_macs + left_macs + list(seqs))
+        return [self._decode(macs) for macs in result]
+
+    @metrics.timed(DATA_SECONDS)
+    def apply_events(self, agent, events):
+        # events are (seq, timestamp, op, mac) from an agent outbox, the ones
+        # at or below the last sequence applied for that agent are replays.
+        # The script applying a group checks and raises the sequence, a batch
+        # sent twice at once is applied once.
+        seq_key = prefix('agent-seq', agent)
+        last = int(self.r.get(seq_key) or 0)
+        events = [event for event in events if event[0] > last]
+        joined = []
+        left = []
+        for (timestamp, group) in group_events(events):
+            joins = [(seq, mac) for (seq, t, op, mac) in group if op == '+']
+            leaves = [(seq, mac) for (seq, t, op, mac) in group if op == '-']
+            (j, l) = self._delta(
+                [mac for (seq, mac) in joins], [mac for (seq, mac) in leaves],
+                now=timestamp, seq_key=seq_key,
+                seqs=[seq for (seq, mac) in joins + leaves])
+            joined.extend(j)
+            left.extend(l)
+        if events:
+            last = max([event[0] for event in events])
+        return (last, joined, left)
+
+    def join(self, mac, interval=JOIN_INTERVAL):
+        (joined, left) = self.delta([mac], [], interval)
+        return len(joined) > 0
 
     def left(self, mac):
-        mac = mac.upper()
-        if not self.r.sismember(self.active_mac_set, mac):
-            # not joined...
-            return False
-        m = self.r.pipeline()
-        m.srem(self.active_mac_set, mac)
-        m.zadd(self.left_mac_by_timestamp_z, mac, time.time())
-        m.srem(self.excluded_mac_set, mac)
-        m.execute()
-        self.r.publish(prefix('left'), mac)
-        return True
+        (joined, left) = self.delta([], [mac])
+        return len(left) > 0
 
+    @metrics.timed(DATA_SECONDS)
     def purge(self, mac):
-        mac = mac.upper()
-        m = self.r.pipeline()
-        m.hdel(self.mac_to_count_hash, mac)
-        m.srem(self.active_mac_set, mac)
-        m.srem(self.excluded_mac_set, mac)
-        m.zrem(self.join_mac_by_timestamp_z, mac)
-        m.zrem(self.left_mac_by_timestamp_z, mac)
-        m.hdel(self.mac_to_ip_hash, mac)
-        m.hdel(self.mac_to_hostname_hash, mac)
-        return m.execute()
+        keys = [
+            self.mac_to_count_hash,
+            self.active_mac_set,
+            self.excluded_mac_set,
+            self.join_mac_by_timestamp_z,
+            self.left_mac_by_timestamp_z,
+            self.mac_to_ip_hash,
+            self.mac_to_hostname_hash,
+            self.present_hash,
+            self.events_stream,
+            self.session_open_hash,
+            self.sessions_prefix,
+            self.sessions_by_day_prefix]
+        return self.purge_script(
+            keys=keys, args=[self.mac_format.encode(mac), repr(time.time())])
+
+    @metrics.timed(DATA_SECONDS)
+    def project(self, events, final=True):
+        # applies (id, event, mac, time, fresh) events of the log, events of
+        # one reconciliation share their time. Unless final, the last of
+        # them may continue in the next batch: they are returned instead.
+        groups = [list(group) for (t, group)
+                  in itertools.groupby(events, lambda e: e[3])]
+        held = []
+        if not final and groups:
+            held = groups.pop()
+        m = self.r.pipeline(transaction=False)
+        for group in groups:
+            t = group[0][3]
+            args = []
+            for (id, name, mac, t, fresh) in group:
+                # joins logged before the fresh flag set the join time, the
+                # log may predate a change of MAC format
+                args.extend([name, self.mac_format.encode(mac),
+                             '1' if fresh is None else fresh])
+            self.project_script(
+                keys=self._reconcile_keys(t),
+                args=self._reconcile_args(t, JOIN_INTERVAL) + args,
+                client=m)
+        m.execute()
+        return held
 
+    @metrics.timed(DATA_SECONDS)
     def count(self):
-        return len(self._active())
-
-    def macs(self):
-        active = self._active()
-        macs = self._macs_info(active)
-        result = {
-            "mac": macs
-        }
-
-        return result
-
-    def query(self, start, end):
-        results = self.r.zrangebyscore(
+        return self.present()[0]
+
+    @metrics.timed(DATA_SECONDS)
+    def present(self):
+        # (number of MACs present, when it last changed)
+        (count, changed) = self.r.hmget(self.present_hash, 'count', 'changed')
+        if count is None:
+            self._update_present()
+            (count, changed) = self.r.hmget(
+                self.present_hash, 'count', 'changed')
+        return (int(count), float(changed))
+
+    @metrics.timed(DATA_SECONDS)
+    def macs(self, offset=0, limit=None, fields=None, after=None):
+        active = sorted(self._active())
+        return self._page_info(active, offset, limit, fields, after)
+
+    @metrics.timed(DATA_SECONDS)
+    def query(self, start, end, offset=0, limit=None, fields=None,
+              after=None):
+        # after is the "score,MAC" next of the previous page
+        if limit is None and after is None:
+            results = self.r.zrangebyscore(
+                self.join_mac_by_timestamp_z,
+                start, end)
+            return self._page_info(results, offset, limit, fields)
+        if limit is None:
+            limit = MAX_LIMIT
+        # one more than the limit to know if there is a next page
+        if after is None:
+            results = self.r.zrangebyscore(
+                self.join_mac_by_timestamp_z,
+                start, end, start=offset, num=limit + 1, withscores=True)
+        else:
+            results = self._query_range(
+                start, end, self._query_cursor(after), limit + 1)
+        next_cursor = None
+        if len(results) > limit:
+            (member, score) = results[limit - 1]
+            next_cursor = '%r,%s' % (score, self.mac_format.decode(member))
+        macs = self._macs_info(
+            [member for (member, score) in results[:limit]], fields)
+        return self._result(macs, limit, next_cursor)
+
+    @metrics.timed(DATA_SECONDS)
+    def excluded(self, offset=0, limit=None, fields=None, after=None):
+        excluded = sorted(self._excluded())
+        return self._page_info(excluded, offset, limit, fields, after)
+
+    def iter_macs(self, fields=None):
+        pages = self._pages(sorted(self._active()))
+        return self._iter_macs_info(pages, fields)
+
+    def iter_query(self, start, end, fields=None, page_size=PAGE_SIZE):
+        pages = self._query_pages(start, end, page_size)
+        return self._iter_macs_info(pages, fields)
+
+    def iter_excluded(self, fields=None):
+        pages = self._pages(sorted(self._excluded()))
+        return self._iter_macs_info(pages, fields)
+
+    @metrics.timed(DATA_SECONDS)
+    def update_excluded(self, max_uptime=60*60*8):
+        # int(uptime) > max_uptime
+        cutoff = time.time() - max_uptime - 1
+        keys = [
             self.join_mac_by_timestamp_z,
-            start, end)
-        macs = self._macs_info(results)
+            self.active_mac_set,
+            self.excluded_mac_set,
+            self.rejoined_mac_set,
+            self.excluded_cutoff_key,
+            self.present_hash,
+            self.events_stream]
+        return self._decode(self.exclude_script(
+            keys=keys,
+            args=[repr(cutoff), prefix('exclude'), repr(time.time())]))
+
+    @metrics.timed(DATA_SECONDS)
+    def rollup(self, resolution, start, end):
+        buckets = bucket_range(resolution, start, end)
+        if len(buckets) > MAX_BUCKETS:
+            raise ValueError('Too many buckets, max %s' % MAX_BUCKETS)
+        m = self.r.pipeline()
+        if resolution == 'minute':
+            days = {}
+            for bucket in buckets:
+                days.setdefault(bucket[0:DAY_LENGTH], []).append(bucket)
+            for (d, fields) in sorted(days.iteritems()):
+                m.hmget(self._minute_set(d), fields)
+                m.hmget(self._peak_minute_set(d), fields)
+        elif resolution == 'hour':
+            m.hmget(self.hour_set, buckets)
+            m.hmget(self.peak_hour_set, buckets)
+        else:
+            m.hmget(self.day_set, buckets)
+            m.hmget(self.peak_day_set, buckets)
+        results = m.execute()
+        joins = []
+        peaks = []
+        for i in range(0, len(results), 2):
+            joins.extend(results[i])
+            peaks.extend(results[i + 1])
+        rollup = []
+        for (bucket, joined, peak) in zip(buckets, joins, peaks):
+            rollup.append({
+                'bucket': bucket,
+                'joins': int(joined or 0),
+                'peak': int(peak or 0),
+            })
         result = {
-            "mac": macs
+            "rollup": rollup
         }
-
         return result
 
-    def excluded(self):
-        excluded = self._excluded()
-        excluded = self._macs_info(excluded)
+    @metrics.timed(DATA_SECONDS)
+    def weekday_hour(self):
+        histogram = [[0] * 24 for i in range(7)]
+        counts = self.r.hgetall(self.weekday_hour_set)
+        for (field, joined) in counts.iteritems():
+            histogram[int(field[0:2])][int(field[2:4])] = int(joined)
         result = {
-            "mac": excluded
+            "weekday_hour": histogram
         }
-
         return result
 
-    def update_excluded(self, max_uptime=60*60*8):
-        excluded = []
-        for (mac_id, mac_info) in self.macs()['mac'].iteritems():
-            if mac_info['uptime'] > max_uptime:
-                self.r.sadd(self.excluded_mac_set, mac_id)
-                self.r.publish(prefix('exclude'), mac_id)
-                excluded.append(mac_id)
-        return excluded
-
-    def _is_recently_active(self, mac, now, interval):
-        last_join = safe_float(self.r.zscore(
-            self.left_mac_by_timestamp_z, mac))
-        if (now - last_join) > interval:
-            return False
-        return True
-
-    def _macs_info(self, macs_list):
-        macs = {}
+    @metrics.timed(DATA_SECONDS)
+    def sessions(self, mac, start=0, end=None):
+        # (start, end) of the sessions of mac overlapping start-end, end is
+        # None for the open session
+        mac = self.mac_format.encode(mac)
+        m = self.r.pipeline()
+        m.zrangebyscore(self.sessions_prefix + mac, '(%r' % start, '+inf')
+        m.hget(self.session_open_hash, mac)
+        (closed, opened) = m.execute()
+        sessions = []
+        for session in closed:
+            (s, e) = [float(v) for v in session.split(' ')]
+            # sessions of a MAC don't overlap, ordered by end is by start
+            if end is not None and s >= end:
+                break
+            sessions.append((s, e))
+        if opened is not None and (end is None or float(opened) < end):
+            sessions.append((float(opened), None))
+        return sessions
+
+    @metrics.timed(DATA_SECONDS)
+    def dwell(self, mac, start, end):
+        now = time.time()
+        sessions = self.sessions(mac, start, end)
+        total = 0
+        for (s, e) in sessions:
+            e = now if e is None else e
+            total += max(0, min(e, end) - max(s, start))
+        return (total, len(sessions))
+
+    @metrics.timed(DATA_SECONDS)
+    def present_at(self, t):
+        m = self.r.pipeline()
+        m.zrangebyscore(self._sessions_by_day(t), '(%r' % t, '+inf')
+        m.hgetall(self.session_open_hash)
+        (closed, opened) = m.execute()
+        macs = set()
+        for session in closed:
+            (mac, s, e) = session.rsplit(' ', 2)
+            if float(s) <= t:
+                macs.add(mac)
+        if t <= time.time():
+            for (mac, s) in opened.iteritems():
+                if float(s) <= t:
+                    macs.add(mac)
+        return sorted(self._decode(macs))
+
+    @metrics.timed(DATA_SECONDS)
+    def overlapping(self, start, end):
+        # (mac, start, end) of every session overlapping start-end
+        days = range(int(start // DAY_SECONDS), int(end // DAY_SECONDS) + 1)
+        if len(days) > MAX_SESSION_DAYS:
+            raise ValueError('Too many days, max %s' % MAX_SESSION_DAYS)
+        m = self.r.pipeline()
+        for d in days:
+            m.zrangebyscore(self._sessions_by_day(d * DAY_SECONDS),
+                            '(%r' % start, '+inf')
+        m.hgetall(self.session_open_hash)
+        results = m.execute()
+        sessions = set()
+        for members in results[:-1]:
+            for session in members:
+                (mac, s, e) = session.rsplit(' ', 2)
+                if float(s) < end:
+                    sessions.add((mac, float(s), float(e)))
+        for (mac, s) in results[-1].iteritems():
+            if float(s) < end:
+                sessions.add((mac, float(s), None))
+        return sorted([(self.mac_format.decode(mac), s, e)
+                       for (mac, s, e) in sessions],
+                      key=lambda session: (session[1], session[0]))
+
+    def _sessions_by_day(self, t):
+        return self.sessions_by_day_prefix + str(int(t // DAY_SECONDS))
+
+    def _minute_set(self, d):
+        return prefix('minute', d)
+
+    def _peak_minute_set(self, d):
+        return prefix('peak', 'minute', d)
+
+    def _reconcile_keys(self, now):
+        d = day(now)
+        return [
+            self.assoclist_mac_set,
+            self.active_mac_set,
+            self.mac_to_count_hash,
+            self.join_mac_by_timestamp_z,
+            self.left_mac_by_timestamp_z,
+            self.excluded_mac_set,
+            self._minute_set(d),
+            self._peak_minute_set(d),
+            self.hour_set,
+            self.peak_hour_set,
+            self.day_set,
+            self.peak_day_set,
+            self.weekday_hour_set,
+            self.rejoined_mac_set,
+            self.present_hash,
+            self.events_stream,
+            self.session_open_hash,
+            self.sessions_prefix,
+            self.sessions_by_day_prefix,
+            self.excluded_cutoff_key]
+
+    def _reconcile_args(self, now, interval):
+        return [
+            repr(now),
+            interval,
+            minute(now),
+            hour(now),
+            day(now),
+            weekday_hour(now),
+            MINUTE_RETENTION,
+            prefix('join'),
+            prefix('left')]
+
+    @metrics.timed(DATA_SECONDS)
+    def _macs_info(self, macs_list, fields=None):
+        macs_list = list(macs_list)
+        (fetched, fields) = projection(fields)
+        infos = self._fetch_macs(macs_list, fetched)
+        now = time.time()
 
-        for mac in macs_list:
-            macs[mac] = self._mac_info(mac)
+        macs = {}
+        for (mac, info) in zip(self._decode(macs_list), infos):
+            macs[mac] = self._mac_info(info, now, fields)
 
         return macs
 
-    def _mac_info(self, mac):
-        info = self._fetch_mac(mac)
-        uptime = int(time.time() - info['joined'])
-        info['joined_iso8601'] = unix_to_iso8601(info['joined'])
-        info['left_iso8601'] = unix_to_iso8601(info['left'])
-        info['uptime'] = uptime
+    def _page_info(self, macs_list, offset, limit, fields, after=None):
+        if after is not None:
+            if not re.match('^%s$' % MAC_REGEXP, after):
+                raise ValueError('after must be a MAC')
+            after = self.mac_format.encode(after)
+        (page, last) = paginate(macs_list, offset, limit, after)
+        macs = self._macs_info(page, fields)
+        if last is not None:
+            last = self.mac_format.decode(last)
+        return self._result(macs, limit, last)
+
+    def _query_cursor(self, after):
+        (score, mac) = after.split(',', 1)
+        if not re.match('^%s$' % MAC_REGEXP, mac):
+            raise ValueError('after must be the next of a previous page')
+        return (float(score), self.mac_format.encode(mac))
+
+    def _result(self, macs, limit, next_cursor):
+        result = {
+            "mac": macs
+        }
+        if limit is not None:
+            result["next"] = next_cursor
+        return result
+
+    def _iter_macs_info(self, pages, fields):
+        for page in pages:
+            macs = self._macs_info(page, fields)
+            for mac in sorted(macs):
+                yield (mac, macs[mac])
+
+    def _pages(self, macs_list, page_size=PAGE_SIZE):
+        for i in range(0, len(macs_list), page_size):
+            yield macs_list[i:i + page_size]
+
+    def _query_pages(self, start, end, page_size):
+        after = None
+        while True:
+            page = self._query_range(start, end, after, page_size)
+            if page:
+                yield [member for (member, score) in page]
+            if len(page) < page_size:
+                break
+            after = (page[-1][1], page[-1][0])
+
+    def _query_range(self, start, end, after, count):
+        # (member, score) of the count first joins between start and end
+        # after the (score, member) cursor, by score then member as in the
+        # sorted set. Joins and leaves elsewhere in the set don't move it.
+        key = self.join_mac_by_timestamp_z
+        if after is None:
+            return self.r.zrangebyscore(
+                key, start, end, start=0, num=count, withscores=True)
+        (score, member) = after
+        # the ones joined at the same time, e.g. in one bulk, sort by member
+        results = [(m, s) for (m, s) in self.r.zrangebyscore(
+            key, repr(score), repr(score), withscores=True) if m > member]
+        results = results[:count]
+        if len(results) < count:
+            results += self.r.zrangebyscore(
+                key, '(%r' % score, end, start=0, num=count - len(results),
+                withscores=True)
+        return results
+
+    def _mac_info(self, info, now, fields=None):
+        if 'joined' in info:
+            info['joined_iso8601'] = unix_to_iso8601(info['joined'])
+            info['uptime'] = int(now - info['joined'])
+        if 'left' in info:
+            info['left_iso8601'] = unix_to_iso8601(info['left'])
+        if fields is not None:
+            info = dict((field, info[field]) for field in fields)
         return info
 
     def _fetch_mac(self, mac):
-        oui = mac[0:8]
-        m = self.r.pipeline()
-        m.zscore(self.join_mac_by_timestamp_z, mac)
-        m.hget(self.mac_to_count_hash, mac)
-        m.hget(self.oui_to_manufacturer_hash, oui)
-        m.zscore(self.left_mac_by_timestamp_z, mac)
-        m.hget(self.mac_to_ip_hash, mac)
-        m.hget(self.mac_to_hostname_hash, mac)
-        results = m.execute()
-        return {
-            'joined': float(results[0]),
-            'count': int(results[1]),
-            'oui': results[2],
-            'left': safe_float(results[3]),
-            'ip': results[4],
-            'hostname': results[5],
-        }
+        return self._fetch_macs([mac])[0]
+
+    def _fetch_macs(self, macs_list, fields=MAC_FIELDS):
+        local_oui = 'oui' in fields and self.oui is not None
+        if local_oui:
+            fields = [field for field in fields if field != 'oui']
+        infos = [{} for mac in macs_list]
+        if fields:
+            # one pipeline (one round trip) for the whole list
+            m = self.r.pipeline()
+            for mac in macs_list:
+                for field in fields:
+                    self._fetch_field(m, mac, field)
+            results = m.execute()
+            for (i, info) in enumerate(infos):
+                values = results[i * len(fields):(i + 1) * len(fields)]
+                for (field, value) in zip(fields, values):
+                    if field in FIELD_PARSERS:
+                        value = FIELD_PARSERS[field](value)
+                    info[field] = value
+        if local_oui:
+            for (mac, info) in zip(self._decode(macs_list), infos):
+                info['oui'] = self.oui.lookup(mac)
+        return infos
+
+    def _fetch_field(self, m, mac, field):
+        if field == 'joined':
+            m.zscore(self.join_mac_by_timestamp_z, mac)
+        elif field == 'count':
+            m.hget(self.mac_to_count_hash, mac)
+        elif field == 'oui':
+            m.hget(self.oui_to_manufacturer_hash,
+                   self.mac_format.decode(mac)[0:8])
+        elif field == 'left':
+            m.zscore(self.left_mac_by_timestamp_z, mac)
+        elif field == 'ip':
+            m.hget(self.mac_to_ip_hash, mac)
+        elif field == 'hostname':
+            m.hget(self.mac_to_hostname_hash, mac)
+
+    def _encode(self, macs):
+        return [self.mac_format.encode(mac) for mac in macs]
+
+    def _decode(self, macs):
+        return [self.mac_format.decode(mac) for mac in macs]
+
+    def _update_present(self):
+        return self.present_script(
+            keys=[self.active_mac_set, self.excluded_mac_set,
+                  self.present_hash],
+            args=[repr(time.time())])
 
     def _active(self):
         return self.r.sdiff(self.active_mac_set, self.excluded_mac_set)
@@ -310,6 +1349,185 @@ IP_REGEXP = '\d+\.\d+\.\d+\.\d+'
 HOSTNAME_REGEXP = '[\w\*-]+'
 
 MAC_PATH = '<mac:re:%s>' % MAC_REGEXP
+RANGE_PATH = '<start:re:[\.\d]+>/<end:re:[\.\d]+>'
+ASSOCLIST_REGEXP = '^(?:assoclist )?(%s)' % MAC_REGEXP
+DELTA_REGEXP = '^([+-])(%s)' % MAC_REGEXP
+EVENT_REGEXP = '^(\d+) ([\.\d]+) ([+-])(%s)' % MAC_REGEXP
+LEASES_REGEXP = '(%s) (%s) (%s)' % (MAC_REGEXP, IP_REGEXP, HOSTNAME_REGEXP)
+
+
+def parse_assoclist(content):
+    return re.findall(ASSOCLIST_REGEXP, content, re.MULTILINE)
+
+
+def parse_delta(content):
+    joined = []
+    left = []
+    for (op, mac) in re.findall(DELTA_REGEXP, content, re.MULTILINE):
+        if op == '+':
+            joined.append(mac)
+        else:
+            left.append(mac)
+    return (joined, left)
+
+
+def parse_events(content):
+    events = []
+    for (seq, timestamp, op, mac) in re.findall(
+            EVENT_REGEXP, content, re.MULTILINE):
+        events.append((int(seq), float(timestamp), op, mac.upper()))
+    return events
+
+
+def group_events(events):
+    # consecutive events sharing a timestamp, split where a MAC repeats so
+    # each group can be applied as one delta
+    groups = []
+    macs = set()
+    for event in events:
+        (seq, timestamp, op, mac) = event
+        if not groups or groups[-1][0] != timestamp or mac in macs:
+            groups.append((timestamp, []))
+            macs = set()
+        groups[-1][1].append(event)
+        macs.add(mac)
+    return groups
+
+
+def parse_leases(content):
+    return re.findall(LEASES_REGEXP, content)
+
+
+def ingest_assoclist(content):
+    joined, left = DATA.bulk(parse_assoclist(content))
+    logger.debug('Updated macs (joined, left) (%s,%s)' % (joined, left))
+    return (joined, left)
+
+
+def ingest_leases(content):
+    changed = LEASES.update(content)
+    logger.debug('Updated leases: %s' % changed)
+    return changed
+
+
+def json_stream(records):
+    yield '{"mac": {'
+    separator = ''
+    for (mac, info) in records:
+        yield '%s%s: %s' % (separator, json.dumps(mac), json.dumps(info))
+        separator = ', '
+    yield '}}'
+
+
+def ndjson_stream(records):
+    for (mac, info) in records:
+        info['mac'] = mac
+        yield '%s\n' % json.dumps(info)
+
+
+# ?stream=json sends the usual {"mac": {...}} document in chunks,
+# ?stream=ndjson one JSON record per line. Streams ignore offset and limit.
+def stream_macs(records):
+    if request.query.get('stream') == 'ndjson':
+        response.headers['Content-Type'] = 'application/x-ndjson'
+        return ndjson_stream(records)
+    response.headers['Content-Type'] = 'text/json'
+    return json_stream(records)
+
+
+def stream_id(id):
+    return tuple([int(i) for i in id.split('-')])
+
+
+def parse_entries(entries):
+    # stream entries as (id, event, mac, time, fresh) events
+    events = []
+    for (id, fields) in entries:
+        fields = dict(zip(fields[::2], fields[1::2]))
+        events.append((id, fields['event'], fields['mac'],
+                       float(fields['time']), fields.get('fresh')))
+    return events
+
+
+def sse(event):
+    (id, name, mac, t, fresh) = event
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (
+        id, name, json.dumps({'mac': mac, 'time': t}))
+
+
+def event_stream(hub, last_id):
+    queue = hub.subscribe()
+    try:
+        yield 'retry: 5000\n\n'
+        # resume from the stream, unless the last event seen was trimmed
+        start = last_id
+        while start:
+            try:
+                events = hub.range(start)
+            except redis.ResponseError:
+                events = []
+            if start == last_id and (not events or events[0][0] != last_id):
+                yield 'event: reset\ndata: {}\n\n'
+                last_id = None
+                break
+            for event in events[1:]:
+                yield sse(event)
+                last_id = event[0]
+            if len(events) < PAGE_SIZE:
+                break
+            start = events[-1][0]
+        while True:
+            try:
+                event = queue.get(timeout=EVENTS_KEEPALIVE)
+            except Queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is None:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            if last_id and stream_id(event[0]) <= stream_id(last_id):
+                continue
+            yield sse(event)
+            last_id = event[0]
+    finally:
+        hub.unsubscribe(queue)
+
+
+def query_params():
+    try:
+        offset = int(request.query.get('offset') or 0)
+        limit = request.query.get('limit')
+        if limit:
+            limit = int(limit)
+        else:
+            limit = None
+    except ValueError:
+        abort(400, 'offset and limit must be integers')
+    after = request.query.get('after') or None
+    if offset < 0 or (limit is not None and limit < 1):
+        abort(400, 'offset must be 0 or more and limit 1 or more')
+    if limit is not None:
+        limit = min(limit, MAX_LIMIT)
+    fields = request.query.get('fields')
+    if fields:
+        fields = fields.split(',')
+        try:
+            projection(fields)
+        except ValueError as e:
+            abort(400, str(e))
+    else:
+        fields = None
+    return (offset, limit, fields, after)
+
+
+def request_content():
+    content = request.body.read()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        try:
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        except zlib.error as e:
+            abort(400, 'Bad gzip body: %s' % e)
+    return content
 
 
 @get('/ping')
@@ -317,14 +1535,39 @@ def ping():
     DATA.ping()
 
 
+def not_modified(etag, changed):
+    # sets the validators, True when the client already has this version
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = email.utils.formatdate(
+        changed, usegmt=True)
+    response.headers['Cache-Control'] = 'public, max-age=%d' % MAX_AGE
+    if 'If-None-Match' in request.headers:
+        return etag in request.headers['If-None-Match']
+    since = parse_date(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(changed) <= since
+
+
 @get('/status.gif')
 def status():
+    (count, changed) = PRESENT()
+    image = 'open' if count else 'closed'
+    if not_modified('"%s"' % image, changed):
+        response.status = 304
+        return ''
     response.headers['Content-Type'] = 'image/gif'
+    return OPEN_IMAGE if count else CLOSE_IMAGE
 
-    if DATA.count():
-        return OPEN_IMAGE
-    else:
-        return CLOSE_IMAGE
+
+@get('/events')
+def events():
+    if not STREAMING:
+        abort(503, '/events needs -worker_class gevent with gunicorn')
+    # EventSource sends Last-Event-ID when it reconnects
+    last_id = request.headers.get('Last-Event-ID') or \
+        request.query.get('last_event_id')
+    response.headers['Content-Type'] = 'text/event-stream'
+    response.headers['Cache-Control'] = 'no-cache'
+    return event_stream(EVENTS, last_id)
 
 
 @get('/agent')
@@ -340,20 +1583,38 @@ def agent():
 
 @get('/MAC')
 def macs():
+    (offset, limit, fields, after) = query_params()
+    if request.query.get('stream'):
+        return stream_macs(DATA.iter_macs(fields))
+    try:
+        result = DATA.macs(offset, limit, fields, after)
+    except ValueError as e:
+        abort(400, str(e))
     response.headers['Content-Type'] = 'text/json'
-    return json.dumps(DATA.macs())
+    return json.dumps(result)
 
 
 @get('/MAC/count')
 def count():
+    (count, changed) = PRESENT()
+    if not_modified('"%d"' % count, changed):
+        response.status = 304
+        return ''
     response.headers['Content-Type'] = 'text/plain'
-    return '%s' % DATA.count()
+    return '%s' % count
 
 
 @get('/MAC/excluded')
 def excluded():
+    (offset, limit, fields, after) = query_params()
+    if request.query.get('stream'):
+        return stream_macs(DATA.iter_excluded(fields))
+    try:
+        result = DATA.excluded(offset, limit, fields, after)
+    except ValueError as e:
+        abort(400, str(e))
     response.headers['Content-Type'] = 'text/json'
-    return json.dumps(DATA.excluded())
+    return json.dumps(result)
 
 
 # @delete('/MAC/%s' % MAC_PATH)
@@ -368,36 +1629,222 @@ def purge(mac):
 
 @get('/MAC/<start:re:[\.\d]*>/<end:re:[\.\d]*>')
 def macs(start, end):
+    (offset, limit, fields, after) = query_params()
+    if request.query.get('stream'):
+        return stream_macs(DATA.iter_query(start, end, fields))
+    try:
+        result = DATA.query(start, end, offset, limit, fields, after)
+    except ValueError as e:
+        abort(400, str(e))
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(result)
+
+
+@get('/rollup/<resolution:re:minute|hour|day>/%s' % RANGE_PATH)
+def rollup(resolution, start, end):
+    try:
+        result = DATA.rollup(resolution, float(start), float(end))
+    except ValueError as e:
+        abort(400, str(e))
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(result)
+
+
+def session_info(mac, start, end):
+    info = {
+        'start': start,
+        'start_iso8601': unix_to_iso8601(start),
+        'end': end,
+        'end_iso8601': unix_to_iso8601(end),
+        'duration': (time.time() if end is None else end) - start,
+    }
+    if mac is not None:
+        info['mac'] = mac
+    return info
+
+
+@get('/sessions/MAC/%s' % MAC_PATH)
+def mac_sessions(mac):
+    end = request.query.get('end')
+    try:
+        start = safe_float(request.query.get('start'))
+        end = float(end) if end else None
+    except ValueError as e:
+        abort(400, str(e))
+    sessions = DATA.sessions(mac, start, end)
     response.headers['Content-Type'] = 'text/json'
-    return json.dumps(DATA.query(start, end))
+    return json.dumps({'sessions': [session_info(None, s, e)
+                                    for (s, e) in sessions]})
+
 
+@get('/sessions/MAC/%s/dwell/%s' % (MAC_PATH, RANGE_PATH))
+def mac_dwell(mac, start, end):
+    try:
+        (start, end) = (float(start), float(end))
+    except ValueError as e:
+        abort(400, str(e))
+    (dwell, sessions) = DATA.dwell(mac, start, end)
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps({'mac': mac.upper(), 'start': start,
+                       'end': end, 'dwell': dwell,
+                       'sessions': sessions})
+
+
+@get('/sessions/%s' % RANGE_PATH)
+def sessions(start, end):
+    try:
+        sessions = DATA.overlapping(float(start), float(end))
+    except ValueError as e:
+        abort(400, str(e))
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps({'sessions': [session_info(*session)
+                                    for session in sessions]})
 
-@SCHED.interval_schedule(minutes=1, coalesce=True)
+
+@get('/present/<t:re:[\.\d]+>')
+def present(t):
+    try:
+        t = float(t)
+    except ValueError as e:
+        abort(400, str(e))
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps({'time': t, 'present': DATA.present_at(t)})
+
+
+@get('/rollup/weekday-hour')
+def rollup_weekday_hour():
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(DATA.weekday_hour())
+
+
+# The router pushes either a full assoclist snapshot (`wl assoclist` output
+# or one MAC per line) or, with ?mode=delta, `+MAC`/`-MAC` lines. Agents
+# send their outbox with ?mode=events&agent=<id> as `<seq> <timestamp>
+# +MAC` lines and get back the last sequence applied. Bodies may be sent
+# with Content-Encoding: gzip.
+@post('/assoclist')
+def push_assoclist():
+    content = request_content()
+    mode = request.query.get('mode')
+    if mode == 'events':
+        agent = request.query.get('agent')
+        if not agent:
+            abort(400, 'agent is required')
+        acked, joined, left = DATA.apply_events(agent, parse_events(content))
+        response.headers['Content-Type'] = 'text/json'
+        return json.dumps({'acked': acked, 'joined': joined, 'left': left})
+    elif mode == 'delta':
+        joined, left = DATA.delta(*parse_delta(content))
+    else:
+        joined, left = ingest_assoclist(content)
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps({'joined': joined, 'left': left})
+
+
+@post('/leases')
+def push_leases():
+    changed = ingest_leases(request_content())
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps({'changed': len(changed)})
+
+
+@get('/redis')
+def redis_stats():
+    # the pool of this process, and how long a PING takes through it
+    start = time.time()
+    DATA.r.ping()
+    stats = DATA.r.connection_pool.stats()
+    stats['ping'] = time.time() - start
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(stats)
+
+
+@get('/scheduler')
+def scheduler_stats():
+    # the jobs run in the process holding the lead, which stores its stats
+    stats = SCHED.stats()
+    if not stats['leader']:
+        stored = DATA.r.get(prefix('scheduler-stats'))
+        if stored is not None:
+            stats = dict(json.loads(stored), leader=False)
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(stats)
+
+
+def report_scheduler(stats):
+    DATA.r.set(prefix('scheduler-stats'),
+               json.dumps(dict(stats, pid=os.getpid(), reported=time.time())))
+
+
+@get('/metrics')
+def prometheus_metrics():
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return METRICS.render()
+
+
+def file_age(filename):
+    try:
+        return time.time() - os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+def register_metrics(files):
+    # read from the pool, the scheduler and the files polled when scraped
+    pool = DATA.r.connection_pool
+    for (name, kind, help) in [
+            ('max_connections', 'gauge', 'Size of the Redis connection pool'),
+            ('connections', 'gauge', 'Redis connections opened'),
+            ('in_use', 'gauge', 'Redis connections in use'),
+            ('requests', 'counter', 'Redis connections taken from the pool'),
+            ('waits', 'counter', 'Times a Redis connection was waited for'),
+            ('wait_seconds', 'counter',
+             'Time spent waiting for a Redis connection'),
+            ('timeouts', 'counter',
+             'Times no Redis connection was free in time')]:
+        METRICS.callback(
+            'wifi_redis_pool_%s%s' % (name, '_total' if kind == 'counter'
+                                      else ''),
+            kind, help, lambda name=name: {(): pool.stats()[name]})
+    for (name, help, attr) in [
+            ('wifi_job_failures_total',
+             'Scheduled job runs raising an exception', 'failures'),
+            ('wifi_job_overruns_total',
+             'Scheduled job runs longer than their interval', 'overruns'),
+            ('wifi_job_triggers_total',
+             'Scheduled job runs requested by a file change', 'triggers')]:
+        METRICS.callback(
+            name, 'counter', help, lambda attr=attr: dict(
+                ((job.name, ), getattr(job, attr)) for job in SCHED.jobs),
+            ['job'])
+    METRICS.callback(
+        'wifi_scheduler_leader', 'gauge',
+        'Whether this process runs the scheduled jobs',
+        lambda: {(): int(SCHED.leading)})
+    METRICS.callback(
+        'wifi_ingest_lag_seconds', 'gauge',
+        'Time since the polled assoclist and leases files were written',
+        lambda: dict(((filename, ), file_age(filename))
+                     for filename in files), ['file'])
+
+
+@metrics.timed(JOB_SECONDS)
 def update_excluded():
     excluded = DATA.update_excluded()
     if len(excluded):
         logger.info('Refreshing update excluded: %s' % excluded)
 
 
-@SCHED.interval_schedule(minutes=1, coalesce=True)
+@metrics.timed(JOB_SECONDS)
 def update_leases():
-    content = file(LEASES_FILENAME).read()
-    regexp = '(%s) (%s) (%s)' % (MAC_REGEXP, IP_REGEXP, HOSTNAME_REGEXP)
-    results = re.findall(regexp, content)
-    logger.debug('Updating leases: %s' % results)
-    for (mac, ip, hostname) in results:
-        mac = mac.upper()
-        DATA.add_ip(mac, ip)
-        DATA.add_hostname(mac, hostname)
+    changed = LEASES.poll()
+    if changed:
+        logger.debug('Updated leases: %s' % changed)
 
 
-@SCHED.interval_schedule(minutes=1, coalesce=True)
+@metrics.timed(JOB_SECONDS)
 def update_macs():
-    content = file(ASSOCLIST_FILENAME).read()
-    regexp = 'assoclist (%s)' % (MAC_REGEXP)
-    results = re.findall(regexp, content)
-    joined, left = DATA.bulk(results)
-    logger.debug('Updated macs (joined, left) (%s,%s)' % (joined, left))
+    ingest_assoclist(file(ASSOCLIST_FILENAME).read())
 
 
 if __name__ == '__main__':
@@ -410,26 +1857,127 @@ if __name__ == '__main__':
         '-assoclist',
         dest='assoclist',
         default='/home/router/assoclist')
+    parser.add_argument(
+        '-push',
+        dest='push',
+        action='store_true',
+        help='router pushes to /assoclist and /leases, do not poll files')
+    parser.add_argument(
+        '-oui',
+        dest='oui',
+        nargs='+',
+        help='IEEE oui.txt/mam.txt/oui36.txt files or an index built by '
+             'oui-loader.py, looked up in process instead of in Redis')
+    parser.add_argument(
+        '-interval',
+        dest='interval',
+        default=10,
+        type=float,
+        help='seconds between reads of the leases and assoclist files, '
+             'which are also read as soon as they change')
+    parser.add_argument(
+        '-excluded_interval',
+        dest='excluded_interval',
+        default=60,
+        type=float)
+    parser.add_argument(
+        '-jitter',
+        dest='jitter',
+        default=1,
+        type=float,
+        help='random seconds added to every interval')
+    parser.add_argument('-host', dest='host', default='0.0.0.0')
+    parser.add_argument('-port', dest='port', default=9000, type=int)
+    parser.add_argument(
+        '-server',
+        dest='server',
+        default='threaded',
+        help='threaded, or a bottle server adapter such as gevent, paste '
+             'or gunicorn')
+    parser.add_argument(
+        '-workers',
+        dest='workers',
+        default=1,
+        type=int,
+        help='worker processes, with -server gunicorn')
+    config.add_arguments(parser)
+    parser.add_argument(
+        '-worker_class',
+        dest='worker_class',
+        default='sync',
+        choices=['sync', 'gevent'],
+        help='gunicorn workers, gevent is needed to serve /events')
+    parser.add_argument(
+        '-redis_connections',
+        dest='redis_connections',
+        type=int,
+        help='size of the Redis connection pool of each process, 64 by '
+             'default')
+    parser.add_argument(
+        '-cache_ttl',
+        dest='cache_ttl',
+        default=1,
+        type=float,
+        help='seconds the present count is reused for the status badge and '
+             '/MAC/count without asking Redis')
+    parser.add_argument('-debug', dest='debug', action='store_true')
+    parser.add_argument(
+        '-reload',
+        dest='reload',
+        action='store_true',
+        help='restart when the code changes, for development')
     args = parser.parse_args()
 
-    if not os.path.isfile(args.leases):
+    if args.workers > 1 and args.server != 'gunicorn':
+        parser.error('-workers requires -server gunicorn')
+
+    if not args.push and not os.path.isfile(args.leases):
         logger.debug('Not a file: %s' % args.leases)
         exit(1)
 
-    global DATA, OPEN_IMAGE, CLOSE_IMAGE, LEASES_FILENAME, ASSOCLIST_FILENAME
+    global DATA, LEASES, PRESENT, EVENTS, OPEN_IMAGE, CLOSE_IMAGE
+    global ASSOCLIST_FILENAME
     ASSOCLIST_FILENAME = args.assoclist
-    LEASES_FILENAME = args.leases
     OPEN_IMAGE = get_file_content('xcj_open_badge.gif')
     CLOSE_IMAGE = get_file_content('xcj_closed_badge.gif')
 
-    DATA = WifiData(client())
-
-    update_macs()
-    update_leases()
-    update_excluded()
-
-    SCHED.start()
-    SCHED.print_jobs()
-
+    oui = None
+    if args.oui:
+        oui = OuiIndex.load(*args.oui)
+        logger.info('Loaded %d OUI assignments' % len(oui))
+    DATA = WifiData(
+        client(config.from_args(args), args.redis_connections), oui)
+    LEASES = LeaseWatcher(DATA, args.leases)
+    PRESENT = Cached(DATA.present, args.cache_ttl)
+    EVENTS = EventHub(DATA.r, DATA.events_stream, DATA.mac_format)
+
+    if not args.push:
+        SCHED.add(update_macs, args.interval, args.jitter, [args.assoclist])
+        SCHED.add(update_leases, args.interval, args.jitter, [args.leases])
+    SCHED.add(update_excluded, args.excluded_interval, args.jitter)
+    SCHED.leader = Leader(DATA.r, prefix('scheduler'))
+    SCHED.report = report_scheduler
+    options = {}
+    if args.server == 'gunicorn':
+        # the workers are forked from this process, each one schedules and
+        # the jobs run in the one holding the lead
+        options['post_fork'] = lambda server, worker: SCHED.start()
+        options['worker_class'] = args.worker_class
+        STREAMING = args.worker_class != 'sync'
+    # with -reload this also runs in the parent process watching the code,
+    # only the serving child (BOTTLE_CHILD) schedules
+    elif not args.reload or os.environ.get('BOTTLE_CHILD'):
+        SCHED.start()
+    register_metrics([] if args.push else [args.assoclist, args.leases])
+    install(metrics.Plugin(ROUTE_SECONDS))
+
+    server = args.server
+    if server == 'threaded':
+        server = ThreadedServer
+    elif server == 'gunicorn':
+        options['workers'] = args.workers
+        # gunicorn parses the command line again
+        sys.argv = sys.argv[:1]
     logger.info('Starting API server')
-    run(host='0.0.0.0', reloader=True, port=9000, debug=True)
+    run(host=args.host, port=args.port, server=server, reloader=args.reload,
+        debug=args.debug, **options)
@@ -0,0 +1,982 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import httplib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+import bottle
+import numpy
+import redis
+
+import agent
+import api
+import client
+import config
+import export
+import fakes
+import metrics
+import migrate
+import oui
+
+
+class CountingConnection(redis.Connection):
+    round_trips = 0
+
+    def send_packed_command(self, command):
+        CountingConnection.round_trips += 1
+        return redis.Connection.send_packed_command(self, command)
+
+
+class CountingUnixConnection(CountingConnection,
+                             redis.UnixDomainSocketConnection):
+    pass
+
+
+def counting_client(args):
+    settings = config.from_args(args)
+    if settings['unix_socket_path']:
+        connection_class = CountingUnixConnection
+    else:
+        connection_class = CountingConnection
+    return redis.Redis(
+        connection_pool=config.pool(settings, connection_class))
+
+
+def random_mac():
+    return ':'.join(['%02X' % random.randint(0, 255) for i in range(6)])
+
+
+def sizes(s):
+    return [int(i) for i in s.split(',')]
+
+
+def measure(f, repeat):
+    best = None
+    for i in range(repeat):
+        CountingConnection.round_trips = 0
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, CountingConnection.round_trips
+
+
+def populate_macs(data, count):
+    now = time.time()
+    macs = [random_mac() for i in range(count)]
+    m = data.r.pipeline()
+    for mac in macs:
+        m.sadd(data.active_mac_set, mac)
+        joined = now - random.randint(0, 3600)
+        m.zadd(data.join_mac_by_timestamp_z, mac, joined)
+        m.zadd(data.left_mac_by_timestamp_z, mac, joined - 3600)
+        m.hset(data.mac_to_count_hash, mac, random.randint(1, 100))
+        m.hset(data.mac_to_ip_hash, mac, '10.0.10.%d' % random.randint(2, 254))
+        m.hset(data.mac_to_hostname_hash, mac, 'host-%s' % mac[-5:])
+    m.execute()
+    return macs
+
+
+def macs_info(args):
+    r = counting_client(args)
+    print '%8s %12s %12s %12s %12s' % (
+        'macs', 'single (s)', 'trips', 'batched (s)', 'trips')
+    for count in sizes(args.sizes):
+        r.flushdb()
+        data = api.WifiData(r)
+        macs = populate_macs(data, count)
+
+        def single():
+            for mac in macs:
+                data._fetch_mac(mac)
+
+        def batched():
+            data._macs_info(macs)
+
+        single_time, single_trips = measure(single, args.repeat)
+        batched_time, batched_trips = measure(batched, args.repeat)
+        print '%8d %12.4f %12d %12.4f %12d' % (
+            count, single_time, single_trips, batched_time, batched_trips)
+    r.flushdb()
+
+
+def write_leases(filename, leases):
+    f = file(filename, 'w')
+    for (mac, (ip, hostname)) in leases.iteritems():
+        f.write('1369000000 %s %s %s *\n' % (mac, ip, hostname))
+    f.close()
+
+
+def leases(args):
+    r = counting_client(args)
+    (fd, filename) = tempfile.mkstemp(suffix='.leases')
+    os.close(fd)
+    print '%8s %12s %12s %12s %12s %12s %12s' % (
+        'leases', 'legacy (s)', 'trips', 'first (s)', 'trips',
+        'steady (s)', 'trips')
+    for count in sizes(args.sizes):
+        r.flushdb()
+        data = api.WifiData(r)
+        entries = {}
+        for i in range(count):
+            entries[random_mac()] = (
+                '10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+                'host-%d' % i)
+        write_leases(filename, entries)
+
+        def legacy():
+            content = file(filename).read()
+            for (mac, ip, hostname) in api.parse_leases(content):
+                mac = mac.upper()
+                data.add_ip(mac, ip)
+                data.add_hostname(mac, hostname)
+
+        def first():
+            watcher = api.LeaseWatcher(data, filename)
+            watcher.poll()
+            return watcher
+
+        legacy_time, legacy_trips = measure(legacy, 1)
+        first_time, first_trips = measure(first, 1)
+        watcher = first()
+        steady_time, steady_trips = measure(watcher.poll, args.repeat)
+        print '%8d %12.4f %12d %12.4f %12d %12.6f %12d' % (
+            count, legacy_time, legacy_trips, first_time, first_trips,
+            steady_time, steady_trips)
+
+        # rewritten file with a handful of renewed leases
+        for mac in random.sample(entries.keys(), min(10, count)):
+            entries[mac] = (entries[mac][0], entries[mac][1] + '-renewed')
+        write_leases(filename, entries)
+        os.utime(filename, (time.time() + 1, time.time() + 1))
+        CountingConnection.round_trips = 0
+        start = time.time()
+        changed = watcher.poll()
+        print '%8s %d changed leases written in %.4fs, %d trips' % (
+            '', len(changed), time.time() - start,
+            CountingConnection.round_trips)
+    os.unlink(filename)
+    r.flushdb()
+
+
+def write_registry(filename, count):
+    f = file(filename, 'w')
+    vendors = ['Vendor %d Co., Ltd' % i for i in range(count / 2)]
+    for value in random.sample(xrange(1 << 24), count):
+        digits = '%06X' % value
+        f.write('%s-%s-%s   (hex)\t\t%s\n' % (
+            digits[0:2], digits[2:4], digits[4:6], random.choice(vendors)))
+        f.write('%s     (base 16)\t\t%s\n\n' % (digits, 'vendor address'))
+    # MA-M and MA-S blocks, under their parent MA-L prefix
+    for (bits, blocks) in [(28, count / 10), (36, count / 10)]:
+        for value in random.sample(xrange(1 << bits), blocks):
+            start = value << (48 - bits)
+            end = start + (1 << (48 - bits)) - 1
+            digits = '%012X' % start
+            vendor = random.choice(vendors)
+            f.write('%s-%s-%s   (hex)\t\t%s\n' % (
+                digits[0:2], digits[2:4], digits[4:6], vendor))
+            f.write('%012X-%012X     (base 16)\t\t%s\n\n' % (
+                start, end, vendor))
+    f.close()
+
+
+def dict_size(d):
+    size = sys.getsizeof(d)
+    for (k, v) in d.iteritems():
+        size += sys.getsizeof(k)
+    for v in set(d.values()):
+        size += sys.getsizeof(v)
+    return size
+
+
+def index_size(index):
+    size = sys.getsizeof(index.vendors)
+    size += sum([sys.getsizeof(v) for v in index.vendors])
+    for (prefixes, ids) in index.tables.values():
+        size += prefixes.buffer_info()[1] * prefixes.itemsize
+        size += ids.buffer_info()[1] * ids.itemsize
+    return size
+
+
+def oui_index(args):
+    filenames = args.files
+    if not filenames:
+        (fd, filename) = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        write_registry(filename, args.count)
+        filenames = [filename]
+    (fd, index_filename) = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+
+    start = time.time()
+    entries = []
+    for filename in filenames:
+        entries.extend(oui.parse(file(filename)))
+    index = oui.OuiIndex.build(entries)
+    print 'parse and build %d assignments: %.3fs' % (
+        len(index), time.time() - start)
+    index.save(index_filename)
+    start = time.time()
+    index = oui.OuiIndex.load(index_filename)
+    print 'load binary index (%d bytes): %.4fs' % (
+        os.path.getsize(index_filename), time.time() - start)
+
+    # what oui-loader.py keeps in the Redis hash, as a dict of strings
+    pairs = {}
+    for (prefix, bits, vendor) in entries:
+        if bits == 24:
+            digits = '%06X' % prefix
+            pairs['%s:%s:%s' % (digits[0:2], digits[2:4], digits[4:6])] = \
+                vendor
+    print 'memory: index %d bytes, dict of strings %d bytes' % (
+        index_size(index), dict_size(pairs))
+
+    macs = [random.choice(pairs.keys()) + random_mac()[8:]
+            for i in range(args.lookups)]
+    start = time.time()
+    for mac in macs:
+        index.lookup(mac)
+    index_time = time.time() - start
+    start = time.time()
+    for mac in macs:
+        pairs.get(mac[0:8])
+    dict_time = time.time() - start
+    print '%d lookups: index %.3fs, dict %.3fs' % (
+        args.lookups, index_time, dict_time)
+
+    os.unlink(index_filename)
+    if not args.files:
+        os.unlink(filenames[0])
+
+
+def history(count, devices):
+    # closed sessions, a minute apart, oldest first
+    now = int(time.time())
+    for i in xrange(count, 0, -1):
+        yield (now - i * 60, now - i * 60 + 30, random.randrange(devices))
+
+
+def agent_store(args):
+    directory = tempfile.mkdtemp()
+    macs = [random_mac() for i in range(args.devices)]
+    # v0 is the unindexed mac table of schema version 0
+    print '%10s %12s %12s %12s %12s %12s' % (
+        'sessions', 'v0 upd (s)', 'v0 cur (s)', 'update (s)',
+        'current (s)', 'archive (s)')
+    for count in sizes(args.sizes):
+        now = int(time.time())
+        legacy = sqlite3.connect(
+            os.path.join(directory, 'legacy-%d.dat' % count))
+        legacy.execute('pragma journal_mode=wal')
+        legacy.execute('pragma synchronous=normal')
+        legacy.execute(
+            'create table mac (joined NUMERIC, left NUMERIC, mac TEXT)')
+        legacy.executemany(
+            'insert into mac(joined, left, mac) values (?, ?, ?)',
+            ((joined, left, macs[i])
+             for (joined, left, i) in history(count, len(macs))))
+        legacy.executemany(
+            'insert into mac(joined, mac) values (?, ?)',
+            [(now, mac) for mac in macs[:args.open]])
+        legacy.commit()
+
+        store = agent.Store(os.path.join(directory, 'store-%d.dat' % count))
+        store.cursor.executemany(
+            'insert into device(id, mac) values (?, ?)',
+            [(i + 1, mac) for (i, mac) in enumerate(macs)])
+        store.cursor.executemany(
+            'insert into session(device, joined, left) values (?, ?, ?)',
+            ((i + 1, joined, left)
+             for (joined, left, i) in history(count, len(macs))))
+        store.record(set(macs[:args.open]), set())
+        store.conn.commit()
+
+        def legacy_update():
+            mac = random_mac()
+            legacy.execute(
+                'insert into mac(joined, mac) values (?, ?)', (now, mac))
+            legacy.commit()
+            legacy.execute(
+                'update mac set left = ? where left is null and mac = ?',
+                (now, mac))
+            legacy.commit()
+
+        def legacy_current():
+            legacy.execute('select mac from mac where left is null') \
+                .fetchall()
+
+        def update():
+            mac = random_mac()
+            store.record(set([mac]), set())
+            store.record(set(), set([mac]))
+
+        legacy_update_time = measure(legacy_update, args.repeat)[0]
+        legacy_current_time = measure(legacy_current, args.repeat)[0]
+        update_time = measure(update, args.repeat)[0]
+        current_time = measure(store.current_macs, args.repeat)[0]
+        start = time.time()
+        store.archive(now - count / 2 * 60)
+        archive_time = time.time() - start
+        print '%10d %12.6f %12.6f %12.6f %12.6f %12.3f' % (
+            count, legacy_update_time, legacy_current_time, update_time,
+            current_time, archive_time)
+        legacy.close()
+        store.close()
+    shutil.rmtree(directory)
+
+
+def events(args):
+    r = counting_client(args)
+    r.flushdb()
+    api.DATA = api.WifiData(r)
+    api.EVENTS = api.EventHub(r, api.DATA.events_stream)
+    server = threading.Thread(target=bottle.run, kwargs={
+        'host': 'localhost', 'port': args.port, 'quiet': True,
+        'server': api.ThreadedServer})
+    server.daemon = True
+    server.start()
+    time.sleep(1)
+    populate_macs(api.DATA, args.macs)
+
+    sent = {}
+    received = []
+    lock = threading.Lock()
+
+    def client():
+        conn = httplib.HTTPConnection('localhost', args.port)
+        conn.request('GET', '/events')
+        res = conn.getresponse()
+        count = 0
+        while count < args.events:
+            line = res.fp.readline()
+            if line.startswith('data: '):
+                mac = json.loads(line[6:])['mac']
+                with lock:
+                    received.append(time.time() - sent[mac])
+                count += 1
+        conn.close()
+
+    clients = [threading.Thread(target=client) for i in range(args.clients)]
+    for thread in clients:
+        thread.daemon = True
+        thread.start()
+    time.sleep(1)
+    CountingConnection.round_trips = 0
+    for i in range(args.events):
+        mac = random_mac()
+        sent[mac] = time.time()
+        api.DATA.delta([mac], [])
+        time.sleep(args.spacing)
+    for thread in clients:
+        thread.join(10)
+    trips = CountingConnection.round_trips
+    received.sort()
+    print '%d clients, %d events: %d delivered, p50 %.2fms, p99 %.2fms, ' \
+        'max %.2fms, %d Redis round trips including the writes' % (
+            args.clients, args.events, len(received),
+            percentile(received, 0.5) * 1000,
+            percentile(received, 0.99) * 1000, received[-1] * 1000, trips)
+
+    # the same clients polling /MAC instead
+    CountingConnection.round_trips = 0
+    api.DATA.macs()
+    print 'polling /MAC (%d macs) every %ss instead: %.1f requests/s, ' \
+        '%.0f Redis round trips/s, up to %ss late' % (
+            args.macs, args.poll, args.clients / float(args.poll),
+            CountingConnection.round_trips * args.clients /
+            float(args.poll), args.poll)
+    r.flushdb()
+
+
+def migration(args):
+    r = counting_client(args)
+    r.flushdb()
+    m = r.pipeline(transaction=False)
+    now = time.time()
+    for i in range(args.size):
+        m.hset('source', '%012X' % i, now - i)
+        if i % 10000 == 9999:
+            m.execute()
+    m.execute()
+
+    # the slowest reply to a PING sent every 10ms while f() runs, from
+    # another process so that it doesn't wait for this one
+    def blocking(f):
+        done = multiprocessing.Event()
+        result = multiprocessing.Queue()
+
+        def ping():
+            client = config.client(config.from_args(args))
+            latency = 0
+            while not done.is_set():
+                start = time.time()
+                client.ping()
+                latency = max(latency, time.time() - start)
+                time.sleep(0.01)
+            result.put(latency)
+
+        process = multiprocessing.Process(target=ping)
+        process.start()
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        done.set()
+        latency = result.get()
+        process.join()
+        return (elapsed, latency)
+
+    print '%-24s %10s %10s %12s %14s' % (
+        'method', 'entries', 'time (s)', 'entries/s', 'max ping (ms)')
+    kv = {}
+    (elapsed, ping) = blocking(lambda: kv.update(r.hgetall('source')))
+    print '%-24s %10d %10.3f %12d %14.2f' % (
+        'hgetall', args.size, elapsed, args.size / elapsed, ping * 1000)
+
+    def legacy():
+        for (member, score) in kv.items()[:args.legacy_size]:
+            r.zadd('target', member, score)
+
+    (elapsed, ping) = blocking(legacy)
+    print '%-24s %10d %10.3f %12d %14.2f' % (
+        'zadd per member', args.legacy_size, elapsed,
+        args.legacy_size / elapsed, ping * 1000)
+    for batch in sizes(args.batches):
+        r.delete('target', migrate.checkpoints())
+        (elapsed, ping) = blocking(lambda: migrate.run(
+            migrate.HashToZset(r, 'source', 'target'), batch,
+            report_interval=3600))
+        assert r.zcard('target') == args.size
+        print '%-24s %10d %10.3f %12d %14.2f' % (
+            'hscan, batch %d' % batch, args.size, elapsed,
+            args.size / elapsed, ping * 1000)
+    r.flushdb()
+
+
+def api_client(args):
+    server = fakes.start(
+        fakes.FakeApi(('localhost', args.port), delay=args.delay))
+    macs = [random_mac() for i in range(args.macs)]
+    ranges = [(i, i + 3600) for i in range(0, args.macs * 3600, 3600)]
+
+    # the previous client, a connection per request
+    def legacy_get(uri):
+        url = 'http://localhost:%d%s' % (args.port, uri)
+        return urllib.urlopen(url).read()
+
+    def legacy_delete(uri):
+        conn = httplib.HTTPConnection('localhost', args.port)
+        conn.request('DELETE', uri)
+        return conn.getresponse().read()
+
+    sequential = client.Client('localhost', args.port, connections=1)
+    pooled = client.Client(
+        'localhost', args.port, connections=args.connections)
+    print '%-32s %10s %10s %12s' % (
+        'operation', 'time (s)', 'requests', 'connections')
+    for (name, f) in [
+            ('purge, legacy', lambda: [
+                legacy_delete('/MAC/purge/%s' % mac) for mac in macs]),
+            ('purge, keep-alive', lambda: [
+                sequential.purge(mac) for mac in macs]),
+            ('purge_many', lambda: pooled.purge_many(macs)),
+            ('join, legacy', lambda: [
+                legacy_get('/MAC/%s' % mac) for mac in macs]),
+            ('join_many', lambda: pooled.join_many(macs)),
+            ('query, legacy', lambda: [
+                legacy_get('/MAC/%s/%s' % r) for r in ranges]),
+            ('query, keep-alive', lambda: [
+                sequential.query(*r) for r in ranges]),
+            ('query_many', lambda: pooled.query_many(ranges))]:
+        del server.requests[:]
+        server.connections = 0
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        print '%-32s %10.3f %10d %12d' % (
+            '%s (%d macs)' % (name, args.macs), elapsed,
+            len(server.requests), server.connections)
+    sequential.close()
+    pooled.close()
+    server.shutdown()
+
+
+def history_export(args):
+    r = counting_client(args)
+    r.flushdb()
+    data = api.WifiData(r)
+    end = time.time()
+    start = end - args.days * api.DAY_SECONDS
+    m = r.pipeline(transaction=False)
+    count = 0
+    for i in range(args.devices):
+        mac = random_mac()
+        t = start + random.uniform(0, api.DAY_SECONDS)
+        while t < end:
+            length = random.expovariate(1 / 3600.0)
+            if t + length >= end:
+                m.hset(data.session_open_hash, mac, t)
+            else:
+                m.zadd(data.sessions_prefix + mac, '%r %r' % (t, t + length),
+                       t + length)
+            count += 1
+            t += length + random.expovariate(1.0 / args.gap)
+        m.execute()
+    filename = os.path.join(tempfile.mkdtemp(), 'history.npz')
+    started = time.time()
+    export.export(data, filename)
+    exported = time.time() - started
+    size = os.path.getsize(filename)
+    started = time.time()
+    (sessions, macs, now) = export.load(filename)
+    loaded = time.time() - started
+    print '%d days, %d devices, %d sessions: export %.2fs, %d bytes, ' \
+        'load %.3fs' % (args.days, args.devices, count, exported, size,
+                        loaded)
+    assert len(sessions) == count
+
+    records = [(int(s['mac']), float(s['start']), float(s['end']))
+               for s in sessions]
+    times = range(int(start), int(now), args.step)
+
+    # per-record loops over the same sessions
+    def legacy_concurrency():
+        changes = sorted([(s, 1) for (mac, s, e) in records] +
+                         [(e, -1) for (mac, s, e) in records])
+        present = []
+        current = 0
+        i = 0
+        for t in times:
+            while i < len(changes) and changes[i][0] <= t:
+                current += changes[i][1]
+                i += 1
+            present.append(current)
+        return present
+
+    def legacy_dwell():
+        dwell = {}
+        for (mac, s, e) in records:
+            dwell[mac] = dwell.get(mac, 0) + e - s
+        return dwell
+
+    def legacy_weekday_hour():
+        total = [[0] * 24 for i in range(7)]
+        samples = [[0] * 24 for i in range(7)]
+        present = legacy_concurrency()
+        for (t, n) in zip(times, present):
+            d = datetime.datetime.fromtimestamp(t)
+            total[d.weekday()][d.hour] += n
+            samples[d.weekday()][d.hour] += 1
+        return total
+
+    samples = numpy.arange(int(start), now, args.step)
+    print '%-20s %12s %12s' % ('analysis', 'loops (s)', 'numpy (s)')
+    for (name, legacy, vectorized) in [
+            ('concurrency', legacy_concurrency,
+             lambda: export.concurrency(sessions, samples)),
+            ('dwell by device', legacy_dwell,
+             lambda: export.dwell_by_mac(sessions)),
+            ('weekday x hour', legacy_weekday_hour,
+             lambda: export.weekday_hour(sessions, int(start), now,
+                                         args.step))]:
+        print '%-20s %12.3f %12.3f' % (
+            name, measure(legacy, 1)[0], measure(vectorized, args.repeat)[0])
+    assert list(export.concurrency(sessions, samples)) == \
+        legacy_concurrency()
+    shutil.rmtree(os.path.dirname(filename))
+    r.flushdb()
+
+
+def mac_format(args):
+    r = counting_client(args)
+    r.flushdb()
+    random.seed(0)
+    macs = sorted(set([random_mac() for i in range(args.devices)]))
+    now = time.time()
+
+    def populate(data):
+        for i in range(0, len(macs), 1000):
+            data.delta(macs[i:i + 1000], [], now=now - 7200)
+        for i in range(0, len(macs) / 2, 1000):
+            data.delta([], macs[i:min(i + 1000, len(macs) / 2)],
+                       now=now - 3600)
+        data.add_leases(dict(
+            (mac, ('10.0.%d.%d' % (i / 250, i % 250), 'host-%d' % i))
+            for (i, mac) in enumerate(macs)))
+
+    def keys(data):
+        return [
+            ('active', data.active_mac_set),
+            ('join-by-timestamp', data.join_mac_by_timestamp_z),
+            ('count', data.mac_to_count_hash),
+            ('hostname', data.mac_to_hostname_hash),
+            ('session-open', data.session_open_hash)]
+
+    def network(f):
+        before = r.info('stats')
+        f()
+        after = r.info('stats')
+        return sum([after[k] - before[k] for k in
+                    ('total_net_input_bytes', 'total_net_output_bytes')])
+
+    results = {}
+    for name in ['text', 'binary']:
+        r.flushdb()
+        r.set(api.prefix('mac-format'), name)
+        baseline = r.info('memory')['used_memory']
+        data = api.WifiData(r)
+        populate(data)
+        memory = r.info('memory')['used_memory'] - baseline
+        sizes = [r.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0)
+                 for (label, key) in keys(data)]
+        active = measure(data._active, args.repeat)[0]
+        listing = measure(
+            lambda: data.macs(fields=['joined', 'count']), args.repeat)[0]
+        listing_bytes = network(lambda: data.macs(fields=['joined', 'count']))
+        results[name] = (memory, sizes, active, listing, listing_bytes)
+
+    print '%d devices, half of them left' % len(macs)
+    print '%-28s %14s %14s' % ('', 'text', 'binary')
+    for (i, label) in enumerate(['used memory (bytes)'] +
+                                [label for (label, key) in keys(data)]):
+        print '%-28s %14d %14d' % (
+            label, results['text'][0] if i == 0 else results['text'][1][i - 1],
+            results['binary'][0] if i == 0
+            else results['binary'][1][i - 1])
+    for (i, label) in [(2, 'active (sdiff, s)'), (3, '/MAC (s)')]:
+        print '%-28s %14.3f %14.3f' % (
+            label, results['text'][i], results['binary'][i])
+    print '%-28s %14d %14d' % (
+        '/MAC network (bytes)', results['text'][4], results['binary'][4])
+
+    # migrating the text form
+    r.flushdb()
+    populate(api.WifiData(r))
+    start = time.time()
+    for migration in migrate.mac_format_migrations(r, 'binary'):
+        migrate.run(migration, report_interval=3600)
+    elapsed = time.time() - start
+    print 'migration to binary: %.2fs, %d bytes used' % (
+        elapsed, r.info('memory')['used_memory'] - baseline)
+    r.flushdb()
+
+
+def instrumentation(args):
+    settings = config.from_args(args)
+    plain = redis.Redis(connection_pool=config.pool(settings))
+    counted = metrics.Redis(
+        metrics.Counter('commands', '', ['command']),
+        metrics.Counter('operations', '', ['operation']),
+        connection_pool=config.pool(settings))
+    histogram = metrics.Histogram('seconds', '', ['method'])
+    plain.flushdb()
+    random.seed(0)
+
+    def noop():
+        pass
+
+    calls = 100000
+    timed = metrics.timed(histogram)(noop)
+    print '%-36s %12s %12s' % ('', 'plain', 'instrumented')
+    (plain_time, counted_time) = [measure(
+        lambda: [f() for i in range(calls)], args.repeat)[0]
+        for f in (noop, timed)]
+    print '%-36s %12.2f %12.2f' % (
+        'call (us)', plain_time / calls * 1e6, counted_time / calls * 1e6)
+
+    commands = 10000
+    (plain_time, counted_time) = [measure(
+        lambda: [r.get('bench') for i in range(commands)], args.repeat)[0]
+        for r in (plain, counted)]
+    print '%-36s %12.2f %12.2f' % (
+        'GET (us)', plain_time / commands * 1e6,
+        counted_time / commands * 1e6)
+
+    macs = [random_mac() for i in range(args.devices)]
+    api.WifiData(plain).delta(macs, [])
+    for fields in [['joined', 'count'], None]:
+        (plain_time, counted_time) = [measure(
+            lambda: api.WifiData(r).macs(fields=fields), args.repeat)[0]
+            for r in (plain, counted)]
+        print '%-36s %12.2f %12.2f' % (
+            '/MAC %s of %d (ms)' % (','.join(fields or ['all']), len(macs)),
+            plain_time * 1000, counted_time * 1000)
+    (plain_time, counted_time) = [measure(
+        lambda: api.WifiData(r).bulk(macs), args.repeat)[0]
+        for r in (plain, counted)]
+    print '%-36s %12.2f %12.2f' % (
+        'bulk of %d (ms)' % len(macs), plain_time * 1000,
+        counted_time * 1000)
+
+    for i in range(calls / 10):
+        histogram.observe(('method %d' % (i % 20), ), random.random())
+    registry = metrics.Registry()
+    registry.add(histogram)
+    print 'rendering 20 histograms: %.2fms' % (
+        measure(registry.render, args.repeat)[0] * 1000)
+    plain.flushdb()
+
+
+def percentile(values, p):
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def load(args):
+    (host, port) = (args.server.split(':') + ['9000'])[:2]
+    paths = args.paths.split(',')
+    results = dict((path, ([], [0])) for path in paths)
+
+    def client(path):
+        (latencies, errors) = results[path]
+        conn = httplib.HTTPConnection(host, int(port), timeout=60)
+        for i in range(args.requests / args.concurrency):
+            start = time.time()
+            try:
+                conn.request('GET', path)
+                res = conn.getresponse()
+                res.read()
+                if res.status != 200:
+                    errors[0] += 1
+            except (httplib.HTTPException, IOError):
+                errors[0] += 1
+                conn.close()
+                conn = httplib.HTTPConnection(host, int(port), timeout=60)
+                continue
+            latencies.append(time.time() - start)
+        conn.close()
+
+    # every path is requested at the same time, as a mixed workload
+    threads = [threading.Thread(target=client, args=(path,))
+               for path in paths for i in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    print '%-16s %8s %8s %10s %10s %10s %10s' % (
+        'path', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)',
+        'max (ms)')
+    for path in paths:
+        (latencies, errors) = results[path]
+        latencies.sort()
+        if not latencies:
+            print '%-16s %8d %8d' % (path, 0, errors[0])
+            continue
+        print '%-16s %8d %8d %10.1f %10.2f %10.2f %10.2f' % (
+            path, len(latencies), errors[0], len(latencies) / elapsed,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000)
+
+
+def servers(args):
+    # api.py started on its own, gevent has to patch before any import
+    r = config.client(config.from_args(args))
+    options = ['-db', str(args.db)]
+    for (option, value) in [('-config', args.config),
+                            ('-redis_host', args.redis_host),
+                            ('-redis_port', args.redis_port),
+                            ('-redis_socket', args.redis_socket)]:
+        if value is not None:
+            options += [option, str(value)]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api.py')
+    args.server = 'localhost:%d' % args.port
+    for server in args.servers.split(','):
+        r.flushdb()
+        populate_macs(api.WifiData(r), args.macs)
+        # api.py logs in the current directory
+        directory = tempfile.mkdtemp()
+        process = subprocess.Popen(
+            [sys.executable, path, '-push', '-server', server, '-port',
+             str(args.port)] + options,
+            cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        started = False
+        for i in range(100):
+            if process.poll() is not None:
+                break
+            try:
+                conn = httplib.HTTPConnection('localhost', args.port)
+                conn.request('GET', '/ping')
+                started = conn.getresponse().status == 200
+                conn.close()
+            except (httplib.HTTPException, IOError):
+                pass
+            if started:
+                break
+            time.sleep(0.1)
+        print '-server %s' % server
+        if started:
+            load(args)
+        else:
+            print 'failed to start'
+        if process.poll() is None:
+            process.terminate()
+        output = process.communicate()[0]
+        if not started:
+            print output
+        shutil.rmtree(directory)
+    r.flushdb()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks, run against a scratch Redis database')
+    # a scratch database, flushed by the benchmarks
+    config.add_arguments(parser, db=15)
+    parser.add_argument('-repeat', default=3, type=int)
+
+    subparsers = parser.add_subparsers()
+
+    macs_info_parser = subparsers.add_parser(
+        'macs_info', help='WifiData._macs_info round trips and latency')
+    macs_info_parser.add_argument('-sizes', default='10,100,1000,5000')
+    macs_info_parser.set_defaults(func=macs_info)
+
+    leases_parser = subparsers.add_parser(
+        'leases', help='LeaseWatcher against synthetic dnsmasq.leases files')
+    leases_parser.add_argument('-sizes', default='100,1000,10000,50000')
+    leases_parser.set_defaults(func=leases)
+
+    oui_parser = subparsers.add_parser(
+        'oui', help='OuiIndex build, load, memory and lookups')
+    oui_parser.add_argument(
+        '-count',
+        default=30000,
+        type=int,
+        help='MA-L assignments of the synthetic registry')
+    oui_parser.add_argument('-lookups', default=100000, type=int)
+    oui_parser.add_argument(
+        'files',
+        nargs='*',
+        help='IEEE registry files instead of a synthetic one')
+    oui_parser.set_defaults(func=oui_index)
+
+    agent_store_parser = subparsers.add_parser(
+        'agent_store',
+        help='agent datastore updates against a growing session history')
+    agent_store_parser.add_argument(
+        '-sizes',
+        default='10000,100000,1000000',
+        help='closed sessions in the history')
+    agent_store_parser.add_argument('-devices', default=5000, type=int)
+    agent_store_parser.add_argument(
+        '-open',
+        default=50,
+        type=int,
+        help='devices currently associated')
+    agent_store_parser.set_defaults(func=agent_store)
+
+    load_parser = subparsers.add_parser(
+        'load', help='latency of a running API server under concurrent load')
+    load_parser.add_argument('-server', default='localhost:9000')
+    load_parser.add_argument('-paths', default='/status.gif,/MAC')
+    load_parser.add_argument(
+        '-concurrency',
+        default=8,
+        type=int,
+        help='connections per path')
+    load_parser.add_argument(
+        '-requests',
+        default=800,
+        type=int,
+        help='requests per path')
+    load_parser.set_defaults(func=load)
+
+    servers_parser = subparsers.add_parser(
+        'servers', help='load on api.py started with each -server')
+    servers_parser.add_argument('-servers', default='threaded,gevent')
+    servers_parser.add_argument('-port', default=9098, type=int)
+    servers_parser.add_argument('-macs', default=500, type=int)
+    servers_parser.add_argument('-paths', default='/status.gif,/MAC')
+    servers_parser.add_argument(
+        '-concurrency',
+        default=8,
+        type=int,
+        help='connections per path')
+    servers_parser.add_argument(
+        '-requests',
+        default=800,
+        type=int,
+        help='requests per path')
+    servers_parser.set_defaults(func=servers)
+
+    migration_parser = subparsers.add_parser(
+        'migration',
+        help='hash to sorted set migration, one zadd per member against '
+             'migrate.py')
+    migration_parser.add_argument('-size', default=1000000, type=int)
+    migration_parser.add_argument(
+        '-legacy_size',
+        default=10000,
+        type=int,
+        help='members copied one zadd at a time')
+    migration_parser.add_argument('-batches', default='100,1000,10000')
+    migration_parser.set_defaults(func=migration)
+
+    client_parser = subparsers.add_parser(
+        'client', help='client.py against a local stub API server')
+    client_parser.add_argument('-port', default=9098, type=int)
+    client_parser.add_argument('-macs', default=200, type=int)
+    client_parser.add_argument(
+        '-delay',
+        default=0.002,
+        type=float,
+        help='simulated round trip of the stub, in seconds')
+    client_parser.add_argument('-connections', default=8, type=int)
+    client_parser.set_defaults(func=api_client)
+
+    export_parser = subparsers.add_parser(
+        'export', help='export.py against per-record loops, synthetic history')
+    export_parser.add_argument('-days', default=365, type=int)
+    export_parser.add_argument('-devices', default=200, type=int)
+    export_parser.add_argument(
+        '-gap',
+        default=6 * 3600,
+        type=int,
+        help='mean seconds between sessions of a device')
+    export_parser.add_argument(
+        '-step', default=60, type=int, help='seconds between samples')
+    export_parser.set_defaults(func=history_export)
+
+    mac_format_parser = subparsers.add_parser(
+        'mac_format', help='Redis memory with MACs stored as text or bytes')
+    mac_format_parser.add_argument('-devices', default=100000, type=int)
+    mac_format_parser.set_defaults(func=mac_format)
+
+    metrics_parser = subparsers.add_parser(
+        'metrics', help='overhead of the /metrics instrumentation')
+    metrics_parser.add_argument('-devices', default=1000, type=int)
+    metrics_parser.set_defaults(func=instrumentation)
+
+    events_parser = subparsers.add_parser(
+        'events', help='/events fan-out latency to concurrent clients')
+    events_parser.add_argument('-port', default=9099, type=int)
+    events_parser.add_argument('-clients', default=50, type=int)
+    events_parser.add_argument('-events', default=200, type=int)
+    events_parser.add_argument(
+        '-spacing',
+        default=0.01,
+        type=float,
+        help='seconds between events')
+    events_parser.add_argument('-macs', default=500, type=int)
+    events_parser.add_argument(
+        '-poll',
+        default=5,
+        type=float,
+        help='dashboard polling interval compared with')
+    events_parser.set_defaults(func=events)
+
+    args = parser.parse_args()
+    args.func(args)
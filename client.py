@@ -1,113 +1,255 @@
 #!/usr/bin/env python
-import urllib
-import json
-import httplib
 import argparse
-import dateutil.parser
+import collections
 import datetime
+import httplib
+import json
+import Queue
+import socket
+import threading
 import time
+import urllib
 
-class Client():
+import dateutil.parser
+
+CONNECTIONS = 8
+TIMEOUT = 30
+# attempts after the first one, waiting RETRY_DELAY then twice as long
+RETRIES = 3
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5
+RETRY_STATUSES = (502, 503, 504)
+
+Mac = collections.namedtuple(
+    'Mac',
+    ['mac', 'joined', 'left', 'count', 'oui', 'ip', 'hostname', 'uptime'])
+Page = collections.namedtuple('Page', ['macs', 'next'])
+Delta = collections.namedtuple('Delta', ['joined', 'left'])
+Agent = collections.namedtuple(
+    'Agent', ['last', 'delta', 'total', 'ping', 'started', 'active'])
 
-    def __init__(self, hostname=None, port=None, protocol='http'):
-        self.hostname = hostname
-        self.port = port
-        self.protocol = protocol
 
-    def _delete(self, uri):
-        conn = httplib.HTTPConnection(self.hostname, self.port)
-        conn.request('DELETE', uri)
-        resp = conn.getresponse()
-        content = resp.read()
-        return content
+def address(mac):
+    # of a MAC or of the Mac of a page, so pages can be passed back
+    return mac.mac if isinstance(mac, Mac) else mac
 
-    def _url(self, uri):
-        return "%s://%s:%s%s" % (self.protocol, self.hostname, self.port, uri)
 
-    def _get(self, uri):
-        url = self._url(uri)
-        f = urllib.urlopen(url)
-        output = f.read()
-        return output
+class ApiError(Exception):
+    def __init__(self, status, reason, body):
+        Exception.__init__(self, '%d %s' % (status, reason))
+        self.status = status
+        self.body = body
+
+
+class Client():
+    # Threads share up to `connections` persistent connections. Requests
+    # that can't reach the server or get a 502, 503 or 504 are retried.
+    def __init__(self, hostname=None, port=None, protocol='http',
+                 connections=CONNECTIONS, timeout=TIMEOUT, retries=RETRIES):
+        self.hostname = hostname
+        self.port = port
+        self.protocol = protocol
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.Semaphore(connections)
 
     def join(self, mac):
-        if mac is object:
-            mac = mac.mac
-        uri = '/MAC/%s' % mac
-        return self._get(uri)
+        return self.join_many([mac])
+
+    def join_many(self, macs):
+        return self._delta(['+%s' % address(mac) for mac in macs])
 
     def left(self, mac):
-        if mac is object:
-            mac = mac.mac
-        uri = '/MAC/%s' % mac
-        return self._delete(uri)
+        return self.left_many([mac])
+
+    def left_many(self, macs):
+        return self._delta(['-%s' % address(mac) for mac in macs])
 
     def purge(self, mac):
-        uri = '/MAC/purge/%s' % mac
-        return self._delete(uri)
+        self._request('DELETE', '/MAC/purge/%s' % address(mac))
+
+    def purge_many(self, macs):
+        self.map(self.purge, macs)
 
     def count(self):
-        uri = '/MAC/count'
-        return self._get(uri)
+        return int(self._request('GET', '/MAC/count'))
 
-    def excluded(self):
-        uri = '/MAC/excluded'
-        return self._get(uri)
+    def excluded(self, offset=0, limit=None, fields=None, after=None):
+        return self._page('/MAC/excluded', offset, limit, fields, after)
 
-    def macs(self):
-        uri = '/MAC'
-        return self._get(uri)
+    def macs(self, offset=0, limit=None, fields=None, after=None):
+        return self._page('/MAC', offset, limit, fields, after)
 
     def agent(self):
-        uri = '/agent'
-        return self._get(uri)
+        agent = self._json('/agent')['agent']
+        return Agent(*[agent.get(field) for field in Agent._fields])
 
     def ping(self):
-        uri = '/ping'
-        return self._get(uri)
+        self._request('GET', '/ping')
+
+    def query(self, start_timestamp, end_timestamp, offset=0, limit=None,
+              fields=None, after=None):
+        uri = '/MAC/%r/%r' % (float(start_timestamp), float(end_timestamp))
+        return self._page(uri, offset, limit, fields, after)
+
+    def query_many(self, ranges):
+        return self.map(lambda r: self.query(*r), ranges)
+
+    def map(self, func, items):
+        # func(item) for every item on as many threads as connections,
+        # results in the order of the items, the first error is raised
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+        pending = Queue.Queue()
+        for i in range(len(items)):
+            pending.put(i)
+
+        def worker():
+            while not errors:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(items[i])
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.connections, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def _delta(self, lines):
+        result = json.loads(self._request(
+            'POST', '/assoclist?mode=delta', '\n'.join(lines),
+            {'Content-Type': 'text/plain'}))
+        return Delta(result.get('joined', []), result.get('left', []))
+
+    def _page(self, uri, offset, limit, fields, after):
+        # the next of a page is the after of the following one
+        params = {}
+        if offset:
+            params['offset'] = offset
+        if after is not None:
+            params['after'] = after
+        if limit is not None:
+            params['limit'] = limit
+        if fields is not None:
+            params['fields'] = ','.join(fields)
+        if params:
+            uri += '?' + urllib.urlencode(params)
+        result = self._json(uri)
+        macs = [Mac(mac, *[info.get(field) for field in Mac._fields[1:]])
+                for (mac, info) in sorted(result.get('mac', {}).items())]
+        return Page(macs, result.get('next'))
+
+    def _json(self, uri):
+        return json.loads(self._request('GET', uri))
+
+    def _request(self, method, uri, body=None, headers={}):
+        delay = RETRY_DELAY
+        attempt = 0
+        while True:
+            attempt += 1
+            self.slots.acquire()
+            try:
+                conn = self.idle.get_nowait()
+            except Queue.Empty:
+                conn = self._connect()
+            try:
+                conn.request(method, uri, body, headers)
+                resp = conn.getresponse()
+                content = resp.read()
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed an idle connection, the next
+                # request on it reconnects
+                conn.close()
+                if attempt > self.retries:
+                    raise
+            else:
+                if resp.status not in RETRY_STATUSES or \
+                        attempt > self.retries:
+                    if resp.status >= 400:
+                        raise ApiError(resp.status, resp.reason, content)
+                    return content
+            finally:
+                self.idle.put(conn)
+                self.slots.release()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def _connect(self):
+        if self.protocol == 'https':
+            return httplib.HTTPSConnection(
+                self.hostname, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(
+            self.hostname, self.port, timeout=self.timeout)
 
-    def query(self, start_timestamp, end_timestamp):
-        uri = '/MAC/%s/%s' % (start_timestamp, end_timestamp)
-        return self._get(uri)
 
 def from_timestamp_to_date(u):
     return datetime.datetime.utcfromtimestamp(u)
 
+
 def from_date_to_timestamp(d):
     return time.mktime(d.timetuple())
 
+
 def join(args):
-    return client.join(args.mac)
+    return client.join_many(args.mac)
+
 
 def query(args):
     start_date = dateutil.parser.parse(args.start)
     end_date = dateutil.parser.parse(args.end)
     start_timestamp = from_date_to_timestamp(start_date)
     end_timestamp = from_date_to_timestamp(end_date)
-    #print 'from: %s (%s) to %s (%s)' % (start_date, start_timestamp, end_date, end_timestamp)
     return client.query(start_timestamp, end_timestamp)
 
+
 def left(args):
-    return client.left(args.mac)
+    return client.left_many(args.mac)
+
 
 def purge(args):
-    return client.purge(args.mac)
+    return client.purge_many(args.mac)
+
 
 def list_macs(args):
     return client.macs()
 
+
 def agent(args):
     return client.agent()
 
+
 def count(args):
     return client.count()
 
+
 def ping(args):
     return client.ping()
 
+
 def excluded_list_macs(args):
     return client.excluded()
 
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -118,12 +260,16 @@ if __name__ == '__main__':
         '-port',
         default='9000',
         help='port for API')
+    parser.add_argument(
+        '-connections',
+        default=CONNECTIONS,
+        type=int,
+        help='concurrent requests of purge')
 
     subparsers = parser.add_subparsers()
 
-
-    join_parser = subparsers.add_parser('join', help='join MAC')
-    join_parser.add_argument('mac', help='mac address')
+    join_parser = subparsers.add_parser('join', help='join MACs')
+    join_parser.add_argument('mac', nargs='+', help='mac address')
     join_parser.set_defaults(func=join)
 
     query_parser = subparsers.add_parser('query', help='query MAC')
@@ -131,12 +277,12 @@ if __name__ == '__main__':
     query_parser.add_argument('end', help='end timestamp')
     query_parser.set_defaults(func=query)
 
-    left_parser = subparsers.add_parser('left', help='left MAC')
-    left_parser.add_argument('mac', help='mac address')
+    left_parser = subparsers.add_parser('left', help='left MACs')
+    left_parser.add_argument('mac', nargs='+', help='mac address')
     left_parser.set_defaults(func=left)
 
-    purge_parser = subparsers.add_parser('purge', help='purge MAC')
-    purge_parser.add_argument('mac', help='mac address')
+    purge_parser = subparsers.add_parser('purge', help='purge MACs')
+    purge_parser.add_argument('mac', nargs='+', help='mac address')
     purge_parser.set_defaults(func=purge)
 
     count_parser = subparsers.add_parser('count', help='count MAC')
@@ -145,7 +291,8 @@ if __name__ == '__main__':
     list_parser = subparsers.add_parser('list', help='list MAC')
     list_parser.set_defaults(func=list_macs)
 
-    excluded_list_parser = subparsers.add_parser('excluded', help='excluded MAC')
+    excluded_list_parser = subparsers.add_parser(
+        'excluded', help='excluded MAC')
     excluded_list_parser.set_defaults(func=excluded_list_macs)
 
     agent_parser = subparsers.add_parser('agent', help='agent information')
@@ -157,6 +304,6 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     global client
-    client = Client(args.hostname, args.port)
+    client = Client(args.hostname, args.port, connections=args.connections)
 
-    print args.func(args)
\ No newline at end of file
+    print args.func(args)
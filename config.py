@@ -0,0 +1,147 @@
+import ConfigParser
+import inspect
+import os
+import threading
+import time
+
+import redis
+
+# name, parser, default of the [redis] settings. A file given with -config
+# or WIFI_CONFIG is read first, then WIFI_REDIS_<NAME> environment
+# variables, then the command line.
+SETTINGS = [
+    ('host', str, 'localhost'),
+    ('port', int, 6379),
+    ('db', int, 0),
+    ('password', str, None),
+    ('unix_socket_path', str, None),
+    ('socket_timeout', float, 5),
+    ('socket_connect_timeout', float, 2),
+    ('retry_on_timeout', lambda s: s.lower() in ('1', 'true', 'yes', 'on'),
+     True),
+    ('max_connections', int, 64),
+    # seconds to wait for a free connection
+    ('pool_timeout', float, 20),
+]
+ENV_PREFIX = 'WIFI_REDIS_'
+# a free connection is handed out in microseconds, longer is a wait
+WAIT_THRESHOLD = 0.001
+
+
+def load(filename=None, environ=os.environ):
+    settings = dict((name, default) for (name, parse, default) in SETTINGS)
+    filename = filename or environ.get('WIFI_CONFIG')
+    if filename:
+        parser = ConfigParser.SafeConfigParser()
+        if not parser.read(filename):
+            raise IOError('Unable to read %s' % filename)
+        if parser.has_section('redis'):
+            for (name, parse, default) in SETTINGS:
+                if parser.has_option('redis', name):
+                    settings[name] = parse(parser.get('redis', name))
+    for (name, parse, default) in SETTINGS:
+        if ENV_PREFIX + name.upper() in environ:
+            settings[name] = parse(environ[ENV_PREFIX + name.upper()])
+    return settings
+
+
+def add_arguments(parser, db=None):
+    parser.add_argument(
+        '-config', help='file with a [redis] section, WIFI_CONFIG otherwise')
+    parser.add_argument('-redis_host')
+    parser.add_argument('-redis_port', type=int)
+    parser.add_argument('-redis_socket', help='unix socket path')
+    parser.add_argument('-db', default=db, type=int)
+
+
+def from_args(args, **overrides):
+    settings = load(args.config)
+    for (name, value) in [('host', args.redis_host),
+                          ('port', args.redis_port),
+                          ('unix_socket_path', args.redis_socket),
+                          ('db', args.db)]:
+        if value is not None:
+            settings[name] = value
+    settings.update(overrides)
+    return settings
+
+
+class Pool(redis.BlockingConnectionPool):
+    # Callers wait up to timeout seconds for a free connection instead of
+    # opening more than max_connections, stats() tells how often they do.
+    def __init__(self, *args, **kwargs):
+        redis.BlockingConnectionPool.__init__(self, *args, **kwargs)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            return redis.BlockingConnectionPool.get_connection(
+                self, command_name, *keys, **options)
+        except redis.ConnectionError:
+            with self.lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with self.lock:
+                self.requests += 1
+                if waited >= WAIT_THRESHOLD:
+                    self.waits += 1
+                    self.wait_seconds += waited
+                    self.max_wait = max(self.max_wait, waited)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_connections': self.max_connections,
+                'connections': len(self._connections),
+                'in_use': self.max_connections - self.pool.qsize(),
+                'requests': self.requests,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'max_wait': self.max_wait,
+                'timeouts': self.timeouts,
+            }
+
+
+def connection_kwargs(settings):
+    kwargs = {
+        'db': settings['db'],
+        'password': settings['password'],
+        'socket_timeout': settings['socket_timeout'],
+    }
+    if settings['unix_socket_path']:
+        kwargs['connection_class'] = redis.UnixDomainSocketConnection
+        kwargs['path'] = settings['unix_socket_path']
+    else:
+        kwargs['host'] = settings['host']
+        kwargs['port'] = settings['port']
+    # only known to newer redis clients, older ones connect within
+    # socket_timeout and always retry a command once after a timeout
+    accepted = inspect.getargspec(
+        kwargs.get('connection_class', redis.Connection).__init__).args
+    for name in ('socket_connect_timeout', 'retry_on_timeout'):
+        if name in accepted:
+            kwargs[name] = settings[name]
+    return kwargs
+
+
+def pool(settings, connection_class=None):
+    kwargs = connection_kwargs(settings)
+    if connection_class is not None:
+        kwargs['connection_class'] = connection_class
+    return Pool(max_connections=settings['max_connections'],
+                timeout=settings['pool_timeout'], **kwargs)
+
+
+def client(settings=None, **overrides):
+    if settings is None:
+        settings = load()
+    settings = dict(settings, **overrides)
+    return redis.Redis(connection_pool=pool(settings))
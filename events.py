@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import argparse
+import socket
+import time
+
+import redis
+
+import api
+import config
+
+BATCH = 1000
+# milliseconds a projector waits for new events
+BLOCK = 5000
+
+
+def source(args):
+    return config.client(config.from_args(args))
+
+
+def target(args):
+    settings = config.from_args(args)
+    if args.target_db == settings['db']:
+        raise SystemExit('The target database must not be the source one')
+    return config.client(settings, db=args.target_db)
+
+
+def projection(r, target):
+    # the target stores MACs like the source
+    key = api.prefix('mac-format')
+    target.set(key, r.get(key) or api.TEXT.name)
+    return api.WifiData(target)
+
+
+def after(id):
+    # first possible id following id
+    (ms, seq) = api.stream_id(id)
+    return '%d-%d' % (ms, seq + 1)
+
+
+def read(r, stream, start):
+    return api.parse_entries(r.execute_command(
+        'XRANGE', stream, start, '+', 'COUNT', BATCH))
+
+
+def show(event, mac_format):
+    (id, name, mac, t, fresh) = event
+    print '%s %s %-7s %s%s' % (
+        id, api.unix_to_iso8601(t), name, mac_format.decode(mac),
+        ' (fresh)' if fresh == '1' else '')
+
+
+def tail(args):
+    r = source(args)
+    mac_format = api.WifiData(r).mac_format
+    stream = api.prefix('events')
+    start = args.start
+    while True:
+        events = read(r, stream, start)
+        for event in events:
+            show(event, mac_format)
+        if events:
+            start = after(events[-1][0])
+        elif not args.follow:
+            break
+        else:
+            time.sleep(1)
+
+
+def rebuild(args):
+    r = source(args)
+    t = target(args)
+    if args.flush:
+        t.flushdb()
+    elif t.dbsize():
+        raise SystemExit('Database %d is not empty, use -flush'
+                         % args.target_db)
+    data = projection(r, t)
+    stream = api.prefix('events')
+    started = time.time()
+    count = 0
+    start = '-'
+    held = []
+    while True:
+        events = read(r, stream, start)
+        count += len(events)
+        held = data.project(held + events, len(events) < BATCH)
+        if len(events) < BATCH:
+            break
+        start = after(events[-1][0])
+    elapsed = time.time() - started
+    print '%d events projected into database %d in %.2fs (%d/s)' % (
+        count, args.target_db, elapsed, count / max(elapsed, 0.001))
+    live = api.WifiData(r)
+    for (name, key, size) in [
+            ('active', live.active_mac_set, redis.Redis.scard),
+            ('excluded', live.excluded_mac_set, redis.Redis.scard),
+            ('count', live.mac_to_count_hash, redis.Redis.hlen),
+            ('join-by-timestamp', live.join_mac_by_timestamp_z,
+             redis.Redis.zcard),
+            ('left-by-timestamp', live.left_mac_by_timestamp_z,
+             redis.Redis.zcard)]:
+        print '%-20s live %8d rebuilt %8d' % (
+            name, size(r, key), size(data.r, key))
+
+
+def claim(r, stream, group, consumer):
+    # events left unacknowledged by other consumers of the group, an older
+    # projector or one started under another name, are taken over
+    consumers = r.execute_command('XINFO', 'CONSUMERS', stream, group)
+    for info in consumers:
+        name = dict(zip(info[::2], info[1::2]))['name']
+        if name == consumer:
+            continue
+        while True:
+            pending = r.execute_command(
+                'XPENDING', stream, group, '-', '+', BATCH, name)
+            if not pending:
+                break
+            r.execute_command('XCLAIM', stream, group, consumer, 0,
+                              *[p[0] for p in pending] + ['JUSTID'])
+        r.execute_command('XGROUP', 'DELCONSUMER', stream, group, name)
+
+
+def project(args):
+    r = source(args)
+    data = projection(r, target(args))
+    stream = api.prefix('events')
+    try:
+        r.execute_command('XGROUP', 'CREATE', stream, args.group, args.start,
+                          'MKSTREAM')
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+    claim(r, stream, args.group, args.consumer)
+    # events delivered to this consumer but not acknowledged, then new ones
+    last = '0'
+    held = []
+    while True:
+        reply = r.execute_command(
+            'XREADGROUP', 'GROUP', args.group, args.consumer, 'COUNT', BATCH,
+            'BLOCK', BLOCK, 'STREAMS', stream, last)
+        events = api.parse_entries(reply[0][1]) if reply else []
+        if last != '>':
+            if not events:
+                last = '>'
+                continue
+            last = events[-1][0]
+        if not events and not held:
+            if args.once:
+                break
+            continue
+        # a full batch may end in the middle of a reconciliation
+        events = held + events
+        held = data.project(events, len(events) - len(held) < BATCH)
+        applied = events[:len(events) - len(held)]
+        if applied:
+            r.execute_command(
+                'XACK', stream, args.group, *[e[0] for e in applied])
+            print '%d events projected up to %s' % (
+                len(applied), applied[-1][0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay the wifi|events log or project it into another '
+                    'database')
+    config.add_arguments(parser)
+
+    subparsers = parser.add_subparsers()
+
+    tail_parser = subparsers.add_parser('tail', help='print the log')
+    tail_parser.add_argument('-start', default='-', help='first event id')
+    tail_parser.add_argument('-follow', action='store_true')
+    tail_parser.set_defaults(func=tail)
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild',
+        help='rebuild presence, counts, join/left timestamps and rollups '
+             'from the whole log')
+    rebuild_parser.add_argument('-target_db', required=True, type=int)
+    rebuild_parser.add_argument(
+        '-flush', action='store_true', help='empty the target database first')
+    rebuild_parser.set_defaults(func=rebuild)
+
+    project_parser = subparsers.add_parser(
+        'project',
+        help='keep another database up to date from the log, as a consumer '
+             'group; events are applied in order, use a single consumer')
+    project_parser.add_argument('-target_db', required=True, type=int)
+    project_parser.add_argument('-group', default='projector')
+    project_parser.add_argument('-consumer', default=socket.gethostname())
+    project_parser.add_argument(
+        '-start',
+        default='0',
+        help='first event of a new group, 0 for the whole log or $ for new '
+             'events only')
+    project_parser.add_argument(
+        '-once', action='store_true', help='stop once caught up')
+    project_parser.set_defaults(func=project)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import socket
+import struct
+import time
+
+import numpy
+
+import api
+import config
+
+BATCH = 1000
+SESSION_DTYPE = numpy.dtype([
+    ('mac', 'u8'), ('start', 'f8'), ('end', 'f8'), ('open', '?')])
+MAC_DTYPE = numpy.dtype([
+    ('mac', 'u8'), ('joined', 'f8'), ('left', 'f8'), ('count', 'u4'),
+    ('ip', 'u4'), ('hostname', 'S64')])
+
+
+def mac_to_int(mac):
+    return int(mac.replace(':', ''), 16)
+
+
+def int_to_mac(i):
+    h = '%012X' % i
+    return ':'.join([h[j:j + 2] for j in range(0, 12, 2)])
+
+
+def ip_to_int(ip):
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return 0
+
+
+def int_to_ip(i):
+    return socket.inet_ntoa(struct.pack('!I', i))
+
+
+def scan_keys(r, pattern, batch=BATCH):
+    cursor = '0'
+    while True:
+        (cursor, keys) = r.execute_command(
+            'SCAN', cursor, 'MATCH', pattern, 'COUNT', batch)
+        if keys:
+            yield keys
+        if cursor == '0':
+            return
+
+
+def scan(r, command, keys, batch=BATCH):
+    # (key, flat reply) of HSCAN or ZSCAN over each key, the first chunk
+    # of every key in one pipeline, big keys continue one chunk at a time
+    m = r.pipeline(transaction=False)
+    for key in keys:
+        m.execute_command(command, key, '0', 'COUNT', batch)
+    for (key, (cursor, flat)) in zip(keys, m.execute()):
+        while True:
+            yield (key, flat)
+            if cursor == '0':
+                break
+            (cursor, flat) = r.execute_command(
+                command, key, cursor, 'COUNT', batch)
+
+
+def scan_dict(r, command, key, batch=BATCH):
+    result = {}
+    for (key, flat) in scan(r, command, [key], batch):
+        result.update(zip(flat[::2], flat[1::2]))
+    return result
+
+
+def export_sessions(data, now, batch=BATCH):
+    macs = []
+    counts = []
+    members = []
+    pattern = data.sessions_prefix.replace('*', '\\*') + '*'
+    for keys in scan_keys(data.r, pattern, batch):
+        for (key, flat) in scan(data.r, 'ZSCAN', keys, batch):
+            # members are "start end", scores the end
+            macs.append(mac_to_int(data.mac_format.decode(
+                key[len(data.sessions_prefix):])))
+            counts.append(len(flat) / 2)
+            members.extend(flat[::2])
+    opened = scan_dict(data.r, 'HSCAN', data.session_open_hash, batch)
+    sessions = numpy.zeros(len(members) + len(opened), SESSION_DTYPE)
+    closed = numpy.array(' '.join(members).split(), 'f8').reshape(-1, 2)
+    sessions['mac'][:len(members)] = numpy.repeat(
+        numpy.array(macs, 'u8'), counts)
+    sessions['start'][:len(members)] = closed[:, 0]
+    sessions['end'][:len(members)] = closed[:, 1]
+    sessions['mac'][len(members):] = [
+        mac_to_int(data.mac_format.decode(mac)) for mac in opened]
+    sessions['start'][len(members):] = [float(s) for s in opened.values()]
+    sessions['end'][len(members):] = now
+    sessions['open'][len(members):] = True
+    # scanning may return a member twice
+    return numpy.unique(sessions)
+
+
+def export_macs(data, batch=BATCH):
+    (joined, left, count, ip, hostname) = [
+        scan_dict(data.r, command, key, batch) for (command, key) in [
+            ('ZSCAN', data.join_mac_by_timestamp_z),
+            ('ZSCAN', data.left_mac_by_timestamp_z),
+            ('HSCAN', data.mac_to_count_hash),
+            ('HSCAN', data.mac_to_ip_hash),
+            ('HSCAN', data.mac_to_hostname_hash)]]
+    names = sorted(set(joined) | set(left) | set(count))
+    macs = numpy.zeros(len(names), MAC_DTYPE)
+    macs['mac'] = [mac_to_int(data.mac_format.decode(mac)) for mac in names]
+    macs['joined'] = [float(joined.get(mac, 0)) for mac in names]
+    macs['left'] = [float(left.get(mac, 0)) for mac in names]
+    macs['count'] = [int(count.get(mac, 0)) for mac in names]
+    macs['ip'] = [ip_to_int(ip.get(mac)) for mac in names]
+    macs['hostname'] = [hostname.get(mac, '')[:64] for mac in names]
+    return macs
+
+
+def export(data, filename, batch=BATCH):
+    now = time.time()
+    sessions = export_sessions(data, now, batch)
+    macs = export_macs(data, batch)
+    numpy.savez_compressed(
+        filename, sessions=sessions, macs=macs, exported=now)
+    return (sessions, macs)
+
+
+def load(filename):
+    f = numpy.load(filename)
+    return (f['sessions'], f['macs'], float(f['exported']))
+
+
+def concurrency(sessions, times):
+    # devices present at each of the times
+    starts = numpy.sort(sessions['start'])
+    ends = numpy.sort(sessions['end'])
+    return numpy.searchsorted(starts, times, 'right') - \
+        numpy.searchsorted(ends, times, 'right')
+
+
+def durations(sessions):
+    return sessions['end'] - sessions['start']
+
+
+def dwell_histogram(sessions, bins):
+    return numpy.histogram(durations(sessions), bins)
+
+
+def dwell_by_mac(sessions, start=None, end=None):
+    # (macs, seconds present between start and end)
+    s = sessions['start']
+    e = sessions['end']
+    if start is not None:
+        s = numpy.maximum(s, start)
+    if end is not None:
+        e = numpy.minimum(e, end)
+    (macs, index) = numpy.unique(sessions['mac'], return_inverse=True)
+    return (macs, numpy.bincount(index, numpy.maximum(e - s, 0),
+                                 len(macs)))
+
+
+def weekday_hour(sessions, start, end, step=60):
+    # mean number of devices present by local weekday and hour, sampled
+    # every step seconds
+    times = numpy.arange(start, end, step)
+    present = concurrency(sessions, times)
+    # local weekday and hour of each UTC hour, they follow DST changes
+    first = int(start // 3600)
+    hours = (times // 3600).astype(int) - first
+    table = numpy.array([
+        (lambda d: d.weekday() * 24 + d.hour)(
+            datetime.datetime.fromtimestamp((first + h) * 3600))
+        for h in range(hours[-1] + 1 if len(hours) else 0)], int)
+    cells = table[hours]
+    total = numpy.bincount(cells, present, 7 * 24)
+    samples = numpy.bincount(cells, None, 7 * 24)
+    return (total / numpy.maximum(samples, 1)).reshape(7, 24)
+
+
+def summary(args):
+    started = time.time()
+    (sessions, macs, exported) = load(args.filename)
+    loaded = time.time() - started
+    start = args.start or sessions['start'].min()
+    end = args.end or exported
+    started = time.time()
+    times = numpy.arange(start, end, args.step)
+    present = concurrency(sessions, times)
+    d = durations(sessions)
+    heatmap = weekday_hour(sessions, start, end, args.step)
+    (devices, dwell) = dwell_by_mac(sessions, start, end)
+    elapsed = time.time() - started
+    print '%d sessions, %d devices, loaded in %.3fs, analysed in %.3fs' % (
+        len(sessions), len(macs), loaded, elapsed)
+    print 'from %s to %s' % (api.unix_to_iso8601(float(start)),
+                             api.unix_to_iso8601(float(end)))
+    peak = present.argmax()
+    print 'peak: %d devices at %s, mean %.1f' % (
+        present[peak], api.unix_to_iso8601(float(times[peak])),
+        present.mean())
+    print 'session minutes: p50 %.0f, p90 %.0f, p99 %.0f' % tuple(
+        numpy.percentile(d, [50, 90, 99]) / 60)
+    for i in dwell.argsort()[::-1][:args.top]:
+        print '%s %8.1f hours' % (int_to_mac(devices[i]), dwell[i] / 3600)
+    print '    ' + ''.join(['%5d' % h for h in range(24)])
+    for (day, row) in zip(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+                          heatmap):
+        print '%s ' % day + ''.join(['%5.1f' % v for v in row])
+
+
+def dump(args):
+    r = config.client(config.from_args(args))
+    started = time.time()
+    (sessions, macs) = export(api.WifiData(r), args.filename, args.batch)
+    print '%d sessions, %d devices exported to %s in %.2fs' % (
+        len(sessions), len(macs), args.filename, time.time() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the presence history to NumPy arrays and '
+                    'analyse it')
+    subparsers = parser.add_subparsers()
+
+    dump_parser = subparsers.add_parser(
+        'dump', help='write sessions and devices to a .npz file')
+    config.add_arguments(dump_parser)
+    dump_parser.add_argument(
+        '-batch', default=BATCH, type=int, help='entries read per SCAN')
+    dump_parser.add_argument('filename')
+    dump_parser.set_defaults(func=dump)
+
+    summary_parser = subparsers.add_parser(
+        'summary',
+        help='occupancy, session lengths, dwell and weekday/hour heatmap')
+    summary_parser.add_argument('-start', default=0, type=float)
+    summary_parser.add_argument(
+        '-end', default=0, type=float, help='the export time by default')
+    summary_parser.add_argument(
+        '-step', default=60, type=int, help='seconds between samples')
+    summary_parser.add_argument(
+        '-top', default=10, type=int, help='devices present the longest')
+    summary_parser.add_argument('filename')
+    summary_parser.set_defaults(func=summary)
+
+    args = parser.parse_args()
+    args.func(args)
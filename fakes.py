@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+import argparse
+import BaseHTTPServer
+import json
+import random
+import SocketServer
+import threading
+import time
+
+PROMPT = 'root@DD-WRT:~# '
+
+
+def random_mac():
+    return ':'.join(['%02X' % random.randint(0, 255) for i in range(6)])
+
+
+class RouterHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write('login: ')
+        self.rfile.readline()
+        if self.server.password:
+            self.wfile.write('Password: ')
+            if self.rfile.readline().strip() != self.server.password:
+                return
+        self.wfile.write(PROMPT)
+        for line in self.rfile:
+            command = line.strip()
+            if command == 'exit':
+                return
+            output = ''
+            if command == 'wl_atheros assoclist':
+                output = ''.join(['assoclist %s\r\n' % mac
+                                  for mac in self.server.assoclist()])
+            self.wfile.write('%s\r\n%s%s' % (command, output, PROMPT))
+
+
+class FakeRouter(SocketServer.ThreadingTCPServer):
+    # Telnet-ish DD-WRT shell answering `wl_atheros assoclist`, every call
+    # moves each device in or out of range with the churn probability.
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, devices=20, churn=0.0, password=None):
+        SocketServer.ThreadingTCPServer.__init__(self, address, RouterHandler)
+        self.password = password
+        self.churn = churn
+        self.devices = [random_mac() for i in range(devices)]
+        self.present = set(random.sample(self.devices, devices / 2))
+        self.lock = threading.Lock()
+
+    def assoclist(self):
+        with self.lock:
+            for mac in self.devices:
+                if random.random() < self.churn:
+                    self.present.symmetric_difference_update([mac])
+            return sorted(self.present)
+
+
+class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers are written one by one, don't wait for the client's ACK
+    # between responses of a persistent connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        # the round trip of the TCP handshake
+        time.sleep(self.server.delay)
+
+    def do_GET(self):
+        self.respond('')
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.respond(self.rfile.read(length))
+
+    def do_DELETE(self):
+        self.respond('')
+
+    def respond(self, body):
+        self.server.requests.append((self.command, self.path, body))
+        time.sleep(self.server.delay)
+        content = self.server.response
+        if 'mode=events' in self.path:
+            # acknowledges every event of the batch, like the real server
+            lines = body.split()
+            content = json.dumps({'acked': int(lines[-3]) if lines else 0})
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class FakeApi(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Records every request and how many connections carried them, delay
+    # simulates the network round trip
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, response='{}', verbose=False, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ApiHandler)
+        self.response = response
+        self.verbose = verbose
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fake router and API server for local agent runs')
+    subparsers = parser.add_subparsers()
+
+    router_parser = subparsers.add_parser('router', help='fake router')
+    router_parser.add_argument('-port', default=2323, type=int)
+    router_parser.add_argument('-devices', default=20, type=int)
+    router_parser.add_argument('-churn', default=0.05, type=float)
+    router_parser.add_argument('-password', default=None)
+    router_parser.set_defaults(
+        server=lambda args: FakeRouter(('localhost', args.port),
+                                       args.devices, args.churn,
+                                       args.password))
+
+    api_parser = subparsers.add_parser('api', help='fake API server')
+    api_parser.add_argument('-port', default=9000, type=int)
+    api_parser.add_argument(
+        '-delay', default=0, type=float, help='seconds per round trip')
+    api_parser.set_defaults(
+        server=lambda args: FakeApi(('localhost', args.port), verbose=True,
+                                    delay=args.delay))
+
+    args = parser.parse_args()
+    args.server(args).serve_forever()
@@ -0,0 +1,224 @@
+import bisect
+import functools
+import threading
+import time
+
+import redis
+import redis.client
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from a single Redis round trip to a slow listing
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+INF = float('inf')
+
+# names of the operations in progress on each thread, outermost first
+LOCAL = threading.local()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        ['%s="%s"' % (name, escape(value)) for (name, value) in pairs])
+
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == INF:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, values=(), amount=1):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(self.name, zip(self.labels, k), v) for (k, v) in values]
+
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count of each bucket and of +Inf, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, values, amount):
+        i = bisect.bisect_left(self.buckets, amount)
+        with self.lock:
+            counts = self.values.get(values)
+            if counts is None:
+                counts = self.values[values] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted([(k, list(v)) for (k, v) in self.values.items()])
+        samples = []
+        for (k, counts) in values:
+            pairs = zip(self.labels, k)
+            total = 0
+            for (le, count) in zip(self.buckets + (INF, ), counts):
+                total += count
+                samples.append(
+                    (self.name + '_bucket', pairs + [('le', format_value(le))],
+                     total))
+            samples.append((self.name + '_sum', pairs, counts[-1]))
+            samples.append((self.name + '_count', pairs, total))
+        return samples
+
+
+class Callback():
+    # read when scraped, func returns {label values: value}
+    def __init__(self, name, kind, help, func, labels=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.func = func
+        self.labels = tuple(labels)
+
+    def samples(self):
+        return [(self.name, zip(self.labels, k), v)
+                for (k, v) in sorted(self.func().items()) if v is not None]
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, kind, help, func, labels=()):
+        return self.add(Callback(name, kind, help, func, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (
+                metric.name,
+                metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for (name, pairs, value) in metric.samples():
+                lines.append('%s%s %s' % (
+                    name, format_labels(pairs), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def operations():
+    try:
+        return LOCAL.operations
+    except AttributeError:
+        LOCAL.operations = []
+        return LOCAL.operations
+
+
+def timed(histogram, *values):
+    # observes the duration of each call, labelled with values or the name
+    # of the function, which is also the operation Redis commands issued
+    # during the call are counted for
+    def decorator(func):
+        labels = values or (func.__name__, )
+        name = ' '.join(labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = operations()
+            stack.append(name)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(labels, time.time() - start)
+                stack.pop()
+        return wrapper
+    return decorator
+
+
+class Plugin():
+    # bottle plugin timing every route, labelled with its method and rule
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def apply(self, callback, route):
+        return timed(self.histogram, route.method, route.rule)(callback)
+
+
+def count(commands, operation_commands, names):
+    for name in names:
+        commands.inc((name, ))
+    # a command counts for every operation in progress, nested ones too
+    for operation in set(operations()):
+        operation_commands.inc((operation, ), len(names))
+
+
+class Redis(redis.Redis):
+    # counts the commands sent, pipelined ones when the pipeline executes
+    def __init__(self, commands, operation_commands, **kwargs):
+        redis.Redis.__init__(self, **kwargs)
+        self.commands = commands
+        self.operation_commands = operation_commands
+
+    def execute_command(self, *args, **options):
+        count(self.commands, self.operation_commands, [args[0]])
+        return redis.Redis.execute_command(self, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self.commands, self.operation_commands,
+                        self.connection_pool, self.response_callbacks,
+                        transaction, shard_hint)
+
+
+class Pipeline(redis.client.Pipeline):
+    def __init__(self, commands, operation_commands, *args):
+        redis.client.Pipeline.__init__(self, *args)
+        self.commands = commands
+        self.operation_commands = operation_commands
+
+    def immediate_execute_command(self, *args, **options):
+        count(self.commands, self.operation_commands, [args[0]])
+        return redis.client.Pipeline.immediate_execute_command(
+            self, *args, **options)
+
+    def execute(self, *args, **kwargs):
+        if self.command_stack:
+            count(self.commands, self.operation_commands,
+                  [command[0] for (command, options) in self.command_stack])
+        return redis.client.Pipeline.execute(self, *args, **kwargs)
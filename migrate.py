@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+import api
+import config
+
+BATCH = 1000
+# seconds between progress reports
+REPORT_INTERVAL = 5
+
+
+class Migration():
+    # A migration reads its source in chunks with one of the SCAN commands,
+    # never all at once, and writes each chunk in a single pipeline along
+    # with the cursor it reached, so an interrupted run resumes from the
+    # last chunk written. Chunks may overlap, writes have to be idempotent.
+    def __init__(self, r):
+        self.r = r
+
+    def name(self):
+        raise NotImplementedError()
+
+    def scan(self, cursor, count):
+        raise NotImplementedError()
+
+    def write(self, m, entries):
+        raise NotImplementedError()
+
+    def describe(self, entry):
+        return repr(entry)
+
+    def keys(self):
+        # keys the migration uses besides the entries it migrates
+        return [checkpoints()]
+
+
+class HashToZset(Migration):
+    # hash of member -> score, e.g. wifi|join to wifi|join-by-timestamp
+    def __init__(self, r, source, target):
+        Migration.__init__(self, r)
+        self.source = source
+        self.target = target
+
+    def name(self):
+        return 'hash-to-zset:%s:%s' % (self.source, self.target)
+
+    def scan(self, cursor, count):
+        (cursor, flat) = self.r.execute_command(
+            'HSCAN', self.source, cursor, 'COUNT', count)
+        return (cursor, zip(flat[::2], flat[1::2]))
+
+    def write(self, m, entries):
+        if entries:
+            m.zadd(self.target, *[
+                v for (member, score) in entries
+                for v in (member, float(score))])
+
+    def describe(self, entry):
+        return '%s -> %s %s' % (self.source, self.target, ' '.join(entry))
+
+
+class RenamePrefix(Migration):
+    # moves every key starting with old to the same name starting with new,
+    # keys already existing under the new name and the keys of the migration
+    # itself are left alone
+    def __init__(self, r, old, new):
+        Migration.__init__(self, r)
+        self.old = old
+        self.new = new
+
+    def name(self):
+        return 'rename-prefix:%s:%s' % (self.old, self.new)
+
+    def scan(self, cursor, count):
+        pattern = ''.join([
+            '\\' + c if c in '*?[]\\' else c for c in self.old]) + '*'
+        return self.r.execute_command(
+            'SCAN', cursor, 'MATCH', pattern, 'COUNT', count)
+
+    def write(self, m, entries):
+        # the checkpoints are kept where run() reads them
+        skipped = set(self.keys())
+        for key in entries:
+            if key in skipped:
+                continue
+            if self.new.startswith(self.old) and key.startswith(self.new):
+                continue
+            m.renamenx(key, self.new + key[len(self.old):])
+
+    def describe(self, entry):
+        return '%s -> %s%s' % (entry, self.new, entry[len(self.old):])
+
+
+class OpenSessions(Migration):
+    # opens the sessions of the MACs active before sessions were recorded,
+    # from the time they joined, those already open are left alone
+    def __init__(self, r):
+        Migration.__init__(self, r)
+        self.data = api.WifiData(r)
+
+    def name(self):
+        return 'open-sessions:%s' % self.data.session_open_hash
+
+    def scan(self, cursor, count):
+        (cursor, macs) = self.r.execute_command(
+            'SSCAN', self.data.active_mac_set, cursor, 'COUNT', count)
+        m = self.r.pipeline(transaction=False)
+        for mac in macs:
+            m.zscore(self.data.join_mac_by_timestamp_z, mac)
+        return (cursor, [(mac, joined) for (mac, joined)
+                         in zip(macs, m.execute()) if joined is not None])
+
+    def write(self, m, entries):
+        for (mac, joined) in entries:
+            m.hsetnx(self.data.session_open_hash, mac, repr(joined))
+
+    def describe(self, entry):
+        return '%s %r -> %r' % (
+            self.data.session_open_hash, entry[0], entry[1])
+
+
+class EncodeMacs(Migration):
+    # rewrites the MAC members of a set or sorted set, or the MAC fields of
+    # a hash, with encode(member)
+    SCANS = {'set': 'SSCAN', 'zset': 'ZSCAN', 'hash': 'HSCAN'}
+
+    def __init__(self, r, key, kind, encode, format_name):
+        Migration.__init__(self, r)
+        self.key = key
+        self.kind = kind
+        self.encode = encode
+        self.format_name = format_name
+
+    def name(self):
+        return 'mac-format:%s:%s' % (self.format_name, self.key)
+
+    def scan(self, cursor, count):
+        (cursor, flat) = self.r.execute_command(
+            self.SCANS[self.kind], self.key, cursor, 'COUNT', count)
+        if self.kind == 'set':
+            return (cursor, [(member, None) for member in flat])
+        return (cursor, zip(flat[::2], flat[1::2]))
+
+    def write(self, m, entries):
+        for (member, value) in entries:
+            new = self.encode(member)
+            if new == member:
+                continue
+            if self.kind == 'set':
+                m.srem(self.key, member)
+                m.sadd(self.key, new)
+            elif self.kind == 'zset':
+                m.zrem(self.key, member)
+                m.zadd(self.key, new, float(value))
+            else:
+                m.hdel(self.key, member)
+                m.hset(self.key, new, value)
+
+    def describe(self, entry):
+        return '%s %r -> %r' % (self.key, entry[0], self.encode(entry[0]))
+
+
+class EncodeKeys(Migration):
+    # renames the keys made of prefix and a MAC
+    def __init__(self, r, prefix, encode, format_name):
+        Migration.__init__(self, r)
+        self.prefix = prefix
+        self.encode = encode
+        self.format_name = format_name
+
+    def name(self):
+        return 'mac-format:%s:%s*' % (self.format_name, self.prefix)
+
+    def scan(self, cursor, count):
+        return self.r.execute_command(
+            'SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', count)
+
+    def write(self, m, entries):
+        for key in entries:
+            new = self.prefix + self.encode(key[len(self.prefix):])
+            if new != key:
+                m.renamenx(key, new)
+
+    def describe(self, entry):
+        return '%r -> %r' % (
+            entry, self.prefix + self.encode(entry[len(self.prefix):]))
+
+
+class SetMacFormat(Migration):
+    # records the format, for the processes started afterwards
+    def __init__(self, r, key, format_name):
+        Migration.__init__(self, r)
+        self.key = key
+        self.format_name = format_name
+
+    def name(self):
+        return 'mac-format:%s:%s' % (self.format_name, self.key)
+
+    def scan(self, cursor, count):
+        return ('0', [self.format_name])
+
+    def write(self, m, entries):
+        m.set(self.key, self.format_name)
+        # a later conversion back to another format must run again
+        done = 'mac-format:%s:' % self.format_name
+        for name in self.r.hkeys(checkpoints()):
+            if name.startswith('mac-format:') and not name.startswith(done):
+                m.hdel(checkpoints(), name)
+
+    def describe(self, entry):
+        return '%s -> %s' % (self.key, entry)
+
+
+def mac_format_migrations(r, format_name):
+    data = api.WifiData(r)
+    mac_format = api.MAC_FORMATS[format_name]
+
+    def encode_session(member):
+        # 'mac start end', a binary MAC may contain spaces
+        (mac, start, end) = member.rsplit(' ', 2)
+        return '%s %s %s' % (mac_format.encode(mac), start, end)
+
+    migrations = []
+    for key in [data.assoclist_mac_set, data.active_mac_set,
+                data.excluded_mac_set, data.rejoined_mac_set]:
+        migrations.append(
+            EncodeMacs(r, key, 'set', mac_format.encode, format_name))
+    for key in [data.join_mac_by_timestamp_z, data.left_mac_by_timestamp_z]:
+        migrations.append(
+            EncodeMacs(r, key, 'zset', mac_format.encode, format_name))
+    for key in [data.mac_to_count_hash, data.mac_to_ip_hash,
+                data.mac_to_hostname_hash, data.session_open_hash]:
+        migrations.append(
+            EncodeMacs(r, key, 'hash', mac_format.encode, format_name))
+    migrations.append(EncodeKeys(
+        r, data.sessions_prefix, mac_format.encode, format_name))
+    cursor = '0'
+    while True:
+        (cursor, keys) = r.execute_command(
+            'SCAN', cursor, 'MATCH', data.sessions_by_day_prefix + '*')
+        for key in sorted(keys):
+            migrations.append(
+                EncodeMacs(r, key, 'zset', encode_session, format_name))
+        if cursor == '0':
+            break
+    migrations.append(SetMacFormat(r, data.mac_format_key, format_name))
+    return migrations
+
+
+def checkpoints():
+    return api.prefix('migrations')
+
+
+def run(migration, batch=BATCH, dry_run=False, restart=False,
+        report_interval=REPORT_INTERVAL):
+    r = migration.r
+    name = migration.name()
+    cursor = r.hget(checkpoints(), name)
+    if cursor == 'done' and not restart:
+        print '%s already done, use -restart to run it again' % name
+        return None
+    if cursor is None or restart:
+        cursor = '0'
+    elif cursor != '0':
+        print 'Resuming %s at cursor %s' % (name, cursor)
+    count = 0
+    started = reported = time.time()
+    while True:
+        (cursor, entries) = migration.scan(cursor, batch)
+        if dry_run:
+            for entry in entries[:max(0, 10 - count)]:
+                print migration.describe(entry)
+        else:
+            m = r.pipeline()
+            migration.write(m, entries)
+            m.hset(checkpoints(), name, cursor if cursor != '0' else 'done')
+            m.execute()
+        count += len(entries)
+        now = time.time()
+        if cursor == '0':
+            break
+        if now - reported >= report_interval:
+            print '%d entries, %d/s, cursor %s' % (
+                count, count / (now - started), cursor)
+            reported = now
+    return (count, time.time() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Migrate Redis keys in chunks, resuming where an earlier '
+                    'run stopped')
+    config.add_arguments(parser)
+    parser.add_argument(
+        '-batch', default=BATCH, type=int, help='entries read per SCAN')
+    parser.add_argument(
+        '-dry_run', action='store_true',
+        help='read everything, print the first changes, write nothing')
+    parser.add_argument(
+        '-restart', action='store_true', help='ignore the checkpoint')
+
+    subparsers = parser.add_subparsers()
+
+    hash_to_zset_parser = subparsers.add_parser(
+        'hash_to_zset', help='copy a hash of scores into a sorted set')
+    hash_to_zset_parser.add_argument('source')
+    hash_to_zset_parser.add_argument('target')
+    hash_to_zset_parser.set_defaults(
+        migrations=lambda r, args: [HashToZset(r, args.source, args.target)])
+
+    rename_prefix_parser = subparsers.add_parser(
+        'rename_prefix', help='rename the keys starting with a prefix')
+    rename_prefix_parser.add_argument('old')
+    rename_prefix_parser.add_argument('new')
+    rename_prefix_parser.set_defaults(
+        migrations=lambda r, args: [RenamePrefix(r, args.old, args.new)])
+
+    open_sessions_parser = subparsers.add_parser(
+        'open_sessions',
+        help='open the sessions of the MACs active before they were recorded')
+    open_sessions_parser.set_defaults(
+        migrations=lambda r, args: [OpenSessions(r)])
+
+    mac_format_parser = subparsers.add_parser(
+        'mac_format',
+        help='store MACs as text or as 6 bytes, the API must be stopped')
+    mac_format_parser.add_argument(
+        'format', choices=sorted(api.MAC_FORMATS))
+    mac_format_parser.set_defaults(
+        migrations=lambda r, args: mac_format_migrations(r, args.format))
+
+    args = parser.parse_args()
+    r = config.client(config.from_args(args))
+    for migration in args.migrations(r, args):
+        result = run(migration, args.batch, args.dry_run, args.restart)
+        if result is not None:
+            (count, elapsed) = result
+            print '%s%s: %d entries in %.2fs (%d/s)' % (
+                migration.name(), ' (dry run)' if args.dry_run else '',
+                count, elapsed, count / max(elapsed, 0.001))
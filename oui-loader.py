@@ -1,20 +1,48 @@
 #!/usr/bin/env python
 
+import argparse
 import re
-import redis
 
-pairs = {}
-count = 0
-for l in file('oui.txt').readlines():
-    m = re.search('(\w{2})-(\w{2})-(\w{2}).*\(hex\)(.*)', l)
-    if m:
-        prefix = '%s:%s:%s' % (m.group(1), m.group(2), m.group(3))
-        name = m.group(4).strip()
-        print '%s %s %s' % (count, prefix, name)
-        count = count + 1
-        pairs[prefix] = name
+import config
+from oui import OuiIndex, parse
 
-print count
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load the IEEE OUI registry into Redis or an index file')
+    parser.add_argument(
+        '-index',
+        help='write an index file for api.py -oui instead of loading Redis')
+    parser.add_argument(
+        'filenames',
+        nargs='*',
+        default=['oui.txt'],
+        help='oui.txt, and for an index also mam.txt and oui36.txt')
+    config.add_arguments(parser)
+    args = parser.parse_args()
 
-r = redis.Redis()
-print r.hmset('oui', pairs)
+    if args.index:
+        entries = []
+        for filename in args.filenames:
+            entries.extend(parse(file(filename)))
+        index = OuiIndex.build(entries)
+        index.save(args.index)
+        print '%s assignments, %s vendors -> %s' % (
+            len(index), len(index.vendors), args.index)
+        exit(0)
+
+    pairs = {}
+    count = 0
+    for filename in args.filenames:
+        for l in file(filename).readlines():
+            m = re.search('(\w{2})-(\w{2})-(\w{2})\s.*\(hex\)(.*)', l)
+            if m:
+                prefix = '%s:%s:%s' % (m.group(1), m.group(2), m.group(3))
+                name = m.group(4).strip()
+                print '%s %s %s' % (count, prefix, name)
+                count = count + 1
+                pairs[prefix] = name
+
+    print count
+
+    r = config.client(config.from_args(args))
+    print r.hmset('oui', pairs)
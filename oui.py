@@ -0,0 +1,136 @@
+import array
+import bisect
+import re
+
+# IEEE registry entries, an MA-L (oui.txt) one:
+#   00-00-0C   (hex)		Cisco Systems, Inc
+#   00000C     (base 16)		Cisco Systems, Inc
+# MA-M (mam.txt) and MA-S (oui36.txt) ones give the parent MA-L prefix, then
+# the range of the block:
+#   70-B3-D5   (hex)		TELEPLATFORM
+#   70B3D5F2F000-70B3D5F2FFFF     (base 16)		TELEPLATFORM
+HEX_REGEXP = re.compile(
+    '^\s*([0-9A-Fa-f]{2}-[0-9A-Fa-f]{2}-[0-9A-Fa-f]{2})\s+\(hex\)\s+'
+    '(.*?)\s*$')
+RANGE_REGEXP = re.compile(
+    '^\s*([0-9A-Fa-f]+)-([0-9A-Fa-f]+)\s+\(base 16\)')
+MAC_BITS = 48
+PREFIX_BITS = (36, 28, 24)
+MAGIC = 'OUI1'
+
+
+def mac_to_int(mac):
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+
+def parse_range(parent, start, end):
+    # (prefix, bits) of a block, its range may also be given relative to
+    # the parent prefix, as 6 digits
+    if len(start) == 6 and len(end) == 6:
+        (start, end) = ['%06X%s' % (parent, digits) for digits in (start, end)]
+    (start, end) = (int(start, 16), int(end, 16))
+    size = end - start + 1
+    bits = MAC_BITS - (size.bit_length() - 1)
+    if size < 1 or size & (size - 1) or start % size or \
+            bits not in PREFIX_BITS:
+        return None
+    return (start >> (MAC_BITS - bits), bits)
+
+
+def parse(lines):
+    # an MA-L line stands for a 24 bit assignment unless a range follows
+    pending = None
+    for line in lines:
+        m = HEX_REGEXP.match(line)
+        if m:
+            if pending is not None:
+                yield pending
+            pending = (int(m.group(1).replace('-', ''), 16), 24, m.group(2))
+            continue
+        m = RANGE_REGEXP.match(line)
+        if m and pending is not None:
+            block = parse_range(pending[0], m.group(1), m.group(2))
+            if block is not None:
+                yield block + (pending[2], )
+            pending = None
+    if pending is not None:
+        yield pending
+
+
+class OuiIndex():
+    def __init__(self, tables, vendors):
+        # bits -> (sorted prefixes, vendor index of each prefix)
+        self.tables = tables
+        self.vendors = vendors
+
+    @classmethod
+    def build(cls, entries):
+        vendors = []
+        vendor_ids = {}
+        by_bits = dict((bits, {}) for bits in PREFIX_BITS)
+        for (prefix, bits, vendor) in entries:
+            if vendor not in vendor_ids:
+                vendor_ids[vendor] = len(vendors)
+                vendors.append(vendor)
+            by_bits[bits][prefix] = vendor_ids[vendor]
+        tables = {}
+        for (bits, prefixes) in by_bits.iteritems():
+            keys = sorted(prefixes)
+            tables[bits] = (
+                array.array('L', keys),
+                array.array('I', [prefixes[k] for k in keys]))
+        return cls(tables, vendors)
+
+    @classmethod
+    def load(cls, *filenames):
+        if len(filenames) == 1 and not filenames[0].endswith('.txt'):
+            return cls.load_binary(filenames[0])
+        entries = []
+        for filename in filenames:
+            entries.extend(parse(file(filename)))
+        return cls.build(entries)
+
+    # header, then per prefix length: count, prefixes, vendor ids and
+    # finally the newline separated vendor names
+    @classmethod
+    def load_binary(cls, filename):
+        f = file(filename, 'rb')
+        header = f.readline().split()
+        if header[0] != MAGIC or int(header[1]) != array.array('L').itemsize:
+            raise ValueError('%s: not an index for this platform' % filename)
+        tables = {}
+        for bits in PREFIX_BITS:
+            count = int(f.readline())
+            prefixes = array.array('L')
+            prefixes.fromfile(f, count)
+            ids = array.array('I')
+            ids.fromfile(f, count)
+            tables[bits] = (prefixes, ids)
+        vendors = f.read().split('\n')
+        f.close()
+        return cls(tables, vendors)
+
+    def save(self, filename):
+        f = file(filename, 'wb')
+        f.write('%s %d\n' % (MAGIC, array.array('L').itemsize))
+        for bits in PREFIX_BITS:
+            (prefixes, ids) = self.tables[bits]
+            f.write('%d\n' % len(prefixes))
+            prefixes.tofile(f)
+            ids.tofile(f)
+        f.write('\n'.join(self.vendors))
+        f.close()
+
+    def __len__(self):
+        return sum([len(prefixes) for (prefixes, ids) in self.tables.values()])
+
+    def lookup(self, mac):
+        value = mac_to_int(mac)
+        # most specific assignment first
+        for bits in PREFIX_BITS:
+            (prefixes, ids) = self.tables[bits]
+            key = value >> (MAC_BITS - bits)
+            i = bisect.bisect_left(prefixes, key)
+            if i < len(prefixes) and prefixes[i] == key:
+                return self.vendors[ids[i]]
+        return None
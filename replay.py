@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import argparse
+import gzip
+import httplib
+import json
+import StringIO
+import time
+
+
+def compress(content):
+    out = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(content)
+    f.close()
+    return out.getvalue()
+
+
+def push(conn, uri, content, use_gzip):
+    headers = {'Content-Type': 'text/plain'}
+    if use_gzip:
+        content = compress(content)
+        headers['Content-Encoding'] = 'gzip'
+    start = time.time()
+    conn.request('POST', uri, content, headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    elapsed = time.time() - start
+    if resp.status != 200:
+        raise Exception('%s %s: %s' % (uri, resp.status, resp.reason))
+    return json.loads(body), elapsed, len(content)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay captured router output against the push API')
+    parser.add_argument('-hostname', default='localhost')
+    parser.add_argument('-port', default='9000')
+    parser.add_argument(
+        '-leases',
+        help='captured dnsmasq.leases, pushed before the assoclists')
+    parser.add_argument(
+        '-delta',
+        action='store_true',
+        help='files contain +MAC/-MAC lines instead of snapshots')
+    parser.add_argument('-gzip', action='store_true')
+    parser.add_argument(
+        '-interval',
+        default=0.0,
+        type=float,
+        help='seconds to wait between pushes')
+    parser.add_argument(
+        'assoclist',
+        nargs='*',
+        help='captured `wl assoclist` outputs, replayed in order')
+    args = parser.parse_args()
+
+    conn = httplib.HTTPConnection(args.hostname, args.port)
+    if args.leases:
+        result, elapsed, size = push(
+            conn, '/leases', file(args.leases).read(), args.gzip)
+        print '%s %d bytes %.3fs %s' % (args.leases, size, elapsed, result)
+
+    uri = '/assoclist'
+    if args.delta:
+        uri = '/assoclist?mode=delta'
+    for filename in args.assoclist:
+        result, elapsed, size = push(
+            conn, uri, file(filename).read(), args.gzip)
+        print '%s %d bytes %.3fs joined %d left %d' % (
+            filename, size, elapsed,
+            len(result['joined']), len(result['left']))
+        time.sleep(args.interval)
@@ -1,3 +1,32 @@
 #!/bin/sh
-wl_atheros assoclist > ~/assoclist
-scp -i ~/.ssh/id_rsa.db /tmp/dnsmasq.leases $HOME/assoclist router@vps2.xinchejian.com:
+API=http://vps2.xinchejian.com:9000
+LOCK=/tmp/router.lock
+
+# one run at a time, a slow push must not overlap the next cron run
+if ! mkdir $LOCK 2> /dev/null; then
+    # unless the run holding it was killed
+    kill -0 "$(cat $LOCK/pid 2> /dev/null)" 2> /dev/null && exit 0
+    rm -rf $LOCK
+    mkdir $LOCK 2> /dev/null || exit 0
+fi
+echo $$ > $LOCK/pid
+trap 'rm -rf $LOCK' EXIT
+trap 'exit 1' INT TERM
+
+push() {
+    gzip -c | curl -s -m 5 -o /dev/null --data-binary @- \
+        -H 'Content-Encoding: gzip' "$API$1"
+}
+
+if which curl > /dev/null; then
+    # push every 5 seconds until the next cron run
+    end=$(($(date +%s) + 55))
+    while [ $(date +%s) -lt $end ]; do
+        wl_atheros assoclist | push /assoclist
+        push /leases < /tmp/dnsmasq.leases
+        sleep 5
+    done
+else
+    wl_atheros assoclist > ~/assoclist
+    scp -i ~/.ssh/id_rsa.db /tmp/dnsmasq.leases $HOME/assoclist router@vps2.xinchejian.com:
+fi
@@ -0,0 +1,238 @@
+import logging
+import os
+import random
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# how often watched files are stat'ed without inotify
+WATCH_INTERVAL = 1
+
+
+def signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class Job():
+    def __init__(self, func, interval, jitter=0, paths=()):
+        self.func = func
+        self.name = func.__name__
+        self.interval = interval
+        self.jitter = jitter
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.next_run = 0
+        self.pending = False
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.triggers = 0
+        self.last_run = None
+        self.last_duration = None
+        self.max_duration = 0
+        self.total_duration = 0
+
+    def due(self, now):
+        return self.pending or now >= self.next_run
+
+    def run(self, logger):
+        self.pending = False
+        start = time.time()
+        try:
+            self.func()
+        except Exception:
+            self.failures += 1
+            logger.exception('Job %s failed' % self.name)
+        duration = time.time() - start
+        self.runs += 1
+        self.last_run = start
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        if duration > self.interval:
+            self.overruns += 1
+            logger.warning('Job %s took %.3fs, longer than its %ss interval'
+                           % (self.name, duration, self.interval))
+        # ticks missed while running are coalesced into this run
+        self.next_run = time.time() + self.interval + \
+            random.uniform(0, self.jitter)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'jitter': self.jitter,
+            'paths': self.paths,
+            'runs': self.runs,
+            'failures': self.failures,
+            'overruns': self.overruns,
+            'triggers': self.triggers,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'mean_duration': self.total_duration / self.runs
+            if self.runs else None,
+            'next_run': self.next_run,
+        }
+
+
+class Scheduler():
+    # Runs all jobs on a single thread, one at a time, so they never
+    # compete with each other. A job also runs as soon as one of its files
+    # changes, through inotify when pyinotify is installed, by polling
+    # their stat otherwise. With a leader, jobs only run while its
+    # acquire() succeeds, it is retried every leader.interval seconds,
+    # from another thread while a job runs.
+    # report(stats) is called after the jobs due have run.
+    def __init__(self, logger=None, leader=None, report=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.leader = leader
+        self.report = report
+        self.leading = False
+        self.jobs = []
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.notifier = None
+        self.signatures = {}
+
+    def add(self, func, interval, jitter=0, paths=()):
+        job = Job(func, interval, jitter, paths)
+        self.jobs.append(job)
+        return job
+
+    def paths(self):
+        return sorted(set([path for job in self.jobs for path in job.paths]))
+
+    def trigger(self, path):
+        for job in self.jobs:
+            if path in job.paths:
+                job.pending = True
+                job.triggers += 1
+        self.wakeup.set()
+
+    def start(self):
+        paths = self.paths()
+        if paths and pyinotify is not None:
+            self.notifier = self._notifier(paths)
+            self.notifier.start()
+        for path in paths:
+            self.signatures[path] = signature(path)
+        for job in self.jobs:
+            self.logger.info('Job %s every %ss%s' % (
+                job.name, job.interval,
+                ', on changes to %s' % ', '.join(job.paths)
+                if job.paths else ''))
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        if self.notifier is not None:
+            self.notifier.stop()
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.notifier is None:
+                self._poll_paths()
+            timeout = WATCH_INTERVAL
+            if self._lead():
+                ran = False
+                for job in self.jobs:
+                    # the lead can be lost while the previous job runs
+                    if not self.leading:
+                        break
+                    if job.due(time.time()) and not self.stopped.is_set():
+                        self._run(job)
+                        ran = True
+                if ran and self.report is not None:
+                    self._report()
+                if self.jobs:
+                    timeout = min([job.next_run for job in self.jobs]) - \
+                        time.time()
+            if self.leader is not None:
+                timeout = min(timeout, self.leader.interval)
+            if self.notifier is None and self.signatures:
+                timeout = min(timeout, WATCH_INTERVAL)
+            self.wakeup.wait(max(0, timeout))
+            self.wakeup.clear()
+
+    def stats(self):
+        return {
+            'leader': self.leading,
+            'watcher': 'inotify' if self.notifier is not None else 'poll',
+            'jobs': dict([(job.name, job.stats()) for job in self.jobs]),
+        }
+
+    def _lead(self):
+        if self.leader is None:
+            self.leading = True
+            return True
+        try:
+            leading = self.leader.acquire()
+        except Exception:
+            self.logger.exception('Unable to acquire the scheduler lead')
+            leading = False
+        if leading != self.leading:
+            self.logger.info('Scheduler lead %s'
+                             % ('acquired' if leading else 'lost'))
+        self.leading = leading
+        return leading
+
+    def _run(self, job):
+        if self.leader is None:
+            job.run(self.logger)
+            return
+        # a job may outlast the lead, it is renewed until the job is done
+        done = threading.Event()
+        renewal = threading.Thread(target=self._renew, args=(done, ))
+        renewal.daemon = True
+        renewal.start()
+        try:
+            job.run(self.logger)
+        finally:
+            done.set()
+            renewal.join()
+
+    def _renew(self, done):
+        while not done.wait(self.leader.interval):
+            self._lead()
+
+    def _report(self):
+        try:
+            self.report(self.stats())
+        except Exception:
+            self.logger.exception('Unable to report the scheduler stats')
+
+    def _poll_paths(self):
+        for (path, old) in self.signatures.items():
+            new = signature(path)
+            if new != old:
+                self.signatures[path] = new
+                self.trigger(path)
+
+    def _notifier(self, paths):
+        # watches the directories, files are usually replaced by a rename
+        scheduler = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.pathname in paths:
+                    scheduler.trigger(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        for directory in set([os.path.dirname(path) for path in paths]):
+            manager.add_watch(directory, mask)
+        notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        notifier.daemon = True
+        return notifier
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import agent
+import fakes
+
+A = '00:11:22:33:44:55'
+B = '00:11:22:33:44:66'
+C = '66:55:44:33:22:20'
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'mac.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def rows(self, store, query):
+        store.cursor.execute(query)
+        return store.cursor.fetchall()
+
+
+class StoreTest(StoreTestCase):
+    def test_migrate(self):
+        # the schema before versions, one row per session in mac
+        conn = sqlite3.connect(self.filename)
+        conn.execute("create table mac (joined NUMERIC, left NUMERIC, "
+                     "mac TEXT)")
+        conn.executemany("insert into mac values (?, ?, ?)",
+                         [(1, 2, A), (3, None, A), (4, None, B)])
+        conn.commit()
+        conn.close()
+        store = agent.Store(self.filename)
+        self.assertEqual(self.rows(store, "pragma user_version"),
+                         [(len(agent.MIGRATIONS), )])
+        self.assertEqual(store.current_macs(), set([A, B]))
+        self.assertEqual(
+            self.rows(store, "select mac, joined, left from session join "
+                             "device on device.id = session.device "
+                             "order by session.id"),
+            [(A, 1, 2), (A, 3, None), (B, 4, None)])
+        store.record(set([C]), set([A]))
+        self.assertEqual(store.current_macs(), set([B, C]))
+        self.assertEqual([event[2:] for event in store.pending(10)],
+                         [('+', C), ('-', A)])
+        store.close()
+        # migrated once
+        store = agent.Store(self.filename)
+        self.assertEqual(store.current_macs(), set([B, C]))
+        store.close()
+
+    def test_archive(self):
+        store = agent.Store(self.filename)
+        store.record(set([A, B]), set())
+        store.record(set(), set([A]))
+        (seq, timestamp, event, mac) = store.pending(10)[-1]
+        store.ack(seq - 1)
+        self.assertEqual(store.archive(time.time() + 1), 1)
+        self.assertEqual(store.current_macs(), set([B]))
+        self.assertEqual(self.rows(store, "select count(*) from session"),
+                         [(1, )])
+        # only the acknowledged events are dropped
+        self.assertEqual(store.pending(10), [(seq, timestamp, event, mac)])
+        self.assertEqual(self.rows(store, "select count(*) from outbox"),
+                         [(1, )])
+        store.close()
+        archive = sqlite3.connect(self.filename + '.archive')
+        sessions = archive.execute("select mac from session").fetchall()
+        archive.close()
+        self.assertEqual(sessions, [(A, )])
+
+
+class FlusherTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.api = fakes.start(fakes.FakeApi(('localhost', 0)))
+
+    def tearDown(self):
+        self.api.shutdown()
+        self.api.server_close()
+        StoreTestCase.tearDown(self)
+
+    def test_flush(self):
+        store = agent.Store(self.filename)
+        store.record(set([A, B]), set())
+        store.record(set(), set([A]))
+        flusher = agent.Flusher(self.filename, 'localhost',
+                                self.api.server_address[1])
+        flusher.flush(store)
+        self.assertEqual(store.pending(10), [])
+        (events, resync) = self.api.requests
+        self.assertEqual(
+            events[:2], ('POST', '/assoclist?mode=events&agent=%s'
+                         % store.agent_id))
+        self.assertEqual(
+            [line.split()[2] for line in events[2].splitlines()],
+            ['+' + A, '+' + B, '-' + A])
+        self.assertEqual(resync, ('POST', '/assoclist', '%s\n' % B))
+        # nothing left to send
+        flusher.flush(store)
+        self.assertEqual(self.api.requests[-1][:2], ('GET', '/ping'))
+        flusher.close()
+        store.close()
+
+    def test_bad_response(self):
+        store = agent.Store(self.filename)
+        store.record(set([A]), set())
+        flusher = agent.Flusher(self.filename, 'localhost',
+                                self.api.server_address[1])
+        flusher.backoff = agent.Backoff(0.01)
+        # the first batch is answered without acked
+        responses = ['{}']
+        request = flusher.request
+        flusher.request = lambda method, uri, body=None: (
+            responses.pop() if responses else request(method, uri, body))
+        flusher.start()
+        flusher.notify()
+        for i in range(200):
+            if not responses:
+                flusher.notify()
+                if not store.pending(10):
+                    break
+            time.sleep(0.01)
+        flusher.stop()
+        self.assertEqual(store.pending(10), [])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+import gzip
+import json
+import os
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import redis
+
+import api
+import events
+import migrate
+
+# the tests start their own redis-server, REDIS_SERVER or the one on the PATH
+REDIS_SERVER = os.environ.get('REDIS_SERVER', 'redis-server')
+T = 1369058400.0
+A = '00:11:22:33:44:55'
+B = '00:11:22:33:44:66'
+C = '66:55:44:33:22:20'
+server = None
+tempdir = None
+
+
+def setUpModule():
+    global server, tempdir
+    tempdir = tempfile.mkdtemp()
+    socket = os.path.join(tempdir, 'redis.sock')
+    try:
+        server = subprocess.Popen(
+            [REDIS_SERVER, '--port', '0', '--unixsocket', socket,
+             '--save', '', '--appendonly', 'no', '--dir', tempdir],
+            stdout=open(os.devnull, 'w'))
+    except OSError:
+        shutil.rmtree(tempdir)
+        raise unittest.SkipTest('%s not found' % REDIS_SERVER)
+    for i in range(50):
+        if os.path.exists(socket):
+            break
+        time.sleep(0.1)
+
+
+def tearDownModule():
+    server.terminate()
+    server.wait()
+    shutil.rmtree(tempdir)
+
+
+class RedisTestCase(unittest.TestCase):
+    def setUp(self):
+        self.r = redis.Redis(
+            unix_socket_path=os.path.join(tempdir, 'redis.sock'))
+        self.r.flushdb()
+        self.data = api.WifiData(self.r)
+
+    def active(self):
+        return set(self.data.macs()['mac'])
+
+    def contents(self):
+        # of every key but the log of events and the migration state
+        readers = {
+            'string': self.r.get,
+            'set': self.r.smembers,
+            'hash': self.r.hgetall,
+            'zset': lambda key: self.r.zrange(key, 0, -1, withscores=True),
+        }
+        skipped = (self.data.events_stream, self.data.mac_format_key,
+                   migrate.checkpoints())
+        return dict((key, readers[self.r.type(key)](key))
+                    for key in self.r.keys('*') if key not in skipped)
+
+    def get(self, path, query='', environ=None):
+        # (status, body) of a request to the API
+        api.DATA = self.data
+        environ = dict(environ or {}, PATH_INFO=path, QUERY_STRING=query)
+        setup_testing_defaults(environ)
+        status = []
+        body = bottle.default_app()(
+            environ, lambda s, headers, exc_info=None: status.append(s))
+        return (int(status[0].split()[0]), ''.join(body))
+
+    def post(self, path, body, query='', encoding=None):
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': StringIO.StringIO(body)}
+        if encoding is not None:
+            environ['HTTP_CONTENT_ENCODING'] = encoding
+        return self.get(path, query, environ)
+
+    def reconcile(self, macs):
+        return tuple(
+            [sorted(changed) for changed in self.data.bulk(macs)])
+
+    def delta(self, joined, left):
+        return tuple(
+            [sorted(changed) for changed in self.data.delta(joined, left)])
+
+
+class ReconcileTest(RedisTestCase):
+    def test_bulk(self):
+        self.assertEqual(self.reconcile([A, B]), ([A, B], []))
+        self.assertEqual(self.reconcile([B, C.lower()]), ([C], [A]))
+        self.assertEqual(self.reconcile([B, C]), ([], []))
+        self.assertEqual(self.active(), set([B, C]))
+        self.assertEqual(self.data.count(), 2)
+        self.assertEqual(self.r.hgetall(self.data.mac_to_count_hash),
+                         {A: '1', B: '1', C: '1'})
+        self.assertNotEqual(
+            self.r.zscore(self.data.left_mac_by_timestamp_z, A), None)
+
+    def test_rejoin(self):
+        self.data.bulk([A])
+        joined = self.r.zscore(self.data.join_mac_by_timestamp_z, A)
+        self.data.bulk([])
+        self.assertEqual(self.reconcile([A]), ([A], []))
+        self.assertEqual(self.r.hget(self.data.mac_to_count_hash, A), '2')
+        self.assertEqual(
+            self.r.zscore(self.data.join_mac_by_timestamp_z, A), joined)
+        self.data.bulk([])
+        self.data.bulk([A], interval=0)
+        self.assertNotEqual(
+            self.r.zscore(self.data.join_mac_by_timestamp_z, A), joined)
+
+    def test_join_and_left(self):
+        self.assertTrue(self.data.join(A))
+        self.assertFalse(self.data.join(A))
+        self.assertEqual(self.reconcile([A, B]), ([B], []))
+        self.assertTrue(self.data.left(A))
+        self.assertFalse(self.data.left(A))
+        self.assertEqual(self.active(), set([B]))
+
+    def test_push(self):
+        body = StringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=body, mode='w')
+        gz.write('assoclist %s\nassoclist %s\n' % (A, B))
+        gz.close()
+        (status, content) = self.post('/assoclist', body.getvalue(),
+                                      encoding='gzip')
+        self.assertEqual((status, sorted(json.loads(content)['joined'])),
+                         (200, [A, B]))
+        for path in ['/assoclist', '/leases']:
+            self.assertEqual(
+                self.post(path, 'not gzip', encoding='gzip')[0], 400)
+        self.assertEqual(self.active(), set([A, B]))
+
+    def test_delta(self):
+        self.assertEqual(self.delta([A, B], [C]), ([A, B], []))
+        self.assertEqual(self.delta([A], [B.lower()]), ([], [B]))
+        self.assertEqual(self.active(), set([A]))
+        # the next snapshot starts from the MACs of the deltas
+        self.assertEqual(self.reconcile([A, C]), ([C], []))
+
+    def test_rejoin_keeps_join_time(self):
+        self.data.delta([A], [], now=T)
+        self.data.delta([], [A], now=T + 10)
+        self.data.delta([A], [], now=T + 20)
+        self.assertEqual(
+            self.r.zscore(self.data.join_mac_by_timestamp_z, A), T)
+        self.data.delta([], [A], now=T + 30)
+        self.data.delta([A], [], now=T + 30 + api.JOIN_INTERVAL + 1)
+        self.assertEqual(
+            self.r.zscore(self.data.join_mac_by_timestamp_z, A),
+            T + 30 + api.JOIN_INTERVAL + 1)
+
+    def test_join_before_cutoff(self):
+        # a replayed join older than the last exclusion run is still excluded
+        self.data.update_excluded()
+        self.data.delta([A], [], now=T)
+        self.assertEqual(self.data.update_excluded(), [A])
+
+    def test_sessions(self):
+        self.data.delta([A], [], now=T)
+        self.data.delta([], [A], now=T + 60)
+        self.data.delta([A], [], now=T + 120)
+        self.assertEqual(self.data.sessions(A),
+                         [(T, T + 60), (T + 120, None)])
+        self.assertEqual(self.data.sessions(A, T + 90, T + 100), [])
+        self.assertEqual(self.data.overlapping(T, T + 30),
+                         [(A, T, T + 60)])
+
+    def test_session_params(self):
+        self.data.delta([A], [], now=T)
+        for (path, query) in [('/sessions/MAC/%s' % A, 'start=x'),
+                              ('/sessions/MAC/%s' % A, 'end=1.2.3'),
+                              ('/sessions/MAC/%s/dwell/1.2.3/2' % A, ''),
+                              ('/sessions/1.2.3/2', ''),
+                              ('/present/1.2.3', '')]:
+            self.assertEqual(self.get(path, query)[0], 400, path)
+        (status, body) = self.get('/sessions/MAC/%s' % A)
+        self.assertEqual((status, len(json.loads(body)['sessions'])),
+                         (200, 1))
+        (status, body) = self.get('/present/%r' % (T + 1))
+        self.assertEqual((status, json.loads(body)['present']), (200, [A]))
+
+
+class QueryTest(RedisTestCase):
+    def test_iter_query(self):
+        macs = ['00:11:22:33:44:%02d' % i for i in range(10)]
+        self.data.bulk(macs)
+        pages = self.data.iter_query(0, '+inf', page_size=3)
+        seen = [pages.next()[0] for i in range(3)]
+        # a purge behind the walk doesn't make it skip any
+        self.data.purge(macs[0])
+        seen += [mac for (mac, info) in pages]
+        self.assertEqual(seen, macs)
+
+    def test_pages(self):
+        macs = ['00:11:22:33:44:%02d' % i for i in range(10)]
+        self.data.bulk(macs)
+        page = self.data.macs(limit=4)
+        self.assertEqual(sorted(page['mac']), macs[:4])
+        self.assertEqual(page['next'], macs[3])
+        # leaves before the cursor don't move it
+        self.data.left(macs[1])
+        page = self.data.macs(limit=4, after=page['next'].lower())
+        self.assertEqual(sorted(page['mac']), macs[4:8])
+        page = self.data.macs(limit=4, after=page['next'])
+        self.assertEqual((sorted(page['mac']), page['next']),
+                         (macs[8:], None))
+        self.assertRaises(ValueError, self.data.macs, limit=4, after='x')
+
+    def test_query_pages(self):
+        macs = ['00:11:22:33:44:%02d' % i for i in range(10)]
+        self.data.bulk(macs[:5])
+        self.data.bulk(macs)
+        page = self.data.query(0, '+inf', limit=4)
+        self.assertEqual(sorted(page['mac']), macs[:4])
+        self.data.purge(macs[0])
+        page = self.data.query(0, '+inf', limit=4, after=page['next'])
+        self.assertEqual(sorted(page['mac']), macs[4:8])
+        page = self.data.query(0, '+inf', after=page['next'])
+        self.assertEqual((sorted(page['mac']), page['next']),
+                         (macs[8:], None))
+        for after in ['x', '1.0', '1.0,x']:
+            self.assertRaises(ValueError, self.data.query, 0, '+inf',
+                              limit=4, after=after)
+
+    def test_query_params(self):
+        self.data.bulk([A, B])
+        for query in ['limit=0', 'limit=-1', 'offset=-1', 'limit=x',
+                      'limit=1&after=x']:
+            self.assertEqual(self.get('/MAC', query)[0], 400)
+            self.assertEqual(self.get('/MAC/0/9999999999', query)[0], 400)
+        self.assertEqual(self.get('/MAC/0/9999999999', 'after=1.0,x')[0],
+                         400)
+        (status, body) = self.get('/MAC', 'limit=1')
+        self.assertEqual((status, json.loads(body)['next']), (200, A))
+
+
+class ApplyEventsTest(RedisTestCase):
+    EVENTS = [(1, T, '+', A), (2, T, '+', B), (3, T + 10, '-', A)]
+
+    def test_replay(self):
+        self.assertEqual(self.data.apply_events('agent', self.EVENTS),
+                         (3, [A, B], [A]))
+        contents = self.contents()
+        self.assertEqual(self.data.apply_events('agent', self.EVENTS),
+                         (3, [], []))
+        self.assertEqual(self.data.apply_events('agent', self.EVENTS[1:]),
+                         (3, [], []))
+        self.assertEqual(self.contents(), contents)
+        self.assertEqual(self.active(), set([B]))
+        self.assertEqual(
+            self.r.zscore(self.data.left_mac_by_timestamp_z, A), T + 10)
+        self.assertEqual(self.data.sessions(A), [(T, T + 10)])
+
+    def test_partial_replay(self):
+        self.data.apply_events('agent', self.EVENTS[:2])
+        self.assertEqual(
+            self.data.apply_events(
+                'agent', self.EVENTS + [(4, T + 20, '+', C)]),
+            (4, [C], [A]))
+        self.assertEqual(self.active(), set([B, C]))
+
+    def test_agents(self):
+        # each agent has its own sequence
+        self.data.apply_events('one', self.EVENTS)
+        self.assertEqual(
+            self.data.apply_events('two', [(1, T + 20, '+', C)]),
+            (1, [C], []))
+
+    def test_repeated_mac(self):
+        # events of one timestamp are applied in order
+        events = [(1, T, '+', A), (2, T, '-', A), (3, T, '+', A),
+                  (4, T, '+', B), (5, T, '-', B)]
+        self.assertEqual(self.data.apply_events('agent', events),
+                         (5, [A, A, B], [A, B]))
+        self.assertEqual(self.active(), set([A]))
+
+    def test_concurrent(self):
+        # the same batch sent twice at once, e.g. by a retry
+        macs = ['00:11:22:33:44:%02d' % i for i in range(50)]
+        events = []
+        for (i, mac) in enumerate(macs):
+            events.append((2 * i + 1, T + 2 * i, '+', mac))
+            events.append((2 * i + 2, T + 2 * i + 1, '-', mac))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.data.apply_events('agent', events))) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([last for (last, joined, left) in results],
+                         [100, 100])
+        self.assertEqual(
+            sorted(sum([joined for (last, joined, left) in results], [])),
+            macs)
+        self.assertEqual(self.r.hgetall(self.data.mac_to_count_hash),
+                         dict((mac, '1') for mac in macs))
+        self.assertEqual(self.r.get(api.prefix('agent-seq', 'agent')), '100')
+
+    def test_parse(self):
+        content = '1 %r +%s\n2 %r -%s\n' % (T, A.lower(), T + 1, A)
+        self.assertEqual(api.parse_events(content),
+                         [(1, T, '+', A), (2, T + 1, '-', A)])
+
+
+class PurgeTest(RedisTestCase):
+    def test_purge(self):
+        self.data.delta([A, B], [], now=T)
+        self.data.delta([], [A], now=T + 60)
+        self.data.delta([A], [], now=T + 120)
+        self.data.add_leases({A: ('10.0.10.2', 'host'),
+                              B: ('10.0.10.3', 'other')})
+        self.data.purge(A)
+        self.assertEqual(self.active(), set([B]))
+        self.assertEqual(self.data.count(), 1)
+        self.assertEqual(self.data.sessions(A), [])
+        self.assertEqual(self.data.overlapping(T, T + 200),
+                         [(B, T, None)])
+        for key in [self.data.join_mac_by_timestamp_z,
+                    self.data.left_mac_by_timestamp_z]:
+            self.assertEqual(self.r.zscore(key, A), None)
+        for key in [self.data.mac_to_count_hash, self.data.mac_to_ip_hash,
+                    self.data.mac_to_hostname_hash,
+                    self.data.session_open_hash]:
+            self.assertFalse(self.r.hexists(key, A))
+        self.assertEqual(self.r.keys(self.data.sessions_prefix + A), [])
+        self.assertEqual(self.r.hget(self.data.mac_to_ip_hash, B),
+                         '10.0.10.3')
+
+
+class MigrateTest(RedisTestCase):
+    def populate(self):
+        self.data.delta([A, B, C], [], now=T)
+        self.data.delta([], [A], now=T + 60)
+        self.data.delta([A], [], now=T + 86400)
+        self.data.add_leases({A: ('10.0.10.2', 'host')})
+
+    def snapshot(self, data):
+        # uptime moves with the clock
+        fields = ['joined', 'count', 'left', 'ip', 'hostname']
+        return (data.macs(fields=fields),
+                data.query(0, '+inf', limit=2, fields=fields),
+                [data.sessions(mac) for mac in (A, B, C)],
+                data.overlapping(T, T + 86400 + 1))
+
+    def migrate(self, migrations):
+        for migration in migrations:
+            migrate.run(migration, batch=2, report_interval=3600)
+
+    def test_mac_format(self):
+        self.populate()
+        before = self.snapshot(self.data)
+        contents = self.contents()
+        self.migrate(migrate.mac_format_migrations(self.r, 'binary'))
+        data = api.WifiData(self.r)
+        self.assertEqual(data.mac_format, api.BINARY)
+        self.assertEqual(
+            self.r.smembers(data.active_mac_set),
+            set([api.BINARY.encode(mac) for mac in (A, B, C)]))
+        self.assertEqual(self.snapshot(data), before)
+        self.migrate(migrate.mac_format_migrations(self.r, 'text'))
+        self.assertEqual(api.WifiData(self.r).mac_format, api.TEXT)
+        self.assertEqual(self.contents(), contents)
+        # and back again
+        self.migrate(migrate.mac_format_migrations(self.r, 'binary'))
+        data = api.WifiData(self.r)
+        self.assertEqual(
+            self.r.smembers(data.active_mac_set),
+            set([api.BINARY.encode(mac) for mac in (A, B, C)]))
+        self.assertEqual(self.snapshot(data), before)
+        self.assertEqual(sorted(data.update_excluded()), [A, B, C])
+
+    def test_resume(self):
+        # a run stopped after some of the migrations, the next one skips them
+        self.populate()
+        before = self.snapshot(self.data)
+        migrations = migrate.mac_format_migrations(self.r, 'binary')
+        self.migrate(migrations[:3])
+        self.migrate(migrate.mac_format_migrations(self.r, 'binary'))
+        self.assertEqual(self.snapshot(api.WifiData(self.r)), before)
+
+    def test_open_sessions(self):
+        self.populate()
+        self.r.delete(self.data.session_open_hash)
+        self.migrate([migrate.OpenSessions(self.r)])
+        self.assertEqual(self.data.sessions(B), [(T, None)])
+        self.assertEqual(self.data.sessions(A)[-1], (T + 86400, None))
+
+    def test_rename_prefix(self):
+        self.populate()
+        keys = set(self.r.keys('*'))
+        self.migrate([migrate.RenamePrefix(self.r, 'wifi|', 'wifi2|')])
+        self.assertEqual(
+            set(self.r.keys('*')) - set([migrate.checkpoints()]),
+            set(['wifi2|' + key[len('wifi|'):] for key in keys]))
+        self.assertEqual(
+            self.r.hgetall(migrate.checkpoints()),
+            {'rename-prefix:wifi|:wifi2|': 'done'})
+
+
+class EventsTest(RedisTestCase):
+    def test_claim(self):
+        # events read by a projector under another name, never acknowledged
+        self.data.delta([A, B], [], now=T)
+        stream = self.data.events_stream
+        self.r.execute_command(
+            'XGROUP', 'CREATE', stream, 'projector', '0')
+        self.r.execute_command(
+            'XREADGROUP', 'GROUP', 'projector', 'host-123', 'COUNT', 1,
+            'STREAMS', stream, '>')
+        events.claim(self.r, stream, 'projector', 'host')
+        pending = self.r.execute_command(
+            'XPENDING', stream, 'projector', '-', '+', 10)
+        self.assertEqual([p[1] for p in pending], ['host'])
+        consumers = self.r.execute_command(
+            'XINFO', 'CONSUMERS', stream, 'projector')
+        self.assertEqual(len(consumers), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
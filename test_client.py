@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import unittest
+
+import client
+import fakes
+
+A = '00:11:22:33:44:55'
+B = '00:11:22:33:44:66'
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.api = fakes.start(fakes.FakeApi(('localhost', 0)))
+        self.client = client.Client('localhost', self.api.server_address[1])
+
+    def tearDown(self):
+        self.api.shutdown()
+        self.api.server_close()
+
+    def test_pages(self):
+        # the Macs of a page are accepted wherever a MAC is
+        page = [client.Mac(mac, *[None] * (len(client.Mac._fields) - 1))
+                for mac in (A, B)]
+        self.client.join_many(page)
+        self.client.left(page[0])
+        self.client.purge_many(page)
+        self.assertEqual(self.api.requests[:2], [
+            ('POST', '/assoclist?mode=delta', '+%s\n+%s' % (A, B)),
+            ('POST', '/assoclist?mode=delta', '-%s' % A)])
+        self.assertEqual(sorted(self.api.requests[2:]), [
+            ('DELETE', '/MAC/purge/%s' % A, ''),
+            ('DELETE', '/MAC/purge/%s' % B, '')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+import oui
+
+# oui.txt, mam.txt and oui36.txt entries, MA-M and MA-S blocks with an
+# absolute range and with one relative to their MA-L prefix
+REGISTRY = '''
+00-00-0C   (hex)\t\tCisco Systems, Inc
+00000C     (base 16)\t\tCisco Systems, Inc
+\t\t\t\t170 West Tasman Drive
+\t\t\t\tSan Jose  CA  95134
+\t\t\t\tUS
+
+70-B3-D5   (hex)\t\tIEEE Registration Authority
+70B3D5     (base 16)\t\tIEEE Registration Authority
+
+F8-B5-68   (hex)\t\tMaybee
+F8B568300000-F8B5683FFFFF     (base 16)\t\tMaybee
+
+F8-B5-68   (hex)\t\tOther
+400000-4FFFFF     (base 16)\t\tOther
+
+70-B3-D5   (hex)\t\tTELEPLATFORM
+70B3D5F2F000-70B3D5F2FFFF     (base 16)\t\tTELEPLATFORM
+
+70-B3-D5   (hex)\t\tSmall
+123000-123FFF     (base 16)\t\tSmall
+
+70-B3-D5   (hex)\t\tMisaligned
+124800-125FFF     (base 16)\t\tMisaligned
+'''.splitlines(True)
+LOOKUPS = [
+    ('00:00:0C:12:34:56', 'Cisco Systems, Inc'),
+    ('00-00-0c-12-34-56', 'Cisco Systems, Inc'),
+    ('F8:B5:68:3A:BC:DE', 'Maybee'),
+    ('F8:B5:68:4A:BC:DE', 'Other'),
+    # the parent of MA-M and MA-S blocks is not assigned with them
+    ('F8:B5:68:5A:BC:DE', None),
+    ('70:B3:D5:F2:F1:23', 'TELEPLATFORM'),
+    ('70:B3:D5:12:3F:FF', 'Small'),
+    ('70:B3:D5:12:40:00', 'IEEE Registration Authority'),
+    ('70:B3:D5:12:48:00', 'IEEE Registration Authority'),
+    ('00:00:0D:00:00:00', None),
+]
+
+
+class OuiIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = oui.OuiIndex.build(oui.parse(REGISTRY))
+
+    def test_parse(self):
+        self.assertEqual(sorted(oui.parse(REGISTRY)), sorted([
+            (0x00000C, 24, 'Cisco Systems, Inc'),
+            (0x70B3D5, 24, 'IEEE Registration Authority'),
+            (0xF8B5683, 28, 'Maybee'),
+            (0xF8B5684, 28, 'Other'),
+            (0x70B3D5F2F, 36, 'TELEPLATFORM'),
+            (0x70B3D5123, 36, 'Small'),
+        ]))
+
+    def test_lookup(self):
+        self.assertEqual(len(self.index), 6)
+        for (mac, vendor) in LOOKUPS:
+            self.assertEqual(self.index.lookup(mac), vendor, mac)
+
+    def test_binary(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'oui.idx')
+            self.index.save(filename)
+            index = oui.OuiIndex.load(filename)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(len(index), len(self.index))
+        for (mac, vendor) in LOOKUPS:
+            self.assertEqual(index.lookup(mac), vendor, mac)
+
+
+if __name__ == '__main__':
+    unittest.main()
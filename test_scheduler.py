@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import time
+import unittest
+
+from scheduler import Scheduler
+
+
+class FakeLeader():
+    def __init__(self, leading=True):
+        self.interval = 0.01
+        self.leading = leading
+        self.acquired = []
+
+    def acquire(self):
+        self.acquired.append(time.time())
+        return self.leading
+
+
+class SchedulerTest(unittest.TestCase):
+    def run_until(self, scheduler, done):
+        scheduler.start()
+        for i in range(100):
+            if done():
+                break
+            time.sleep(0.01)
+        scheduler.stop()
+
+    def test_renew_during_job(self):
+        leader = FakeLeader()
+        scheduler = Scheduler(leader=leader)
+        runs = []
+
+        def slow():
+            runs.append(len(leader.acquired))
+            time.sleep(0.1)
+            runs.append(len(leader.acquired))
+        scheduler.add(slow, 60)
+        self.run_until(scheduler, lambda: len(runs) == 2)
+        # renewed several times while it ran
+        self.assertTrue(runs[1] - runs[0] >= 3, runs)
+
+    def test_lost_during_job(self):
+        leader = FakeLeader()
+        scheduler = Scheduler(leader=leader)
+        ran = []
+
+        def losing():
+            leader.leading = False
+            time.sleep(0.05)
+            ran.append('losing')
+
+        def other():
+            ran.append('other')
+        scheduler.add(losing, 60)
+        scheduler.add(other, 60)
+        self.run_until(scheduler, lambda: ran)
+        self.assertEqual(ran, ['losing'])
+        self.assertFalse(scheduler.leading)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
 echo "convert join"
-./convert_from_hash_to_z.py "wifi|join" "wifi|join-by-timestamp"
+./migrate.py hash_to_zset "wifi|join" "wifi|join-by-timestamp"
 echo "convert left"
-./convert_from_hash_to_z.py "wifi|left" "wifi|left-by-timestamp"
+./migrate.py hash_to_zset "wifi|left" "wifi|left-by-timestamp"